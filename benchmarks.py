@@ -0,0 +1,222 @@
+"""
+Performance benchmarks for the sandbar analysis raster code.
+
+Each benchmark runs against a real survey points file so that the timings
+reflect a realistic site. By default this is the test grid that ships with
+the repository.
+
+    python benchmarks.py bilinear --points test/assets/grids/realgrid.txt
+    python benchmarks.py resample --cell_size 0.5
+    python benchmarks.py geotiff --profiles legacy deflate zstd cog
+    python benchmarks.py parser --copies 20 --files 4 --workers 4
+"""
+import os
+import argparse
+import tempfile
+import timeit
+import numpy as np
+from raster import Raster, bilinear_resample, delete_raster, geotiff_profile, GEOTIFF_PROFILES
+from csv_lib import union_csv_extents, read_points, PointCloudLoader
+
+DEFAULT_POINTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test', 'assets', 'grids', 'realgrid.txt')
+
+
+def load_site_dem(points_path: str, cell_size: float) -> Raster:
+    """
+    Load a survey points file into a DEM raster the same way that raster preparation does
+    """
+
+    the_extent = union_csv_extents([points_path], cell_size=cell_size, padding=10.0)
+    dem = Raster(extent=the_extent, cellWidth=cell_size)
+    dem.load_dem_from_csv(points_path, the_extent)
+    return dem
+
+
+def bilinear_resample_loop(old_grid: np.array, new_shape: tuple) -> np.array:
+    """
+    The original cell by cell bilinear resample. Kept here as the
+    reference that the vectorized version is compared against.
+    """
+    new_arr = np.nan * np.empty(new_shape)
+    old_cols, old_rows = old_grid.shape
+    new_cols, new_rows = new_shape
+    x_mult = float(new_cols) / old_cols
+    y_mult = float(new_rows) / old_rows
+
+    for (x, y), __element in np.ndenumerate(new_arr):
+        fx = x / x_mult
+        fy = y / y_mult
+
+        ix1 = int(np.floor(fx))
+        iy1 = int(np.floor(fy))
+
+        if fx == float(new_cols - 1):
+            ix1 -= 1
+        if fy == float(new_rows - 1):
+            iy1 -= 1
+
+        ix2 = ix1 + 1
+        iy2 = iy1 + 1
+
+        if (ix1 >= 0) and (iy1 >= 0) and (ix2 < old_cols) and (iy2 < old_rows):
+            vals = [old_grid[ix1, iy1], old_grid[ix1, iy2], old_grid[ix2, iy1], old_grid[ix2, iy2]]
+            if not np.any([np.isnan(v) for v in vals]):
+                new_arr[x, y] = (vals[0] * (ix2 - fx) * (iy2 - fy) + vals[1] * (fx - ix1) * (iy2 - fy) + vals[2] * (ix2 - fx) * (fy - iy1) + vals[3] * (fx - ix1) * (fy - iy1)) / ((ix2 - ix1) * (iy2 - iy1) + 0.0)
+
+    return new_arr
+
+
+def bench_bilinear(args) -> None:
+    """
+    Compare the vectorized bilinear resample with the original cell by cell loop
+    """
+
+    dem = load_site_dem(args.points, args.csv_cell_size)
+    factor = dem.cell_width / args.cell_size
+    new_shape = (int(dem.rows * factor), int(dem.cols * factor))
+    print(f'Bilinear resample of {dem.rows} x {dem.cols} grid at {dem.cell_width}m to {new_shape[0]} x {new_shape[1]} at {args.cell_size}m')
+
+    loop_time = min(timeit.repeat(lambda: bilinear_resample_loop(dem.values, new_shape), number=1, repeat=1))
+    vector_time = min(timeit.repeat(lambda: bilinear_resample(dem.values, new_shape), number=1, repeat=args.repeat))
+
+    same = np.array_equal(bilinear_resample_loop(dem.values, new_shape), bilinear_resample(dem.values, new_shape), equal_nan=True)
+
+    print(f'  Loop:       {loop_time:.3f}s')
+    print(f'  Vectorized: {vector_time:.3f}s')
+    print(f'  Speedup:    {loop_time / vector_time:.0f}x')
+    print(f'  Identical:  {same}')
+
+
+def bench_resample(args) -> None:
+    """
+    Compare the regular grid resample engine with the griddata engine, both for speed
+    and for how closely the resampled values and masks agree
+    """
+
+    dem = load_site_dem(args.points, args.csv_cell_size)
+    print(f'Resample of {dem.rows} x {dem.cols} grid at {dem.cell_width}m to {args.cell_size}m')
+
+    for method in ['nearest', 'linear', 'cubic']:
+        griddata_time = min(timeit.repeat(lambda: dem.resample_dem(args.cell_size, method, Raster.ResampleEngine.GRIDDATA), number=1, repeat=args.repeat))
+        regular_time = min(timeit.repeat(lambda: dem.resample_dem(args.cell_size, method, Raster.ResampleEngine.REGULAR), number=1, repeat=args.repeat))
+
+        griddata_dem = dem.resample_dem(args.cell_size, method, Raster.ResampleEngine.GRIDDATA)
+        regular_dem = dem.resample_dem(args.cell_size, method, Raster.ResampleEngine.REGULAR)
+        griddata_mask = np.ma.getmaskarray(griddata_dem.array)
+        regular_mask = np.ma.getmaskarray(regular_dem.array)
+        both = ~griddata_mask & ~regular_mask
+        diff = np.abs(griddata_dem.array.data - regular_dem.array.data)[both]
+
+        print(f'  {method}')
+        print(f'    griddata: {griddata_time:.3f}s  regular: {regular_time:.3f}s  speedup: {griddata_time / regular_time:.0f}x')
+        print(f'    valid cells griddata: {(~griddata_mask).sum()}  regular: {(~regular_mask).sum()}  mask agreement: {(griddata_mask == regular_mask).mean():.2%}')
+        if diff.size > 0:
+            print(f'    difference median: {np.median(diff):.4f}m  99th percentile: {np.percentile(diff, 99):.4f}m  max: {diff.max():.4f}m')
+
+
+def bench_geotiff(args) -> None:
+    """
+    Write and read back a site DEM with each GeoTIFF writer profile and compare
+    the write time, read time and file size
+    """
+
+    dem = load_site_dem(args.points, args.csv_cell_size)
+    if args.cell_size != dem.cell_width:
+        dem = dem.resample_dem(args.cell_size, 'bilinear')
+    print(f'GeoTIFF write and read of {dem.rows} x {dem.cols} grid at {dem.cell_width}m')
+
+    values = dem.array.copy()
+    with tempfile.TemporaryDirectory() as temp_folder:
+        for name in args.profiles:
+            profile = geotiff_profile(name, args.options)
+            raster_path = os.path.join(temp_folder, f'{name}.tif')
+
+            def write():
+                # Raster.write fills the array in place so give it a fresh copy every time
+                dem.set_array(values, copy=True)
+                dem.write(raster_path, profile=profile)
+
+            write_time = min(timeit.repeat(write, number=1, repeat=args.repeat))
+            read_time = min(timeit.repeat(lambda: Raster(filepath=raster_path).array, number=1, repeat=args.repeat))
+            size = os.path.getsize(raster_path)
+            same = np.array_equal(np.ma.filled(Raster(filepath=raster_path).array.astype(float), np.nan), np.ma.filled(values.astype(float), np.nan), equal_nan=True)
+
+            print(f'  {name:8s} write: {write_time:.3f}s  read: {read_time:.3f}s  size: {size / 1024:.0f}KB  identical: {same}')
+            delete_raster(raster_path)
+
+
+def bench_parser(args) -> None:
+    """
+    Compare the corgrids points parser with np.loadtxt, for a single file and for
+    several files parsed in parallel. The points file is repeated to make a bigger file.
+    """
+
+    with open(args.points, 'rb') as f:
+        data = f.read()
+
+    with tempfile.TemporaryDirectory() as temp_folder:
+        files = []
+        for i in range(args.files):
+            files.append(os.path.join(temp_folder, f'points{i}.txt'))
+            with open(files[-1], 'wb') as f:
+                f.write(data * args.copies)
+
+        points = read_points(files[0])
+        print(f'Parse of {points.shape[0]} points ({os.path.getsize(files[0]) / 1024 / 1024:.1f}MB)')
+
+        loadtxt_time = min(timeit.repeat(lambda: np.loadtxt(files[0], delimiter=' ', ndmin=2), number=1, repeat=args.repeat))
+        parser_time = min(timeit.repeat(lambda: read_points(files[0]), number=1, repeat=args.repeat))
+        same = np.array_equal(np.loadtxt(files[0], delimiter=' ', ndmin=2), points)
+
+        print(f'  loadtxt:  {loadtxt_time:.3f}s')
+        print(f'  parser:   {parser_time:.3f}s  speedup: {loadtxt_time / parser_time:.1f}x  identical: {same}')
+
+        def parse_all(workers):
+            loader = PointCloudLoader(budget_mb=args.files * len(data) * args.copies / 1024 / 1024 * 2, workers=workers)
+            loader.preload(files)
+            for file in files:
+                loader.get(file)
+
+        serial_time = min(timeit.repeat(lambda: parse_all(1), number=1, repeat=args.repeat))
+        parallel_time = min(timeit.repeat(lambda: parse_all(args.workers), number=1, repeat=args.repeat))
+        print(f'  {args.files} files serial: {serial_time:.3f}s  {args.workers} workers: {parallel_time:.3f}s  speedup: {serial_time / parallel_time:.1f}x')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    bilinear_parser = subparsers.add_parser('bilinear', help='Vectorized bilinear resample against the original loop.')
+    bilinear_parser.add_argument('--points', help='Survey points TXT file.', type=str, default=DEFAULT_POINTS)
+    bilinear_parser.add_argument('--csv_cell_size', help='Cell size of the points file (m).', type=float, default=1.0)
+    bilinear_parser.add_argument('--cell_size', help='Resampled cell size (m).', type=float, default=0.25)
+    bilinear_parser.add_argument('--repeat', help='Number of times to repeat the vectorized timing.', type=int, default=5)
+    bilinear_parser.set_defaults(func=bench_bilinear)
+
+    resample_parser = subparsers.add_parser('resample', help='Regular grid resample engine against griddata.')
+    resample_parser.add_argument('--points', help='Survey points TXT file.', type=str, default=DEFAULT_POINTS)
+    resample_parser.add_argument('--csv_cell_size', help='Cell size of the points file (m).', type=float, default=1.0)
+    resample_parser.add_argument('--cell_size', help='Resampled cell size (m).', type=float, default=0.5)
+    resample_parser.add_argument('--repeat', help='Number of times to repeat each timing.', type=int, default=3)
+    resample_parser.set_defaults(func=bench_resample)
+
+    geotiff_parser = subparsers.add_parser('geotiff', help='Write time, read time and file size of the GeoTIFF writer profiles.')
+    geotiff_parser.add_argument('--points', help='Survey points TXT file.', type=str, default=DEFAULT_POINTS)
+    geotiff_parser.add_argument('--csv_cell_size', help='Cell size of the points file (m).', type=float, default=1.0)
+    geotiff_parser.add_argument('--cell_size', help='Cell size of the written raster (m).', type=float, default=0.25)
+    geotiff_parser.add_argument('--profiles', help='GeoTIFF profiles to compare.', nargs='+', choices=list(GEOTIFF_PROFILES), default=list(GEOTIFF_PROFILES))
+    geotiff_parser.add_argument('--options', help='Creation options applied on top of every profile, e.g. "ZLEVEL=9".', type=str, default=None)
+    geotiff_parser.add_argument('--repeat', help='Number of times to repeat each timing.', type=int, default=3)
+    geotiff_parser.set_defaults(func=bench_geotiff)
+
+    parser_parser = subparsers.add_parser('parser', help='Corgrids points parser against np.loadtxt.')
+    parser_parser.add_argument('--points', help='Survey points TXT file.', type=str, default=DEFAULT_POINTS)
+    parser_parser.add_argument('--copies', help='Number of times the points are repeated in the parsed file.', type=int, default=20)
+    parser_parser.add_argument('--files', help='Number of files parsed in the parallel timing.', type=int, default=4)
+    parser_parser.add_argument('--workers', help='Number of worker threads in the parallel timing.', type=int, default=4)
+    parser_parser.add_argument('--repeat', help='Number of times to repeat each timing.', type=int, default=3)
+    parser_parser.set_defaults(func=bench_parser)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -3,8 +3,8 @@ Run the binned analysis
 """
 import csv
 from typing import Dict, List
-from raster_analysis import get_vol_and_area
-from raster import Raster
+from raster_analysis import get_vol_and_area_bins, get_vol_and_area_bins_from_values, get_valid_values_by_window
+from raster_cache import get_raster
 from logger import Logger
 from sandbar_site import SandbarSite
 from analysis_bin import AnalysisBin
@@ -38,34 +38,40 @@ def run_binned_analysis(
             # Only proceed with this survey if it is flagged to be apart of the analysis.
             if survey.is_analysis is True:
 
+                # Get the lower and upper elevations for each discharge bin. Either could be None
+                elev_pairs = [(survey.get_stage(anal_bin.lower_discharge), survey.get_stage(anal_bin.upper_discharge)) for anal_bin in analysis_bins.values()]
+
+                # Get the volume and area between the maximum surface and minimum surface
+                # This is only needed for the 8-25k and above 25k bins and is the same for every section
+                maxmin_area_vol = get_vol_and_area_bins(site.max_surface.values, site.min_surface.values, elev_pairs, cell_size)
+
                 for section in survey.surveyed_sections.values():
 
                     # Only process sections that have computation extent polygons
                     if section.ignore:
                         continue
 
-                    survey_raster = Raster(filepath=section.raster_path)
-
-                    for anal_bin in analysis_bins.values():
+                    # Share the decoded section raster with the incremental analysis through the cache.
+                    # Rasters too large for the cache are streamed window by window rather than read into one array
+                    survey_raster = get_raster(section.raster_path)
+                    survey_values, min_values = get_valid_values_by_window(survey_raster, site.min_surface.values)
 
-                        # Get the lower and upper elevations for the discharge. Either could be None
-                        lower_elev = survey.get_stage(anal_bin.lower_discharge)
-                        upper_elev = survey.get_stage(anal_bin.upper_discharge)
+                    # Get volume and area between the surveyed surface and minimum surface for every bin at once
+                    area_vol = get_vol_and_area_bins_from_values(survey_values, min_values, elev_pairs, cell_size)
 
-                        # Get volume and area between the surveyed surface and minimum surface
-                        area_vol = get_vol_and_area(survey_raster.array, site.min_surface.array, lower_elev, upper_elev, cell_size)
+                    for idx, anal_bin in enumerate(analysis_bins.values()):
 
-                        # Get the volume and area between the maximum surface and minimum surface
-                        # This is only needed for the 8-25k and above 25k bins
-                        maxmin_area_vol = (None, None, None, None, None, None)
-                        if lower_elev is not None:
-                            maxmin_area_vol = get_vol_and_area(site.max_surface.array, site.min_surface.array, lower_elev, upper_elev, cell_size)
+                        maxmin_area = None
+                        maxmin_vol = None
+                        if elev_pairs[idx][0] is not None:
+                            maxmin_area = maxmin_area_vol[0][idx]
+                            maxmin_vol = maxmin_area_vol[1][idx]
 
                         model_results.append((site_id, site.site_code5, survey_id, survey.survey_date.strftime('%Y-%m-%d'),
                                              section.section_type_id, section.section_type, section.section_id,
                                              anal_bin.bin_id, anal_bin.title,
-                                             area_vol[0], area_vol[1], area_vol[2], area_vol[3], area_vol[4], area_vol[5],
-                                             maxmin_area_vol[0], maxmin_area_vol[1]))
+                                             area_vol[0][idx], area_vol[1][idx], area_vol[2][idx], area_vol[3][idx], area_vol[4][idx], area_vol[5][idx],
+                                             maxmin_area, maxmin_vol))
 
     # Write the binned results to CSV
     log.info(f'Binned analysis complete. Writing {len(model_results)} results to {result_file_path}')
@@ -0,0 +1,123 @@
+"""
+Dependency tracked reuse of rasters between runs
+
+Each raster that raster preparation builds is recorded in a manifest next
+to it with a key made from everything that went into it: a hash of the
+content of its input files and the settings used to build it. On a later
+run the raster is only reused if it still exists and the key built from
+the current inputs matches the one recorded, so changing a survey file,
+a cell size or a computation extent polygon rebuilds just the rasters
+that depend on it.
+
+The content hash of each input file is remembered along with its size and
+modification time so that unchanged files aren't read again to hash them.
+"""
+import os
+import json
+import hashlib
+import tempfile
+from logger import Logger
+
+MANIFEST_FILE = 'build_manifest.json'
+
+# Input files are hashed this many bytes at a time
+HASH_CHUNK_BYTES = 8 * 1024 * 1024
+
+
+def build_key(*inputs) -> str:
+    """
+    A key that changes whenever any of the inputs do
+    :param inputs: Hashes, settings, extents etc. Anything that JSON can represent
+    """
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class BuildManifest:
+    """
+    The build keys of the rasters in one folder
+    """
+
+    def __init__(self, folder: str):
+        self.log = Logger('Build Manifest')
+        self.folder = folder
+        self.path = os.path.join(folder, MANIFEST_FILE)
+
+        # Absolute path: [size, modification time, content hash]
+        self.inputs = {}
+        # Path relative to the folder: build key
+        self.artifacts = {}
+        # Name: anything else a build step needs to remember between runs
+        self.states = {}
+
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    manifest = json.load(f)
+                self.inputs = manifest['inputs']
+                self.artifacts = manifest['artifacts']
+                self.states = manifest.get('states', {})
+            except (OSError, ValueError, KeyError) as ex:
+                self.log.warning(f'Ignoring unreadable build manifest {self.path}. Every raster will be rebuilt: {ex}')
+
+    def file_digest(self, file: str) -> str:
+        """
+        Hash of the content of a file. It's only read again if its size or modification time has changed.
+        """
+        key = os.path.abspath(file)
+        stat = os.stat(key)
+        known = self.inputs.get(key)
+        if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+
+        digest = hashlib.sha1()
+        with open(key, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+                digest.update(chunk)
+
+        self.inputs[key] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def is_current(self, artifact: str, key: str) -> bool:
+        """
+        Whether a raster exists and was built from the same inputs as this key
+        """
+        return os.path.isfile(artifact) and self.artifacts.get(os.path.relpath(artifact, self.folder)) == key
+
+    def recorded_key(self, artifact: str) -> str:
+        """
+        The key a raster was last built with, or None if it isn't in the manifest
+        """
+        return self.artifacts.get(os.path.relpath(artifact, self.folder))
+
+    def record(self, artifact: str, key: str) -> None:
+        """
+        Remember the key that a raster was just built with
+        """
+        self.artifacts[os.path.relpath(artifact, self.folder)] = key
+
+    def state(self, name: str):
+        """
+        What a build step remembered with set_state on an earlier run, or None
+        """
+        return self.states.get(name)
+
+    def set_state(self, name: str, value) -> None:
+        """
+        Remember something about a build for the next run. It must be JSON serialisable.
+        """
+        self.states[name] = value
+
+    def save(self) -> None:
+        """
+        Write the manifest. It's written under a temporary name and then renamed so that
+        an interrupted run never leaves half a manifest behind.
+        """
+        os.makedirs(self.folder, exist_ok=True)
+        handle, temp_path = tempfile.mkstemp(dir=self.folder, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w') as f:
+                json.dump({'inputs': self.inputs, 'artifacts': self.artifacts, 'states': self.states}, f, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
@@ -9,13 +9,12 @@ import math
 from datetime import datetime
 from osgeo import ogr
 from raster import Raster
-from raster_analysis import get_bin_area
+from raster_analysis import get_bin_areas
 from logger import Logger
 from sandbar_site import SandbarSite
 from analysis_bin import AnalysisBin
 from clip_raster import clip_raster
 from points_to_raster import points_to_raster
-import numpy as np
 
 file_name_pattern = re.compile(r'^(?P<site_name>[^_]+)_(?P<survey_date>\d{8})_.*')
 
@@ -91,14 +90,14 @@ def run_campsite_analysis(
 
             # Loop over the analysis bins and determine the campsite area between the elevations
             campsite_raster = Raster(filepath=clipped_path)
-            for bin_id, anal_bin in analysis_bins.items():
-                # Get the lower and upper elevations for the discharge. Either could be None
-                lower_elev = survey.get_stage(anal_bin.lower_discharge)
-                upper_elev = survey.get_stage(anal_bin.upper_discharge)
-
-                masked_array = np.ma.array(campsite_raster.array)
-                area = get_bin_area(masked_array, lower_elev, upper_elev, cell_size)
-                model_results.append((site_id, survey_id, os.path.basename(campsite_shapefile), bin_id, anal_bin.lower_discharge, anal_bin.upper_discharge, area))
+
+            # Get the lower and upper elevations for each discharge bin. Either could be None
+            elev_pairs = [(survey.get_stage(anal_bin.lower_discharge), survey.get_stage(anal_bin.upper_discharge)) for anal_bin in analysis_bins.values()]
+
+            areas = get_bin_areas(campsite_raster.values, elev_pairs, cell_size)
+
+            for idx, (bin_id, anal_bin) in enumerate(analysis_bins.items()):
+                model_results.append((site_id, survey_id, os.path.basename(campsite_shapefile), bin_id, anal_bin.lower_discharge, anal_bin.upper_discharge, areas[idx]))
 
     # Write the results to the output file
     with open(result_file_path, 'w', newline='', encoding='utf8') as result_file:
@@ -1,37 +1,240 @@
 """
 Clip a raster using filtered features from a ShapeFile
 This is used for clipping the DEM rasters to the computation extent polygons
+
+Clipping is done in process with gdal.Warp. The features used as the cutline
+are copied out of the ShapeFile into /vsimem/ once and the warp options are
+built once for each cutline and writer profile, so that clipping every survey
+of a site doesn't reopen and filter the ShapeFile each time. The gdalwarp
+executable is still used if asked for, or if the in process warp fails.
+
+Every survey DEM of a site is on the same union grid, so the mask engine
+rasterizes the polygons of each section onto that grid once and clips every
+survey by setting the cells outside the mask to nodata. Like the cutline,
+a cell is inside the polygons if its centre is, and polygons in a different
+coordinate system to the DEM are reprojected onto its grid.
 """
 import os
+import uuid
+from functools import lru_cache
+from typing import List, Tuple
 from subprocess import call, PIPE
-from raster import delete_raster
+import numpy as np
+from osgeo import gdal, ogr
+from raster import Raster, delete_raster, write_statistics
 from logger import Logger
 
+# Default number of threads gdal.Warp uses to warp each raster
+DEFAULT_WARP_THREADS = 'ALL_CPUS'
+
+# (ShapeFile, modification time, where clause): /vsimem/ path of the cutline features
+_cutlines = {}
+
+# (ShapeFile, modification time, where clause, grid): boolean array that is True inside the features
+_masks = {}
 
-def clip_raster(gdal_warp_path: str, in_raster: str, out_raster: str, shape_file: str, where_clause: str) -> None:
+
+class ClipEngine:
+    # gdal.Warp in this process
+    API = 'api'
+    # The gdalwarp executable, run once for each raster
+    EXECUTABLE = 'gdalwarp'
+    # The features rasterized once onto the DEM grid and applied as a mask (see mask_raster)
+    MASK = 'mask'
+
+
+def clip_raster(gdal_warp_path: str, in_raster: str, out_raster: str, shape_file: str, where_clause: str,
+                geotiff_profile: Tuple[str, List[str]] = None, engine: str = ClipEngine.API, warp_threads=DEFAULT_WARP_THREADS) -> None:
     """
     :param gdal_warp_path: The path to the GDAL Warp executable
     :param in_raster: The path to the input raster
     :param out_raster: The path to the output raster
     :param shape_file: The path to the shapefile to use for clipping
     :param where_clause: Feature filter for selecting which features to use for clipping
+    :param geotiff_profile: (driver, creation options) for the output raster. Defaults to GDAL's own defaults
+    :param engine: ClipEngine to clip with. The API engine falls back to the executable if it fails
+    :param warp_threads: Number of threads the API engine warps with, or 'ALL_CPUS'
     """
 
     log = Logger('Clip Raster')
 
-    assert os.path.isfile(gdal_warp_path), f'Missing GDAL Warp executable at {gdal_warp_path}'
     assert os.path.isfile(in_raster), f'Missing clipping operation input at {in_raster}'
     assert os.path.isfile(shape_file), f'Missing clipping operation input ShapeFile at {shape_file}'
 
     # Make sure the rasters get removed before they get re-made
     delete_raster(out_raster)
 
+    # The clipped raster keeps the nodata value of the DEM whichever engine clips it
+    nodata = Raster(filepath=in_raster, read_array=False).nodata
+
+    if engine == ClipEngine.API:
+        try:
+            _warp_in_process(in_raster, out_raster, shape_file, where_clause, geotiff_profile, warp_threads, nodata)
+        except RuntimeError as ex:
+            if gdal_warp_path is None or not os.path.isfile(gdal_warp_path):
+                raise
+            log.warning(f'In process clipping of {in_raster} failed. Falling back to GDAL Warp: {ex}')
+            delete_raster(out_raster)
+            _warp_executable(gdal_warp_path, in_raster, out_raster, shape_file, where_clause, geotiff_profile, nodata)
+    elif engine == ClipEngine.EXECUTABLE:
+        _warp_executable(gdal_warp_path, in_raster, out_raster, shape_file, where_clause, geotiff_profile, nodata)
+    else:
+        raise ValueError(f'Unknown clip engine {engine}')
+
+    # Store the statistics with the clipped raster so the analyses don't have to rescan it
+    write_statistics(out_raster)
+
+
+def _warp_in_process(in_raster: str, out_raster: str, shape_file: str, where_clause: str, geotiff_profile: Tuple[str, List[str]], warp_threads,
+                     nodata: float) -> None:
+    """
+    Clip with gdal.Warp. COG can only be written as a copy of another raster, so
+    for that driver the clipped raster is warped into /vsimem/ first.
+    """
+    cutline = _cutline(os.path.abspath(shape_file), os.stat(shape_file).st_mtime_ns, where_clause)
+    profile = (geotiff_profile[0], tuple(geotiff_profile[1])) if geotiff_profile is not None else None
+
+    if profile is not None and profile[0] == 'COG':
+        temp_raster = f'/vsimem/clip_{uuid.uuid4().hex}.tif'
+        try:
+            _run_warp(temp_raster, in_raster, _warp_options(cutline, None, warp_threads, nodata))
+            result = gdal.Translate(out_raster, temp_raster, options=gdal.TranslateOptions(format='COG', creationOptions=list(profile[1])))
+            if result is None:
+                raise RuntimeError(f'Failed to write {out_raster}')
+            result = None
+        finally:
+            gdal.Unlink(temp_raster)
+    else:
+        _run_warp(out_raster, in_raster, _warp_options(cutline, profile, warp_threads, nodata))
+
+
+def _run_warp(out_raster: str, in_raster: str, options) -> None:
+    result = gdal.Warp(out_raster, in_raster, options=options)
+    if result is None:
+        raise RuntimeError(f'gdal.Warp failed to clip {in_raster}')
+    # Closing the dataset flushes it to disk
+    result = None
+
+
+def _cutline(shape_file: str, mtime_ns: int, where_clause: str) -> str:
+    """
+    Copy the features that pass the where clause into a /vsimem/ GeoJSON file. The
+    modification time is part of the cache key so a rewritten ShapeFile is copied again.
+    :return: Path of the in memory cutline
+    """
+    key = (shape_file, mtime_ns, where_clause)
+    if key in _cutlines:
+        return _cutlines[key]
+
+    cutline = f'/vsimem/cutline_{uuid.uuid4().hex}.geojson'
+    result = gdal.VectorTranslate(cutline, shape_file, options=gdal.VectorTranslateOptions(format='GeoJSON', where=where_clause or None))
+    if result is None:
+        raise RuntimeError(f'Failed to read the clipping features from {shape_file}')
+    result = None
+    _cutlines[key] = cutline
+    return cutline
+
+
+@lru_cache(maxsize=None)
+def _warp_options(cutline: str, profile: Tuple[str, Tuple[str]], warp_threads, nodata: float):
+    """
+    Warp options for a cutline, writer profile, thread count and nodata value, built once and reused for every raster
+    :param profile: (driver, creation options) as tuples so that they can be cached. None for GDAL's defaults
+    :param nodata: Nodata value of the clipped raster. None to leave it to GDAL
+    """
+    driver_name, options = profile if profile is not None else ('GTiff', ())
+
+    # Float32 to match the DEMs, the same as -ot Float32 and -dstnodata for the executable
+    return gdal.WarpOptions(format=driver_name, creationOptions=list(options), outputType=gdal.GDT_Float32, dstNodata=nodata,
+                            cutlineDSName=cutline, multithread=True, warpOptions=[f'NUM_THREADS={warp_threads}'])
+
+
+def mask_raster(dem: Raster, out_raster: str, shape_file: str, where_clause: str, geotiff_profile: Tuple[str, List[str]] = None) -> None:
+    """
+    Clip a DEM that is already open by masking it with the rasterized features
+    :param dem: The DEM to clip. It's left unchanged
+    :param out_raster: The path to the output raster
+    :param shape_file: The path to the shapefile to use for clipping
+    :param where_clause: Feature filter for selecting which features to use for clipping
+    :param geotiff_profile: (driver, creation options) for the output raster. Defaults to the legacy profile
+    """
+    assert os.path.isfile(shape_file), f'Missing clipping operation input ShapeFile at {shape_file}'
+
+    mask = feature_mask(shape_file, where_clause, dem)
+    clipped = Raster(proj=dem.proj, rows=dem.rows, cols=dem.cols, left=dem.left, top=dem.top, cellWidth=dem.cell_width, cellHeight=dem.cell_height,
+                     nodata=dem.nodata)
+    clipped.set_array(np.where(mask, dem.values, np.nan))
+
+    # Raster.write stores the statistics with the raster
+    clipped.write(out_raster, profile=geotiff_profile)
+
+
+def feature_mask(shape_file: str, where_clause: str, grid: Raster) -> np.array:
+    """
+    The cells of a grid whose centres are inside the features that pass the where clause.
+    Each mask is rasterized once and reused for every raster on the same grid.
+    :param grid: Raster whose projection, geotransform and size define the grid
+    :return: (rows x cols) boolean array
+    """
+    key = (os.path.abspath(shape_file), os.stat(shape_file).st_mtime_ns, where_clause,
+           (grid.proj, grid.left, grid.top, grid.cell_width, grid.cell_height, grid.rows, grid.cols))
+    if key in _masks:
+        return _masks[key]
+
+    data_source = ogr.Open(shape_file, 0)
+    assert data_source is not None, f'Could not open the clipping ShapeFile {shape_file}'
+    layer = data_source.GetLayer()
+    if len(where_clause) > 0:
+        layer.SetAttributeFilter(where_clause)
+
+    mask_ds = gdal.GetDriverByName('MEM').Create('', grid.cols, grid.rows, 1, gdal.GDT_Byte)
+    mask_ds.SetGeoTransform([grid.left, grid.cell_width, 0, grid.top, 0, grid.cell_height])
+    # With the projection set RasterizeLayer reprojects features in any other coordinate
+    # system onto the grid. Features without one are assumed to be in the DEM's
+    mask_ds.SetProjection(grid.proj)
+    gdal.RasterizeLayer(mask_ds, [1], layer, burn_values=[1])
+
+    _masks[key] = mask_ds.GetRasterBand(1).ReadAsArray() > 0
+    mask_ds = None
+    data_source = None
+    return _masks[key]
+
+
+def clear_clip_cache() -> None:
+    """
+    Delete the in memory cutlines and masks and forget the warp options built for them
+    """
+    for cutline in _cutlines.values():
+        gdal.Unlink(cutline)
+    _cutlines.clear()
+    _masks.clear()
+    _warp_options.cache_clear()
+
+
+def _warp_executable(gdal_warp_path: str, in_raster: str, out_raster: str, shape_file: str, where_clause: str,
+                     geotiff_profile: Tuple[str, List[str]], nodata: float) -> None:
+    """
+    Clip by running the gdalwarp executable
+    :param nodata: Nodata value of the clipped raster. None to leave it to gdalwarp
+    """
+
+    log = Logger('Clip Raster')
+
+    assert os.path.isfile(gdal_warp_path), f'Missing GDAL Warp executable at {gdal_warp_path}'
+
     # Reset the where parameter to an empty string if no where clause is provided
-    # TODO: This is giving us 64-bit rasters for some reason and a weird nodata value with nan as well. We're probably losing precision somewhere
     where_param = f"-cwhere \"{where_clause}\"" if len(where_clause) > 0 else ''
 
-    # -dstnodata 0
-    gdal_args = f' -cutline {shape_file} {where_param} {in_raster} {out_raster}'
+    # Output format and creation options from the GeoTIFF writer profile
+    profile_param = ''
+    if geotiff_profile is not None:
+        driver_name, options = geotiff_profile
+        profile_param = f'-of {driver_name} ' + ' '.join(f'-co {option}' for option in options)
+
+    # Float32 with the DEM's nodata value. Left to itself gdalwarp could write 64-bit rasters with NaN as well as nodata
+    nodata_param = f'-dstnodata {nodata}' if nodata is not None else ''
+
+    gdal_args = f' -ot Float32 {nodata_param} -cutline {shape_file} {where_param} {profile_param} {in_raster} {out_raster}'
     log.debug('RUNNING GdalWarp: ' + gdal_warp_path + gdal_args)
 
     if ' ' in gdal_warp_path:
@@ -3,6 +3,7 @@ Computational extents represents a ShapeFile containing polygons that define the
 extents for each site. The ShapeFile must contain a field named 'Site' that contains the site code
 """
 import os
+import hashlib
 from osgeo import osr, ogr
 from logger import Logger
 
@@ -19,6 +20,8 @@ class ComputationExtents:
     def __init__(self, full_path: str, epsg):
         self.full_path = full_path
         self.log = Logger('Comp. Extents')
+        # (site code, section type): hash of the polygons
+        self.digests = {}
 
         assert os.path.isfile(self.full_path), f'The computation extents ShapeFile does not exist at {self.full_path}'
 
@@ -86,3 +89,49 @@ class ComputationExtents:
 
         section_where = section_where.replace(' ', '')
         return f"(\"{SITE_CODE_FIELD}\" ='{site_code}')  AND (\"{SECTION_FIELD}\"='{section_where}')"
+
+    def get_section_digest(self, site_code: str, section_type: str) -> str:
+        """
+        Hash of the polygons that a site's section is clipped to. It changes if the polygons are edited.
+        """
+        key = (site_code, section_type)
+        if key not in self.digests:
+            driver = ogr.GetDriverByName('ESRI Shapefile')
+            data_source = driver.Open(self.full_path, 0)
+            layer = data_source.GetLayer()
+            layer.SetAttributeFilter(self.get_filter_clause(site_code, section_type))
+
+            geometries = sorted(bytes(feature.GetGeometryRef().ExportToWkb()) for feature in layer if feature.GetGeometryRef() is not None)
+            self.digests[key] = hashlib.sha1(b''.join(geometries)).hexdigest()
+
+        return self.digests[key]
+
+    def get_site_extent(self, site_code: str, margin: float = 0.0) -> tuple:
+        """
+        The (x_min, x_max, y_min, y_max) envelope of all the polygons for a site, grown by a margin
+        :param site_code: Five character site code
+        :param margin: Distance to grow the envelope by on every side (m)
+        :return: The extent, or None if the site has no polygons
+        """
+
+        driver = ogr.GetDriverByName('ESRI Shapefile')
+        data_source = driver.Open(self.full_path, 0)
+        layer = data_source.GetLayer()
+        layer.SetAttributeFilter(f"{SITE_CODE_FIELD} = '{site_code}'")
+
+        extent = None
+        for feature in layer:
+            geom = feature.GetGeometryRef()
+            if geom is None:
+                continue
+
+            envelope = geom.GetEnvelope()
+            if extent is None:
+                extent = envelope
+            else:
+                extent = (min(extent[0], envelope[0]), max(extent[1], envelope[1]), min(extent[2], envelope[2]), max(extent[3], envelope[3]))
+
+        if extent is None:
+            return None
+
+        return (extent[0] - margin, extent[1] + margin, extent[2] - margin, extent[3] + margin)
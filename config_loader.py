@@ -38,13 +38,26 @@ def load_config(xml_file: str) -> dict:
         elif the_tag.tag == 'CSVCellSize' \
                 or the_tag.tag == 'RasterCellSize' \
                 or the_tag.tag == 'ElevationIncrement' \
-                or the_tag.tag == 'ElevationBenchmark':
+                or the_tag.tag == 'ElevationBenchmark' \
+                or the_tag.tag == 'BlockValidFraction' \
+                or the_tag.tag == 'RasterCacheMB' \
+                or the_tag.tag == 'PointsCacheMB' \
+                or the_tag.tag == 'PlausibleMargin':
 
             config[the_tag.tag] = float(the_tag.text)
 
+        elif the_tag.tag == 'ParseWorkers' \
+                or the_tag.tag == 'SiteWorkers' \
+                or the_tag.tag == 'SurveyWorkers' \
+                or the_tag.tag == 'WarpThreads':
+            config[the_tag.tag] = int(the_tag.text)
+
         elif the_tag.tag == 'ReUseRasters':
             config['ReUseRasters'] = the_tag.text.upper() == 'TRUE'
 
+        elif the_tag.tag == 'SurveyStack':
+            config['SurveyStack'] = the_tag.text.upper() == 'TRUE'
+
         else:
             config[the_tag.tag] = the_tag.text
 
@@ -1,12 +1,539 @@
 """
 Parse a delimited text file of volcano data and create a shapefile
 """
+import os
+import json
+import hashlib
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 import numpy as np
 from logger import Logger
 
+# Default memory budget for parsed survey points held by a PointCloudLoader (MB)
+DEFAULT_POINTS_BUDGET_MB = 512.0
 
-def union_csv_extents(csv_files: List[str], delimiter: str = ' ', cell_size: float = 1.0, padding: float = 10.0) -> tuple:
+# Survey points files are read and parsed this many bytes at a time
+CHUNK_BYTES = 64 * 1024 * 1024
+
+# Smaller blocks used when only the extent of a file is needed
+EXTENT_CHUNK_BYTES = 8 * 1024 * 1024
+
+# Fields with more digits than this can't be converted exactly through float64
+MAX_FIXED_DIGITS = 15
+
+# Number of problem rows reported for an invalid points file
+MAX_PROBLEMS = 10
+
+NEWLINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+DECIMAL_POINT = ord('.')
+ZERO = ord('0')
+
+
+def parse_fixed_width(data: bytes, delimiter: str = ' ') -> np.array:
+    """
+    Vectorized parse of a block of points lines that all have the same width and the same
+    layout, which is how the corgrids files are written. Each line becomes a row of a byte
+    matrix, the digits of each field are combined into an integer with one matrix product
+    and then scaled by the position of the decimal point. The result is identical to
+    parsing each value as text. Returns None if the block doesn't have this layout
+    (e.g. negative values, exponents or lines of differing widths) so that the caller can
+    fall back to the general parser.
+    :param data: Complete lines ending in a newline
+    :param delimiter: Single character field delimiter
+    """
+    if len(delimiter) != 1:
+        return None
+
+    raw = np.frombuffer(data, dtype=np.uint8)
+    newlines = np.flatnonzero(raw == NEWLINE)
+    if newlines.size == 0:
+        return None
+
+    width = newlines[0] + 1
+    rows = newlines.size
+    if raw.size != rows * width or np.any(newlines != np.arange(width - 1, raw.size, width)):
+        return None
+
+    lines = raw.reshape(rows, width)
+    first = lines[0]
+    separators = (first == ord(delimiter)) | (first == CARRIAGE_RETURN) | (first == NEWLINE)
+    if not np.array_equal((lines == ord(delimiter)) | (lines == CARRIAGE_RETURN) | (lines == NEWLINE), np.broadcast_to(separators, lines.shape)):
+        return None
+
+    # Start and end column of each field. Fields must be separated by exactly one delimiter,
+    # the same as the general parser requires.
+    edges = np.flatnonzero(np.diff(np.concatenate(([1], separators.astype(np.int8), [1]))))
+    starts, ends = edges[::2], edges[1::2]
+    if starts.size == 0 or starts[0] != 0 or np.any(starts[1:] - ends[:-1] != 1):
+        return None
+
+    columns = []
+    for start, end in zip(starts, ends):
+        field = lines[:, start:end]
+        points = np.flatnonzero(first[start:end] == DECIMAL_POINT)
+        if points.size > 1 or (points.size == 1 and not np.all(field[:, points[0]] == DECIMAL_POINT)):
+            return None
+
+        digits = np.delete(field, points, axis=1)
+        if digits.shape[1] == 0 or digits.shape[1] > MAX_FIXED_DIGITS or np.any(digits - ZERO > 9):
+            return None
+
+        # Integer mantissa. Every intermediate is an integer below 2^53 so float64 is exact
+        # and the single division below rounds the same way as parsing the text.
+        mantissa = (digits - ZERO).astype(np.float64) @ (10.0 ** np.arange(digits.shape[1] - 1, -1, -1))
+        decimals = end - start - points[0] - 1 if points.size else 0
+        columns.append(mantissa / 10.0 ** decimals)
+
+    return np.column_stack(columns)
+
+
+class PointsFormatError(ValueError):
+    """
+    A survey points file that can't be parsed, with the line by line problems found in it
+    """
+
+    def __init__(self, problems: List[str]):
+        super().__init__('; '.join(problems))
+        self.problems = problems
+
+
+def find_line_problems(data: bytes, delimiter: str = ' ', first_line: int = 1, max_problems: int = MAX_PROBLEMS) -> List[str]:
+    """
+    Find the lines in a block of points text that don't parse. This goes line by line
+    so it is only used to report on a block that has already failed to parse.
+    :param first_line: Line number in the file of the first line of the block
+    """
+    problems = []
+    columns = None
+    for number, line in enumerate(data.decode(errors='replace').split('\n'), first_line):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+
+        values = line.split(delimiter)
+        if columns is None:
+            columns = len(values)
+
+        if len(values) != columns:
+            problems.append(f'Line {number}: expected {columns} values but found {len(values)}')
+        else:
+            for value in values:
+                try:
+                    float(value)
+                except ValueError:
+                    problems.append(f"Line {number}: '{value}' is not a number")
+                    break
+
+        if len(problems) >= max_problems:
+            break
+
+    return problems
+
+
+def parse_points_block(data: bytes, delimiter: str = ' ', first_line: int = 1) -> np.array:
+    """
+    Parse a block of complete points lines into an (n, columns) array, using the vectorized
+    fixed width parser where the block allows it
+    :param first_line: Line number in the file of the first line of the block. Used to report problems
+    """
+    points = parse_fixed_width(data, delimiter)
+    if points is None:
+        try:
+            points = np.loadtxt(data.decode().splitlines(), delimiter=delimiter, ndmin=2)
+        except ValueError as ex:
+            raise PointsFormatError(find_line_problems(data, delimiter, first_line) or [str(ex)]) from ex
+    return points
+
+
+def validate_points(points: np.array, plausible_extent: tuple = None, columns: int = 4, max_problems: int = MAX_PROBLEMS) -> List[str]:
+    """
+    Check every parsed point in one vectorized pass. Returns the problems found, if any.
+    :param points: Parsed (n, columns) points array
+    :param plausible_extent: (x_min, x_max, y_min, y_max) that every point must fall inside. None to skip this check
+    :param columns: Expected number of values on each line
+    """
+    if points.shape[0] == 0:
+        return ['No points found']
+
+    if points.ndim != 2 or points.shape[1] != columns:
+        return [f'Expected {columns} values per line but found {points.shape[1]}']
+
+    problems = []
+    for row in np.flatnonzero(~np.isfinite(points).all(axis=1))[:max_problems]:
+        problems.append(f'Point {row + 1}: non-finite value {points[row].tolist()}')
+
+    if plausible_extent is not None:
+        outside = (points[:, 1] < plausible_extent[0]) | (points[:, 1] > plausible_extent[1]) | (points[:, 2] < plausible_extent[2]) | (points[:, 2] > plausible_extent[3])
+        for row in np.flatnonzero(outside)[:max_problems - len(problems)]:
+            problems.append(f'Point {row + 1}: ({points[row, 1]}, {points[row, 2]}) is outside the plausible extent {tuple(plausible_extent)}')
+
+    return problems
+
+
+def iter_text_blocks(file: str, chunk_bytes: int = CHUNK_BYTES):
+    """
+    Read a text file in blocks of whole lines and yield each block with the line number it starts on
+    :param chunk_bytes: Size of the blocks the file is read in. Only one block of text is held in memory at a time
+    """
+    remainder = b''
+    line = 1
+    with open(file, 'rb') as f:
+        while True:
+            data = f.read(chunk_bytes)
+            if not data:
+                break
+
+            # Only parse complete lines. Carry the partial line on to the next block
+            data = remainder + data
+            end = data.rfind(b'\n') + 1
+            remainder = data[end:]
+            if end > 0:
+                yield data[:end], line
+                line += data.count(b'\n', 0, end)
+
+    if remainder.strip():
+        yield remainder + b'\n', line
+
+
+def read_points(file: str, delimiter: str = ' ', chunk_bytes: int = CHUNK_BYTES) -> np.array:
+    """
+    Parse a survey points file into an (n, 4) array of point id, x, y and z.
+    The file is read in large blocks of whole lines and each block is converted in one go.
+    :param file: Path to the points text file
+    :param delimiter:
+    :param chunk_bytes: Size of the blocks the file is read in. Only one block of text is held in memory at a time
+    """
+    blocks = []
+    problems = []
+    for data, first_line in iter_text_blocks(file, chunk_bytes):
+        # Keep going after a bad block so that the problems in the whole file get reported
+        try:
+            if len(problems) == 0:
+                blocks.append(parse_points_block(data, delimiter, first_line))
+            elif parse_fixed_width(data, delimiter) is None:
+                problems.extend(find_line_problems(data, delimiter, first_line, MAX_PROBLEMS - len(problems)))
+        except PointsFormatError as ex:
+            problems.extend(ex.problems)
+
+        if len(problems) >= MAX_PROBLEMS:
+            break
+
+    if len(problems) > 0:
+        raise PointsFormatError(problems)
+
+    if len(blocks) == 0:
+        # Empty file. Let loadtxt produce the same empty result (and warning) it always has
+        return np.loadtxt(file, delimiter=delimiter, ndmin=2)
+
+    if any(block.shape[1] != blocks[0].shape[1] for block in blocks):
+        raise PointsFormatError([f'Inconsistent number of values per line in {file}'])
+
+    return blocks[0] if len(blocks) == 1 else np.concatenate(blocks)
+
+
+def points_extent(points: np.array) -> tuple:
+    """
+    The (x_min, x_max, y_min, y_max) extent of the point cell centres
+    """
+    return (np.amin(points[:, 1]), np.amax(points[:, 1]), np.amin(points[:, 2]), np.amax(points[:, 2]))
+
+
+def read_points_extent(file: str, delimiter: str = ' ', chunk_bytes: int = EXTENT_CHUNK_BYTES) -> tuple:
+    """
+    The (x_min, x_max, y_min, y_max) extent of a survey points file, keeping a running
+    minimum and maximum over the blocks of the file. Only one block is ever in memory.
+    """
+    extent = None
+    for data, first_line in iter_text_blocks(file, chunk_bytes):
+        block = parse_points_block(data, delimiter, first_line)
+        if block.shape[0] == 0 or block.shape[1] < 3:
+            continue
+
+        block_extent = points_extent(block)
+        if extent is None:
+            extent = block_extent
+        else:
+            extent = (min(extent[0], block_extent[0]), max(extent[1], block_extent[1]),
+                      min(extent[2], block_extent[2]), max(extent[3], block_extent[3]))
+
+    if extent is None:
+        raise ValueError(f'No points found in {file}')
+    return extent
+
+
+def points_cache_paths(file: str, cache_dir: str) -> tuple:
+    """
+    The (.npy, .json) paths in the cache folder for a survey points file. The name comes from
+    the absolute path of the file. The size and modification time are checked against the JSON.
+    """
+    name = hashlib.sha1(os.path.abspath(file).encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, f'{name}.npy'), os.path.join(cache_dir, f'{name}.json')
+
+
+def read_cached_points(file: str, cache_dir: str) -> tuple:
+    """
+    The memory mapped points and extent of a survey points file from the cache folder.
+    Returns (None, None) if the file isn't cached or has changed since it was.
+    """
+    npy_path, json_path = points_cache_paths(file, cache_dir)
+    try:
+        with open(json_path, 'r') as f:
+            header = json.load(f)
+
+        stat = os.stat(file)
+        if header['source'] != os.path.abspath(file) or header['size'] != stat.st_size or header['mtime'] != stat.st_mtime_ns:
+            return None, None
+
+        points = np.load(npy_path, mmap_mode='r')
+    except (OSError, ValueError, KeyError):
+        return None, None
+
+    extent = tuple(header['extent']) if header['extent'] is not None else None
+    return points, extent
+
+
+def write_cached_points(file: str, cache_dir: str, points: np.array, extent: tuple) -> None:
+    """
+    Store the parsed points and extent of a survey points file in the cache folder. The files
+    are written under temporary names and then renamed so a reader never sees half a file.
+    """
+    stat = os.stat(file)
+    npy_path, json_path = points_cache_paths(file, cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    header = {
+        'source': os.path.abspath(file),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'shape': list(points.shape),
+        'extent': [float(value) for value in extent] if extent is not None else None
+    }
+
+    for final_path, write in [(npy_path, lambda f: np.save(f, points)), (json_path, lambda f: f.write(json.dumps(header).encode('utf-8')))]:
+        handle, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as f:
+                write(f)
+            os.replace(temp_path, final_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+
+def load_points(file: str, delimiter: str = ' ', cache_dir: str = None) -> np.array:
+    """
+    The points of a survey points file, memory mapped from the cache folder if it has them
+    and otherwise parsed and added to the cache
+    :param cache_dir: Folder of binary point caches. None to always parse the text
+    """
+    if cache_dir is None:
+        return read_points(file, delimiter)
+
+    points, __extent = read_cached_points(file, cache_dir)
+    if points is None:
+        points = read_points(file, delimiter)
+        try:
+            write_cached_points(file, cache_dir, points, points_extent(points) if points.shape[0] > 0 and points.shape[1] > 2 else None)
+        except OSError as ex:
+            Logger('Points Cache').warning(f'Failed to cache the points for {file}: {ex}')
+    return points
+
+
+class PointCloudLoader:
+    """
+    Parses each survey points file once and shares the parsed points between
+    validation, extent computation and gridding. The parsed arrays are kept, least
+    recently used first out, within a memory budget. The extent of every file that
+    has been parsed is always kept so it never needs to be parsed again for that.
+    With a cache folder the parsed points are also stored there as binary arrays that
+    later runs memory map instead of parsing the text again.
+    """
+
+    def __init__(self, delimiter: str = ' ', budget_mb: float = DEFAULT_POINTS_BUDGET_MB, workers: int = 1, cache_dir: str = None):
+        self.log = Logger('Point Cloud Loader')
+        self.delimiter = delimiter
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.used = 0
+        self.parse_count = 0
+
+        # Absolute path: points array. Oldest first
+        self.points = OrderedDict()
+        # Absolute path: (x_min, x_max, y_min, y_max)
+        self.extents = {}
+
+    def set_budget(self, budget_mb: float) -> None:
+        """
+        Change the memory budget, dropping parsed points if the loader is now over it
+        """
+        self.budget = int(budget_mb * 1024 * 1024)
+        self._evict()
+
+    def get(self, file: str) -> np.array:
+        """
+        The parsed points for this file, parsing it only if it isn't already held
+        """
+        key = os.path.abspath(file)
+        points = self.points.get(key)
+        if points is not None:
+            self.points.move_to_end(key)
+            return points
+
+        if self.cache_dir is not None:
+            points, extent = read_cached_points(file, self.cache_dir)
+            if points is not None:
+                if extent is not None:
+                    self.extents[key] = extent
+                return self._hold(key, points)
+
+        return self._add(file, read_points(file, self.delimiter))
+
+    def preload(self, files: List[str]) -> None:
+        """
+        Parse several files at once, spread across the loader's worker threads. Files are
+        parsed a batch at a time and preloading stops once the memory budget is used up.
+        Files that fail to parse are skipped here so that the error is raised by get().
+        """
+        files = [file for file in files if os.path.abspath(file) not in self.points]
+        if self.cache_dir is not None:
+            files = [file for file in files if read_cached_points(file, self.cache_dir)[0] is None]
+        if self.workers < 2 or len(files) < 2:
+            return
+
+        def parse(file):
+            try:
+                return read_points(file, self.delimiter)
+            except ValueError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for start in range(0, len(files), self.workers):
+                if self.used >= self.budget:
+                    break
+
+                batch = files[start:start + self.workers]
+                for file, points in zip(batch, executor.map(parse, batch)):
+                    if points is not None:
+                        self._add(file, points)
+
+    def _add(self, file: str, points: np.array) -> np.array:
+        key = os.path.abspath(file)
+        self.parse_count += 1
+        self.log.debug(f'Parsed {points.shape[0]} points from {file}')
+        if points.shape[0] > 0 and points.shape[1] > 2:
+            self.extents[key] = points_extent(points)
+
+        if self.cache_dir is not None:
+            try:
+                write_cached_points(file, self.cache_dir, points, self.extents.get(key))
+            except OSError as ex:
+                self.log.warning(f'Failed to cache the points for {file}: {ex}')
+
+        return self._hold(key, points)
+
+    def _hold(self, key: str, points: np.array) -> np.array:
+        self.points[key] = points
+        self.used += points.nbytes
+        self._evict(keep=key)
+        return points
+
+    def extent(self, file: str) -> tuple:
+        """
+        The (x_min, x_max, y_min, y_max) extent of the points in this file
+        """
+        key = os.path.abspath(file)
+        if not self._known_extent(file):
+            if self._fits(file):
+                self.get(file)
+            else:
+                # Too big to hold so stream through the file for just its extent
+                self.extents[key] = read_points_extent(file, self.delimiter)
+        return self.extents[key]
+
+    def union_extent(self, files: List[str]) -> tuple:
+        """
+        The (x_min, x_max, y_min, y_max) extent of the points in all these files. Files that fit
+        the budget are parsed and held for later. The extents of the rest are streamed, with
+        the files spread across the loader's worker threads.
+        """
+        unknown = [file for file in files if not self._known_extent(file)]
+        self.preload([file for file in unknown if self._fits(file)])
+
+        streamed = [file for file in unknown if not self._known_extent(file) and not self._fits(file)]
+        if self.workers > 1 and len(streamed) > 1:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for file, extent in zip(streamed, executor.map(lambda f: read_points_extent(f, self.delimiter), streamed)):
+                    self.extents[os.path.abspath(file)] = extent
+
+        extents = [self.extent(file) for file in files]
+        return (min(extent[0] for extent in extents), max(extent[1] for extent in extents),
+                min(extent[2] for extent in extents), max(extent[3] for extent in extents))
+
+    def _known_extent(self, file: str) -> bool:
+        """
+        Whether the extent of this file is known without parsing it, either from an earlier
+        parse or from the header in the cache folder
+        """
+        key = os.path.abspath(file)
+        if key not in self.extents and self.cache_dir is not None:
+            __points, extent = read_cached_points(file, self.cache_dir)
+            if extent is not None:
+                self.extents[key] = extent
+        return key in self.extents
+
+    def _fits(self, file: str) -> bool:
+        """
+        Whether the parsed points of this file are likely to fit in what is left of the budget.
+        The parsed points take up about as much memory as the text takes on disk.
+        """
+        return self.used + os.path.getsize(file) <= self.budget
+
+    def take(self, file: str) -> np.array:
+        """
+        Hand over the parsed points held for a file and stop holding them. Its extent is kept.
+        :return: The points, or None if they aren't held
+        """
+        points = self.points.pop(os.path.abspath(file), None)
+        if points is not None:
+            self.used -= points.nbytes
+        return points
+
+    def release(self, file: str) -> None:
+        """
+        Drop the parsed points for a file that is no longer needed. Its extent is kept.
+        """
+        points = self.points.pop(os.path.abspath(file), None)
+        if points is not None:
+            self.used -= points.nbytes
+
+    def clear(self) -> None:
+        """
+        Drop all the parsed points and extents
+        """
+        self.points.clear()
+        self.extents.clear()
+        self.used = 0
+
+    def _evict(self, keep: str = None) -> None:
+        """
+        Drop the least recently used points until the loader is within budget.
+        The file that was just parsed is handed back even if it is over budget on its own.
+        """
+        for key in list(self.points):
+            if self.used <= self.budget:
+                break
+            if key != keep:
+                self.release(key)
+
+        if self.used > self.budget and keep is not None:
+            self.release(keep)
+
+
+def union_csv_extents(csv_files: List[str], delimiter: str = ' ', cell_size: float = 1.0, padding: float = 10.0, loader: PointCloudLoader = None) -> tuple:
     """
     Take a list of csvfiles and finds the unioned extent of them
     We are assuming csvfile points are the center of the cell so we
@@ -16,32 +543,17 @@ def union_csv_extents(csv_files: List[str], delimiter: str = ' ', cell_size: flo
     :param delimiter:
     :param cellSize:
     :param padding:
+    :param loader: PointCloudLoader that shares the parsed points with the rest of the site's
+    processing. Without one each file is streamed through for just its extent.
     :return:
     """
     cell_size = float(cell_size)
     log = Logger('unionCSVExtents')
-    value_extent: tuple = ()
-
-    for file in csv_files:
-
-        file_arr = np.loadtxt(open(file, 'rb'), delimiter=delimiter)
 
-        # Get the extents (plus some padding):
-        x_max = np.amax(file_arr[:, 1])
-        y_max = np.amax(file_arr[:, 2])
+    if loader is None:
+        loader = PointCloudLoader(delimiter, budget_mb=0)
 
-        x_min = np.amin(file_arr[:, 1])
-        y_min = np.amin(file_arr[:, 2])
-
-        file_extent = (x_min, x_max, y_min, y_max)
-
-        if not value_extent:
-            value_extent = file_extent[:]  # Slice deep copy
-        else:
-            value_extent = (min(file_extent[0], value_extent[0]),
-                            max(file_extent[1], value_extent[1]),
-                            min(file_extent[2], value_extent[2]),
-                            max(file_extent[3], value_extent[3]))
+    value_extent = loader.union_extent(csv_files)
 
     log.debug(f'Uncorrected extent for {value_extent} delimited files is {len(csv_files)}')
 
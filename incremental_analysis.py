@@ -3,8 +3,8 @@ Incremental sandbar analysis
 """
 from typing import Dict
 import csv
-from raster_analysis import get_vol_and_area
-from raster import Raster
+from raster_analysis import get_hypsometry_from_values, get_valid_values_by_window
+from raster_cache import get_raster
 from logger import Logger
 from sandbar_site import SandbarSite
 from sandbar_survey_section import SandbarSurveySection
@@ -78,24 +78,28 @@ def run_section(site: SandbarSite, section: SandbarSurveySection, elev_benchmark
     # The results for this section will be a list of tuples (Elevation, Area, Volume)
     section_results = []
 
-    # Open the clipped raster for this site, survey and section and get the minimum surveyed elevation in this section
-    survey_raster = Raster(filepath=section.raster_path)
+    # Get the clipped raster for this site, survey and section and the minimum surveyed elevation in this section.
+    # It comes from the shared cache so the binned analysis doesn't decode it again. Rasters too large
+    # for the cache are streamed window by window below rather than read into one array.
+    survey_raster = get_raster(section.raster_path)
     analysis_elev = site.get_min_analysis_stage(survey_raster.min, elev_benchmark, elev_increment)
 
     if analysis_elev is None:
         # There is no survey data in this section
         return None
 
-    # We do the diff once and then mask it later
-    assert survey_raster.array.size == site.min_surface.array.size, 'The two arrays are not the same size!'
-
+    # Build the list of analysis elevations first so that every elevation can be
+    # calculated from a single pass over the section data.
+    elevations = []
     while analysis_elev < survey_raster.max:
-        area_vol = (-1.0, -1)
-        area_vol = get_vol_and_area(survey_raster.array, site.min_surface.array, analysis_elev, None, cell_size)
+        elevations.append(analysis_elev)
+        analysis_elev += elev_increment
 
-        if area_vol[0] > 0:
-            section_results.append((analysis_elev, area_vol[0], area_vol[1]))
+    survey_values, min_values = get_valid_values_by_window(survey_raster, site.min_surface.values)
+    areas, volumes = get_hypsometry_from_values(survey_values, min_values, elevations, cell_size)
 
-        analysis_elev += elev_increment
+    for elevation, area, volume in zip(elevations, areas, volumes):
+        if area > 0:
+            section_results.append((elevation, float(area), float(volume)))
 
     return section_results
@@ -8,6 +8,7 @@ import xml.etree.ElementTree as ET
 import xml.dom.minidom as minidom
 import logging
 import logging.handlers
+import threading
 from pprint import pformat
 
 
@@ -19,6 +20,10 @@ class _LoggerSingleton:
         def __init__(self):
             self.initialized = False
             self.verbose = False
+            # Messages are held here instead of being written while buffering (see Logger.start_buffer)
+            self.buffer = None
+            # Threads take turns writing so that the XML log stays whole
+            self.lock = threading.RLock()
 
         def setup(self, logRoot, xmlFilePath, config, verbose=False):
             self.initialized = True
@@ -57,6 +62,14 @@ class _LoggerSingleton:
                 obj2XML("MetaData", config, self.logTree.getroot())
             self.write()
 
+        def start_buffer(self):
+            self.buffer = []
+
+        def take_buffer(self):
+            records = self.buffer or []
+            self.buffer = None
+            return records
+
         def logprint(self, message, method="", severity="info", exception=None):
             """
             Logprint logs things 3 different ways: 1) stdout 2) log txt file 3) xml
@@ -66,6 +79,14 @@ class _LoggerSingleton:
             :param exception:
             :return:
             """
+            with self.lock:
+                self._logprint(message, method, severity, exception)
+
+        def _logprint(self, message, method, severity, exception):
+            # Hold on to everything. Whoever replays the buffer decides what gets written
+            if self.buffer is not None:
+                self.buffer.append((message, method, severity, str(exception) if exception is not None else None))
+                return
 
             # Verbose logs don't get written until we ask for them
             if severity == 'debug' and not self.verbose:
@@ -162,6 +183,32 @@ class Logger():
         self.instance = None
         self.method = None
 
+    def start_buffer(self):
+        """
+        Hold every message in memory instead of writing it. Used in worker processes
+        so that their messages can be written by the main process in one block.
+        """
+        self.instance.start_buffer()
+
+    def take_buffer(self):
+        """
+        Stop buffering and hand back the messages held since start_buffer
+        :return: List of (message, method, severity, exception) tuples
+        """
+        return self.instance.take_buffer()
+
+    def replay(self, records):
+        """
+        Write messages that were buffered, usually in another process
+        :param records: Messages from take_buffer
+        """
+        for message, method, severity, exception in records:
+            self.instance.logprint(message, method, severity, exception)
+
+    def __reduce__(self):
+        # Loggers are just a name in front of the process wide singleton
+        return (Logger, (self.method,))
+
     def info(self, message):
         self.instance.logprint(message, self.method, "info")
 
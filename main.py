@@ -12,7 +12,11 @@ from sandbar_site import load_sandbar_data, validate_site_codes
 from incremental_analysis import run_incremental_analysis
 from binned_analysis import run_binned_analysis
 from campsite_analysis import run_campsite_analysis
-from raster_preparation import raster_preparation
+from raster_preparation import raster_preparation, RasterPrepSettings
+from raster import Raster, geotiff_profile
+from raster_cache import raster_cache, DEFAULT_BUDGET_MB
+from csv_lib import DEFAULT_POINTS_BUDGET_MB
+from clip_raster import ClipEngine
 
 from config_loader import load_config
 
@@ -47,9 +51,32 @@ def main(conf: dict) -> None:
 
     if incremental is True or binned is True:
         # Create the DEM rasters and then clip them to the sandbar sections
-        raster_preparation(sites, conf['AnalysisFolder'], conf['CSVCellSize'], conf['RasterCellSize'],
-                           conf['ResampleMethod'], conf['srsEPSG'], conf['ReUseRasters'], conf['GDALWarp'],
-                           comp_extent)
+        settings = RasterPrepSettings(
+            analysis_folder=conf['AnalysisFolder'],
+            csv_cell_size=conf['CSVCellSize'],
+            raster_cell_size=conf['RasterCellSize'],
+            resample_method=conf['ResampleMethod'],
+            epsg=conf['srsEPSG'],
+            reuse_rasters=conf['ReUseRasters'],
+            gdal_warp=conf['GDALWarp'],
+            comp_extent=comp_extent,
+            resample_engine=conf.get('ResampleEngine', Raster.ResampleEngine.GRIDDATA),
+            block_valid_fraction=conf.get('BlockValidFraction', 0.5),
+            geotiff_profile=geotiff_profile(conf.get('GeoTIFFProfile', 'legacy'), conf.get('GeoTIFFOptions')),
+            points_budget_mb=conf.get('PointsCacheMB', DEFAULT_POINTS_BUDGET_MB),
+            parse_workers=conf.get('ParseWorkers', 1),
+            points_cache_dir=conf.get('PointsCacheFolder'),
+            plausible_margin=conf.get('PlausibleMargin'),
+            point_aggregation=conf.get('PointAggregation', Raster.PointAggregation.LAST),
+            site_workers=conf.get('SiteWorkers', 1),
+            survey_workers=conf.get('SurveyWorkers', 1),
+            survey_stack=conf.get('SurveyStack', False),
+            clip_engine=conf.get('ClipEngine', ClipEngine.MASK),
+            warp_threads=conf.get('WarpThreads'))
+        raster_preparation(sites, settings)
+
+    # The incremental and binned analyses share decoded section rasters through this cache
+    raster_cache.set_budget(conf.get('RasterCacheMB', DEFAULT_BUDGET_MB))
 
     # Incremental Analysis
     if incremental is True:
@@ -61,6 +88,9 @@ def main(conf: dict) -> None:
         bin_results_path = os.path.join(conf['AnalysisFolder'], conf['BinnedResults'])
         run_binned_analysis(sites, analysis_bins, conf['RasterCellSize'], bin_results_path)
 
+    if incremental is True or binned is True:
+        raster_cache.report()
+
     # Campsite Analysis
     if campsite is True:
         campsite_results_path = os.path.join(conf['AnalysisFolder'], conf['CampsiteResults'])
@@ -2,15 +2,37 @@
 Generic raster class for basic raster operations
 """
 from os import path
-from typing import Type
+from typing import Type, Tuple, List
 from osgeo import gdal, osr
+import warnings
 import numpy as np
 from scipy import interpolate
 from logger import Logger
+from csv_lib import load_points
 
 # this allows GDAL to throw Python Exceptions
 gdal.UseExceptions()
 
+# Data type of DEM arrays held in memory. This matches the GDT_Float32 rasters on disk.
+# Sums over these arrays (areas, volumes and statistics) are accumulated in float64.
+DEM_DTYPE = np.float32
+
+# Target number of cells in each window when streaming over a raster block by block
+WINDOW_CELLS = 1024 * 1024
+
+# GeoTIFF writer profiles. Each is the GDAL driver and its creation options.
+# 'legacy' is what Raster.write always used: LZW, striped and single threaded.
+# The tiled profiles use the floating point predictor, which suits smooth elevation surfaces.
+GEOTIFF_PROFILES = {
+    'legacy': ('GTiff', ['COMPRESS=LZW']),
+    'deflate': ('GTiff', ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'COMPRESS=DEFLATE', 'ZLEVEL=6', 'PREDICTOR=3', 'NUM_THREADS=ALL_CPUS']),
+    'zstd': ('GTiff', ['TILED=YES', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256', 'COMPRESS=ZSTD', 'ZSTD_LEVEL=9', 'PREDICTOR=3', 'NUM_THREADS=ALL_CPUS']),
+    'cog': ('COG', ['BLOCKSIZE=256', 'COMPRESS=DEFLATE', 'LEVEL=6', 'PREDICTOR=YES', 'NUM_THREADS=ALL_CPUS', 'OVERVIEWS=NONE']),
+}
+
+# Integer factor resample methods that aggregate (or replicate) whole blocks of cells
+BLOCK_METHODS = ('block_mean', 'block_min', 'block_max', 'block_linear')
+
 
 class Raster:
     """
@@ -24,6 +46,20 @@ class Raster:
         BOTTOMLEFT = (0.0, -1.0)
         BOTTOMRIGHT = (0.0, 1.0)
 
+    class ResampleEngine:
+        # scipy griddata over a triangulation (or KD-tree) of every cell
+        GRIDDATA = 'griddata'
+        # Index arithmetic and separable interpolation on the regular lattice
+        REGULAR = 'regular'
+
+    class PointAggregation:
+        # How the elevations of several points that fall in the same cell are combined
+        LAST = 'last'
+        MEAN = 'mean'
+        MIN = 'min'
+        MAX = 'max'
+        COUNT = 'count'
+
     def __init__(self, *args, **kwargs):
 
         self.log = Logger('Raster')
@@ -44,22 +80,9 @@ class Raster:
                 self.driver = src_ds.GetDriver().LongName
                 self.gt = src_ds.GetGeoTransform()
                 self.nodata = srcband.GetNoDataValue()
-                """ Turn a Raster with a single band into a 2D [x,y] = v array """
-                self.array = srcband.ReadAsArray()
-
-                # Now mask out any NAN or nodata values (we do both for consistency)
-                if self.nodata is not None:
-                    self.array = np.ma.array(self.array, mask=(np.isnan(self.array) | (self.array == self.nodata)))
-
                 self.data_type = srcband.DataType
-                self.min = np.nanmin(self.array)
-                self.max = np.nanmax(self.array)
-
-                if self.min is np.ma.masked:
-                    self.min = np.nan
-                if self.max is np.ma.masked:
-                    self.max = np.nan
-
+                # GDAL's native [x, y] block size. Windowed reads are aligned to these blocks
+                self.block_size = tuple(srcband.GetBlockSize())
                 self.proj = src_ds.GetProjection()
 
                 # Remember:
@@ -75,6 +98,23 @@ class Raster:
                 self.cell_height = self.gt[5]
                 self.cols = src_ds.RasterXSize
                 self.rows = src_ds.RasterYSize
+
+                if kwargs.get('read_array', True):
+                    """ Turn a Raster with a single band into a 2D [x,y] = v array """
+                    self.values = self._nodata_to_nan(srcband.ReadAsArray())
+
+                    # Use the statistics stored with the raster when it was written and skip the rescan
+                    self.min, self.max = band_statistics(srcband)
+                    if self.min is None:
+                        self.min, self.max = nan_min_max(self.values)
+                else:
+                    # Metadata only. Leave the pixels on disk until the values are first used
+                    # and take the min and max from the band statistics if GDAL has them
+                    self.values = None
+                    self._values_pending = True
+                    self.min, self.max = band_statistics(srcband)
+                    self._stats_pending = self.min is None
+
                 # Important to throw away the srcband
                 srcband.FlushCache()
                 srcband = None
@@ -88,7 +128,8 @@ class Raster:
             self.nodata = kwargs.get('nodata', -9999.0)
             self.min = None
             self.max = None
-            self.array = None
+            self.values = None
+            self.block_size = None
 
             self.rows = int(kwargs.get('rows', 0))
             self.cols = int(kwargs.get('cols', 0))
@@ -100,8 +141,6 @@ class Raster:
             temp_array = kwargs.get('array', None)
             if temp_array is not None:
                 self.set_array(temp_array)
-                self.min = np.nanmin(self.array)
-                self.max = np.nanmax(self.array)
 
             extent = kwargs.get('extent', None)
 
@@ -116,20 +155,165 @@ class Raster:
                 self.top = float(kwargs.get('top', -9999.0))
                 self.left = float(kwargs.get('left', -9999.0))
 
-    def load_dem_from_csv(self, csv_path: str, the_extent, pt_center=None) -> None:
+    @property
+    def values(self) -> np.array:
+        """
+        The raster values as a plain float array with NaN for nodata. Rasters opened
+        with read_array=False only read their pixels from disk the first time this is accessed.
+        """
+        if self._values_pending:
+            self._values_pending = False
+            src_ds = gdal.Open(self.filename)
+            self._values = self._nodata_to_nan(src_ds.GetRasterBand(1).ReadAsArray())
+            src_ds = None
+        return self._values
+
+    @values.setter
+    def values(self, value: np.array) -> None:
+        self._values = value
+        self._values_pending = False
+        self._masked_view = None
+
+    @property
+    def array(self) -> np.array:
+        """
+        Masked array view of the values (masked wherever they are NaN). This shares
+        memory with the values and is kept for code that still wants numpy.ma.
+        The raster core and analysis work on the values directly.
+        """
+        if self._masked_view is None and self.values is not None:
+            self._masked_view = np.ma.masked_invalid(self._values, copy=False)
+        return self._masked_view
+
+    @array.setter
+    def array(self, value: np.array) -> None:
+        self.values = None if value is None else to_nan_array(value)
+
+    @property
+    def min(self) -> float:
+        if self._stats_pending:
+            self._load_statistics()
+        return self._min
+
+    @min.setter
+    def min(self, value: float) -> None:
+        self._min = value
+        self._stats_pending = False
+
+    @property
+    def max(self) -> float:
+        if self._stats_pending:
+            self._load_statistics()
+        return self._max
+
+    @max.setter
+    def max(self, value: float) -> None:
+        self._max = value
+        self._stats_pending = False
+
+    def _load_statistics(self) -> None:
+        """
+        Work out the min and max of a metadata only raster that had no band statistics.
+        The pixels are streamed so the full array still isn't held in memory.
+        """
+        self.min, self.max = self.window_min_max()
+
+    def _nodata_to_nan(self, arr: np.array) -> np.array:
+        """
+        Turn the nodata values of an array freshly read from GDAL into NaN (in place where possible)
+        """
+        if arr.dtype.kind != 'f':
+            arr = arr.astype(np.float64)
+        if self.nodata is not None and not np.isnan(self.nodata):
+            arr[arr == self.nodata] = np.nan
+        return arr
+
+    def packed_valid_mask(self) -> np.array:
+        """
+        The cells that have a value, packed eight to a byte. This is an eighth of the size
+        of a boolean mask. Use unpack_valid_mask() to get the boolean mask back.
+        """
+        return np.packbits(~np.isnan(self.values), axis=None)
+
+    def windows(self, max_cells: int = WINDOW_CELLS):
+        """
+        Generator of (xoff, yoff, xsize, ysize) windows that cover the raster. Each window
+        is a whole number of GDAL's native blocks, grouped until it holds roughly max_cells.
+        Rasters that are not backed by a file are split into full rows.
+        """
+        block_x, block_y = self.block_size if self.block_size else (self.cols, 1)
+        block_x = max(1, min(block_x, self.cols))
+        block_y = max(1, min(block_y, self.rows))
+
+        blocks_x = max(1, min(-(-self.cols // block_x), max_cells // (block_x * block_y)))
+        blocks_y = max(1, max_cells // (blocks_x * block_x * block_y))
+        step_x = blocks_x * block_x
+        step_y = blocks_y * block_y
+
+        for yoff in range(0, self.rows, step_y):
+            for xoff in range(0, self.cols, step_x):
+                yield (xoff, yoff, min(step_x, self.cols - xoff), min(step_y, self.rows - yoff))
+
+    def read_window(self, xoff: int, yoff: int, xsize: int, ysize: int) -> np.array:
+        """
+        Read just one window of the raster with NaN for nodata, the same as the full values
+        """
+        if self._values is not None:
+            return self._values[yoff:yoff + ysize, xoff:xoff + xsize]
+
+        src_ds = gdal.Open(self.filename)
+        srcband = src_ds.GetRasterBand(1)
+        arr = self._nodata_to_nan(srcband.ReadAsArray(xoff, yoff, xsize, ysize))
+        srcband = None
+        src_ds = None
+        return arr
+
+    def iter_blocks(self, max_cells: int = WINDOW_CELLS):
+        """
+        Generator of (window, array) tuples that stream over the raster without ever
+        holding the full array. If the array is already loaded the windows are slices of it.
+        """
+        if self._values is not None:
+            for window in self.windows(max_cells):
+                yield (window, self.read_window(*window))
+            return
+
+        src_ds = gdal.Open(self.filename)
+        srcband = src_ds.GetRasterBand(1)
+        for window in self.windows(max_cells):
+            yield (window, self._nodata_to_nan(srcband.ReadAsArray(*window)))
+        srcband = None
+        src_ds = None
+
+    def window_min_max(self) -> Tuple[float, float]:
+        """
+        The minimum and maximum valid values, found by streaming over the raster
+        one window at a time. Both are NaN if there are no valid values.
+        """
+        the_min = np.nan
+        the_max = np.nan
+        for __window, block in self.iter_blocks():
+            values = valid_values(block)
+            if values.size > 0:
+                the_min = np.fmin(the_min, values.min())
+                the_max = np.fmax(the_max, values.max())
+
+        return (the_min, the_max)
+
+    def load_dem_from_csv(self, csv_path: str, the_extent, pt_center=None, points: np.array = None, cache_dir: str = None,
+                          aggregation: str = PointAggregation.LAST) -> dict:
         """
         Populate a raster's grid with values from a CSV file
         :param sCSVPath:
-        :return:
+        :param points: The already parsed (n, 4) points of the CSV file (see csv_lib.PointCloudLoader)
+        :param cache_dir: Folder of binary point caches that the points are memory mapped from
+        :param aggregation: Raster.PointAggregation used for cells with more than one point
+        :return: Duplicate point statistics (see duplicate_statistics)
         """
         if not pt_center:
             pt_center = self.PointShift.CENTER
 
-        file_arr = np.loadtxt(open(csv_path, 'rb'), delimiter=' ')
-
-        # Set up an empty array with the right size
-        z_array = np.empty((self.rows, self.cols))
-        z_array[:] = np.nan
+        file_arr = points if points is not None else load_points(csv_path, cache_dir=cache_dir)
 
         # If there is a :, python will pass .cellHeight))a slice:
         # Remember: theExtent = (Xmin, Xmax, Ymin, Ymax)
@@ -137,7 +321,11 @@ class Raster:
         y = (file_arr[:, 2] - (the_extent[2] + (pt_center[1] * self.cell_height))).astype(int)
 
         # Assign every point in the flat array to a grid point
-        z_array[y, x] = file_arr[:, 3]
+        z_array, counts = grid_points((self.rows, self.cols), y, x, file_arr[:, 3], aggregation)
+
+        stats = duplicate_statistics(counts)
+        if stats['duplicate_cells'] > 0:
+            self.log.info(f'{stats["duplicate_cells"]} cells have more than one point ({stats["duplicate_points"]} points, up to {stats["max_points_per_cell"]} in one cell). Combined using {aggregation}. {csv_path}')
 
         # This array might be upside-down from GDAL's perspective
         if self.cell_height < 0:
@@ -145,6 +333,8 @@ class Raster:
         else:
             self.set_array(z_array, True)
 
+        return stats
+
     def meta_copy(self):
         """
         Copy everything but the array
@@ -158,11 +348,9 @@ class Raster:
         :param rDEM:
         :return:
         """
-        # TODO: the masks are more complicated than this but we can make assumptions
-        # because we always get to the mask the same way.
-        min_arr = np.ma.masked_invalid(np.fmin(self.array.data, arr_dem.array.data))
-
-        self.set_array(min_arr)
+        # NaN is nodata so fmin takes whichever surface has a value. Accumulate in place
+        # so merging many surveys doesn't allocate a new surface each time
+        self.set_array(np.fmin(self.values, arr_dem.values, out=self.values))
 
     def merge_max_surface(self, arr_dem: np.array) -> None:
         """
@@ -170,91 +358,116 @@ class Raster:
         :return:
         """
 
-        max_arr = np.ma.masked_invalid(np.fmax(self.array.data, arr_dem.array.data))
-        self.set_array(max_arr)
+        self.set_array(np.fmax(self.values, arr_dem.values, out=self.values))
 
-    def resample_dem(self, new_cell_size: float, method: str) -> Type['Raster']:
+    def resample_dem(self, new_cell_size: float, method: str, engine: str = ResampleEngine.GRIDDATA, min_valid_fraction: float = 0.5) -> Type['Raster']:
         """
         Resample the raster and return a new resampled raster
         current raster
         :param newCellSize:
         :param method:
+        :param engine: Raster.ResampleEngine used for the linear, cubic and nearest methods
+        :param min_valid_fraction: fraction of valid cells required in a block by the block methods
         :return:
         """
         # Create a blank copy with everything but the array
         new_dem = self.meta_copy()
 
-        self.log.debug(f'Resampling original data from {self.cell_width}m to {new_cell_size}m using {method} method')
+        self.log.debug(f'Resampling original data from {self.cell_width}m to {new_cell_size}m using {method} method and {engine} engine')
         array_resampled = None
 
-        x_axis_old, y_axis_old = np.ma.masked_array(np.mgrid[0:self.rows:self.cell_width, 0:self.cols:abs(self.cell_height)],
-                                                    (self.array.mask, self.array.mask))
-
-        x_axis_new, y_axis_new = np.mgrid[0:self.rows:new_cell_size, 0:self.cols:new_cell_size]
-        new_mask = interpolate.griddata((x_axis_old.ravel(), y_axis_old.ravel()), self.array.mask.ravel(),
-                                        (x_axis_new, y_axis_new), method='nearest', fill_value=np.nan)
-
-        # Put us in the middle of the cell
-        x_axis_old += abs(self.cell_width) / 2
-        y_axis_old += abs(self.cell_height) / 2
-
-        # Bilinear is a lot slower that the others and it's its own
-        # method, written based on the
-        # well known wikipedia article.
-        if method == 'bilinear':
-            # Now we resample based on the method passed in here.
-            factor = self.cell_width / new_cell_size
-            new_shape = (int(self.rows * factor), int(self.cols * factor))
-            array_resampled = bilinear_resample(self.array, new_shape)
-        elif method == 'linear' or method == 'cubic' or method == 'nearest':
-            array_resampled = interpolate.griddata((x_axis_old.ravel(), y_axis_old.ravel()), self.array.ravel(),
-                                                   (x_axis_new, y_axis_new), method=method, fill_value=np.nan)
+        if method in BLOCK_METHODS:
+            # Block methods work for any engine because they never interpolate across the lattice
+            array_resampled = block_resample(self.values, self.cell_width, new_cell_size, method, min_valid_fraction)
+            new_mask = np.isnan(array_resampled)
+
+        elif engine == Raster.ResampleEngine.REGULAR:
+            if method == 'bilinear':
+                array_resampled = bilinear_resample(self.values, self._bilinear_shape(new_cell_size))
+                new_mask = regular_grid_mask(self.values, self.cell_width, new_cell_size)
+            elif method == 'linear' or method == 'cubic' or method == 'nearest':
+                array_resampled, new_mask = regular_grid_resample(self.values, self.cell_width, new_cell_size, method)
+            else:
+                raise ValueError(f"Resample Method: '{method}' not recognized")
+
+        elif engine == Raster.ResampleEngine.GRIDDATA:
+            old_mask = np.isnan(self.values)
+            x_axis_old, y_axis_old = np.mgrid[0:self.rows:self.cell_width, 0:self.cols:abs(self.cell_height)]
+
+            x_axis_new, y_axis_new = np.mgrid[0:self.rows:new_cell_size, 0:self.cols:new_cell_size]
+            new_mask = interpolate.griddata((x_axis_old.ravel(), y_axis_old.ravel()), old_mask.ravel(),
+                                            (x_axis_new, y_axis_new), method='nearest', fill_value=np.nan)
+
+            # Put us in the middle of the cell. Only the valid cells move: these axes used to be
+            # masked arrays and an in place add on a masked array leaves its masked cells alone
+            x_axis_old = x_axis_old + np.where(old_mask, 0.0, abs(self.cell_width) / 2)
+            y_axis_old = y_axis_old + np.where(old_mask, 0.0, abs(self.cell_height) / 2)
+
+            # Bilinear is a lot slower that the others and it's its own
+            # method, written based on the
+            # well known wikipedia article.
+            if method == 'bilinear':
+                # Now we resample based on the method passed in here.
+                array_resampled = bilinear_resample(self.values, self._bilinear_shape(new_cell_size))
+            elif method == 'linear' or method == 'cubic' or method == 'nearest':
+                array_resampled = interpolate.griddata((x_axis_old.ravel(), y_axis_old.ravel()), self.values.ravel(),
+                                                       (x_axis_new, y_axis_new), method=method, fill_value=np.nan)
+            else:
+                raise ValueError(f"Resample Method: '{method}' not recognized")
         else:
-            raise ValueError(f"Resample Method: '{method}' not recognized")
+            raise ValueError(f"Resample Engine: '{engine}' not recognized")
 
-        # Set the new cell size and set the new array
+        # Set the new cell size and set the new array. The resample itself is done in float64
+        # but the result is stored in the same precision as the rasters on disk
         new_dem.cell_width = new_cell_size
         new_dem.cell_height = -new_cell_size
-        new_dem.set_array(np.ma.masked_array(array_resampled, new_mask), False)
+        array_resampled = array_resampled.astype(DEM_DTYPE, copy=False)
+        array_resampled[np.asarray(new_mask, dtype=bool)] = np.nan
+        new_dem.set_array(array_resampled)
         self.log.debug('Successfully Resampled Raster')
         return new_dem
 
+    def _bilinear_shape(self, new_cell_size: float) -> tuple:
+        """
+        The shape of the array produced by the bilinear resample
+        """
+        factor = self.cell_width / new_cell_size
+        return (int(self.rows * factor), int(self.cols * factor))
+
     def set_array(self, incoming_array: np.array, copy=False) -> None:
         """
-        You can use the self.array directly but if you want to copy from one array
-        into a raster we suggest you do it this way
+        You can use the self.values directly but if you want to copy from one array
+        into a raster we suggest you do it this way. Masked arrays are accepted and
+        their masked cells become NaN.
         :param incomingArray:
+        :param copy: Always copy the incoming array, even if it could be used as it is
         :return:
         """
-        masked = isinstance(self.array, np.ma.MaskedArray)
-        if copy:
-            if masked:
-                self.array = np.ma.copy(incoming_array)
-            else:
-                self.array = np.ma.masked_invalid(incoming_array, copy=True)
-        else:
-            if masked:
-                self.array = incoming_array
-            else:
-                self.array = np.ma.masked_invalid(incoming_array)
+        self.values = to_nan_array(incoming_array, copy)
 
-        self.rows = self.array.shape[0]
-        self.cols = self.array.shape[1]
-        self.min = np.nanmin(self.array)
-        self.max = np.nanmax(self.array)
+        self.rows = self.values.shape[0]
+        self.cols = self.values.shape[1]
+        self.min, self.max = nan_min_max(self.values)
 
-    def write(self, output_raster: str) -> None:
+    def write(self, output_raster: str, histogram_bins: int = 0, profile: Tuple[str, List[str]] = None) -> None:
         """
         Write this raster object to a file. The Raster is closed after this so keep that in mind
         You won't be able to access the raster data after you run this.
+        The band statistics are stored with the raster so that readers don't need to rescan it.
         :param outputRaster:
+        :param histogram_bins: Also store an elevation histogram with this many bins (0 for none)
+        :param profile: (driver, creation options) from geotiff_profile(). Defaults to the legacy profile
         :return:
         """
         if path.isfile(output_raster):
             delete_raster(output_raster)
 
-        driver = gdal.GetDriverByName('GTiff')
-        out_raster = driver.Create(output_raster, self.cols, self.rows, 1, self.data_type, ['COMPRESS=LZW'])
+        driver_name, options = profile if profile is not None else GEOTIFF_PROFILES['legacy']
+        if driver_name == 'COG':
+            # The COG driver can only copy an existing dataset so build it in memory first
+            out_raster = gdal.GetDriverByName('MEM').Create('', self.cols, self.rows, 1, self.data_type)
+        else:
+            out_raster = gdal.GetDriverByName(driver_name).Create(output_raster, self.cols, self.rows, 1, self.data_type, options)
 
         # Remember:
         # [0]/* top left x */
@@ -266,16 +479,11 @@ class Raster:
         out_raster.SetGeoTransform([self.left, self.cell_width, 0, self.top, 0, self.cell_height])
         outband = out_raster.GetRasterBand(1)
 
+        values = valid_values(self.values)
+
         # Set nans to the original No Data Value
         outband.SetNoDataValue(self.nodata)
-        self.array.data[np.isnan(self.array)] = self.nodata
-        # Any mask that gets passed in here should have masked out elements set to
-        # Nodata Value
-        if isinstance(self.array, np.ma.MaskedArray):
-            np.ma.set_fill_value(self.array, self.nodata)
-            outband.WriteArray(self.array.filled())
-        else:
-            outband.WriteArray(self.array)
+        outband.WriteArray(np.where(np.isnan(self.values), self.nodata, self.values))
 
         spatial_ref = osr.SpatialReference()
         if self.proj == '':
@@ -284,9 +492,26 @@ class Raster:
             spatial_ref.ImportFromWkt(self.proj)
 
         out_raster.SetProjection(spatial_ref.ExportToWkt())
-        outband.FlushCache()
+        set_band_statistics(outband, *values_statistics(values))
+        histogram = None
+        if histogram_bins > 0 and values.size > 0:
+            histogram = (np.histogram(values, bins=histogram_bins)[0], float(values.min()), float(values.max()))
+
+        if driver_name == 'COG':
+            # The statistics metadata is copied across. The histogram goes in an .aux.xml sidecar
+            outband = None
+            gdal.GetDriverByName('COG').CreateCopy(output_raster, out_raster, options=options)
+            if histogram is not None:
+                cog_ds = gdal.Open(output_raster)
+                set_band_histogram(cog_ds.GetRasterBand(1), *histogram)
+                cog_ds = None
+        else:
+            if histogram is not None:
+                set_band_histogram(outband, *histogram)
+            outband.FlushCache()
         # Important to throw away the srcband
         outband = None
+        out_raster = None
         self.log.debug(f'Finished Writing Raster: {output_raster}')
 
     def print_raw_array(self):
@@ -357,6 +582,60 @@ class Raster:
         print('\n')
 
 
+def grid_points(shape: Tuple[int, int], rows: np.array, cols: np.array, z: np.array, aggregation: str = Raster.PointAggregation.LAST) -> Tuple[np.array, np.array]:
+    """
+    Scatter point elevations onto a grid in one vectorized pass, combining the points that land in the same cell
+    :param shape: (rows, cols) of the grid
+    :param rows: Row index of each point
+    :param cols: Column index of each point
+    :param z: Elevation of each point
+    :param aggregation: Raster.PointAggregation. Last is the order the points come in, as a plain assignment does
+    :return: DEM_DTYPE grid with NaN where there are no points, and the int count of points in each cell
+    """
+    cells = np.ravel_multi_index((rows, cols), shape)
+    counts = np.bincount(cells, minlength=shape[0] * shape[1])
+    z = np.asarray(z)
+
+    if aggregation == Raster.PointAggregation.LAST:
+        grid = np.full(counts.size, np.nan, dtype=DEM_DTYPE)
+        grid[cells] = z
+    elif aggregation == Raster.PointAggregation.MEAN:
+        # Accumulate in float64 so that many points in a cell don't lose precision
+        sums = np.bincount(cells, weights=z, minlength=counts.size)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            grid = (sums / counts).astype(DEM_DTYPE)
+    elif aggregation in (Raster.PointAggregation.MIN, Raster.PointAggregation.MAX):
+        # Group the points by cell and reduce each run of points. NaN elevations are ignored like merge_min_surface does
+        order = np.argsort(cells, kind='stable')
+        sorted_cells = cells[order]
+        starts = np.flatnonzero(np.diff(sorted_cells, prepend=-1))
+        reduce = np.fmin if aggregation == Raster.PointAggregation.MIN else np.fmax
+        grid = np.full(counts.size, np.nan, dtype=DEM_DTYPE)
+        grid[sorted_cells[starts]] = reduce.reduceat(z[order], starts)
+    elif aggregation == Raster.PointAggregation.COUNT:
+        grid = counts.astype(DEM_DTYPE)
+        grid[counts == 0] = np.nan
+    else:
+        raise ValueError(f'Unknown point aggregation: {aggregation}')
+
+    return grid.reshape(shape), counts.reshape(shape)
+
+
+def duplicate_statistics(counts: np.array) -> dict:
+    """
+    Summarise the cells that more than one point landed in
+    :param counts: Number of points in each cell (see grid_points)
+    """
+    duplicates = counts > 1
+    return {
+        'points': int(counts.sum()),
+        'cells': int(np.count_nonzero(counts)),
+        'duplicate_cells': int(np.count_nonzero(duplicates)),
+        'duplicate_points': int(counts[duplicates].sum()),
+        'max_points_per_cell': int(counts.max()) if counts.size > 0 else 0
+    }
+
+
 def delete_raster(full_path: str) -> None:
     """
     Delete a raster on disk
@@ -384,6 +663,9 @@ def bilinear_resample(old_grid: np.array, new_shape: tuple) -> np.array:
     :param oldGrid: A 2D array. This must be a regularly spaced grid (like a raster band array)
     :param newShape: the new shape you want in tuple format eg: (200,300)
     :return: newArr: The resampled array.
+
+    Masked and NaN cells in the old grid produce NaN in any new cell that
+    interpolates from them. New cells outside the old raster midpoints are NaN.
     '''
     new_arr = np.nan * np.empty(new_shape)
     old_cols, old_rows = old_grid.shape
@@ -391,36 +673,391 @@ def bilinear_resample(old_grid: np.array, new_shape: tuple) -> np.array:
     x_mult = float(new_cols) / old_cols  # 4 in our test case
     y_mult = float(new_rows) / old_rows
 
-    for (x, y), __element in np.ndenumerate(new_arr):
-        # do a transform to figure out where we are ont he old matrix
-        fx = x / x_mult
-        fy = y / y_mult
+    # Masked values are treated exactly like NaN values
+    old_values = np.ma.filled(old_grid, np.nan)
+
+    # do a transform to figure out where we are on the old matrix, one axis at a time
+    fx = np.arange(new_cols) / x_mult
+    fy = np.arange(new_rows) / y_mult
+
+    ix1 = np.floor(fx).astype(int)
+    iy1 = np.floor(fy).astype(int)
 
-        ix1 = int(np.floor(fx))
-        iy1 = int(np.floor(fy))
+    # Special case where point is on upper bounds
+    ix1[fx == float(new_cols - 1)] -= 1
+    iy1[fy == float(new_rows - 1)] -= 1
 
-        # Special case where point is on upper bounds
-        if fx == float(new_cols - 1):
-            ix1 -= 1
-        if fy == float(new_rows - 1):
-            iy1 -= 1
+    ix2 = ix1 + 1
+    iy2 = iy1 + 1
 
-        ix2 = ix1 + 1
-        iy2 = iy1 + 1
+    # Only new cells within the raster midpoints get a value
+    in_x = np.nonzero((ix1 >= 0) & (ix2 < old_cols))[0]
+    in_y = np.nonzero((iy1 >= 0) & (iy2 < old_rows))[0]
+    if in_x.size == 0 or in_y.size == 0:
+        return new_arr
 
-        # Test if we're within the raster midpoints
-        if (ix1 >= 0) and (iy1 >= 0) and (ix2 < old_cols) and (iy2 < old_rows):
-            # get the 4 values we need
-            vals = [old_grid[ix1, iy1], old_grid[ix1, iy2], old_grid[ix2, iy1], old_grid[ix2, iy2]]
+    # Column vectors for the x axis and row vectors for the y axis so that
+    # everything below broadcasts to the (x, y) block of new cells
+    fx, ix1, ix2 = fx[in_x, None], ix1[in_x, None], ix2[in_x, None]
+    fy, iy1, iy2 = fy[None, in_y], iy1[None, in_y], iy2[None, in_y]
 
-            # Here's where the actual interpolation is but make sure
-            # there aren't any nan values.
-            if not np.any([np.isnan(v) for v in vals]):
-                new_arr[x, y] = (vals[0] * (ix2 - fx) * (iy2 - fy) + vals[1] * (fx - ix1) * (iy2 - fy) + vals[2] * (ix2 - fx) * (fy - iy1) + vals[3] * (fx - ix1) * (fy - iy1)) / ((ix2 - ix1) * (iy2 - iy1) + 0.0)
+    # Here's where the actual interpolation is. Any NaN among the four values
+    # propagates into the result so there is no need to test for them.
+    new_arr[np.ix_(in_x, in_y)] = old_values[ix1, iy1] * (ix2 - fx) * (iy2 - fy) + \
+        old_values[ix1, iy2] * (fx - ix1) * (iy2 - fy) + \
+        old_values[ix2, iy1] * (ix2 - fx) * (fy - iy1) + \
+        old_values[ix2, iy2] * (fx - ix1) * (fy - iy1)
 
     return new_arr
 
 
+def regular_grid_positions(old_count: int, old_cell_size: float, new_cell_size: float) -> np.array:
+    """
+    The positions of the new cells along one axis, expressed in units of old cells from the
+    raster edge. These are the same sample positions that the griddata engine uses.
+    """
+    return np.arange(0, old_count * old_cell_size, new_cell_size) / old_cell_size
+
+
+def nearest_index(positions: np.array, old_count: int) -> np.array:
+    """
+    Index of the nearest old cell along one axis for each position (ties round up)
+    """
+    return np.clip(np.floor(positions + 0.5).astype(int), 0, old_count - 1)
+
+
+def regular_grid_mask(old_grid: np.array, old_cell_size: float, new_cell_size: float) -> np.array:
+    """
+    Nearest neighbour resample of the mask of a regular grid. Like the griddata engine this
+    uses the cell origins (not the cell centres) to look up the mask.
+    """
+    old_mask = ~valid_mask(old_grid)
+    rows_idx = nearest_index(regular_grid_positions(old_grid.shape[0], old_cell_size, new_cell_size), old_grid.shape[0])
+    cols_idx = nearest_index(regular_grid_positions(old_grid.shape[1], old_cell_size, new_cell_size), old_grid.shape[1])
+    return old_mask[np.ix_(rows_idx, cols_idx)]
+
+
+def regular_grid_resample(old_grid: np.array, old_cell_size: float, new_cell_size: float, method: str) -> Tuple[np.array, np.array]:
+    """
+    Resample a regular grid onto another regular grid without building a triangulation.
+    'nearest' is pure index arithmetic. 'linear' and 'cubic' are separable: the grid is
+    interpolated along the rows and then along the columns. New cells that fall outside
+    the old cell centres are NaN, as are cells that interpolate from a masked or NaN cell.
+    :param old_grid: 2D (masked) array of values
+    :param old_cell_size: cell size of the old grid
+    :param new_cell_size: cell size of the new grid
+    :param method: 'nearest', 'linear' or 'cubic'
+    :return: tuple of the resampled values and the resampled mask
+    """
+    old_values = np.ma.filled(old_grid, np.nan)
+    new_mask = regular_grid_mask(old_grid, old_cell_size, new_cell_size)
+
+    # Positions relative to the old cell centres
+    rows_pos = regular_grid_positions(old_grid.shape[0], old_cell_size, new_cell_size) - 0.5
+    cols_pos = regular_grid_positions(old_grid.shape[1], old_cell_size, new_cell_size) - 0.5
+
+    if method == 'nearest':
+        rows_idx = nearest_index(rows_pos, old_grid.shape[0])
+        cols_idx = nearest_index(cols_pos, old_grid.shape[1])
+        return (old_values[np.ix_(rows_idx, cols_idx)], new_mask)
+
+    if method == 'linear':
+        kernel = linear_weights
+    elif method == 'cubic':
+        kernel = cubic_weights
+    else:
+        raise ValueError(f"Resample Method: '{method}' not recognized")
+
+    new_values = separable_resample(old_values, kernel(rows_pos, old_grid.shape[0]), kernel(cols_pos, old_grid.shape[1]))
+
+    # Nothing is extrapolated beyond the outer cell centres
+    new_values[(rows_pos < 0) | (rows_pos > old_grid.shape[0] - 1), :] = np.nan
+    new_values[:, (cols_pos < 0) | (cols_pos > old_grid.shape[1] - 1)] = np.nan
+
+    return (new_values, new_mask)
+
+
+def separable_resample(old_values: np.array, rows_taps: Tuple[np.array, np.array], cols_taps: Tuple[np.array, np.array]) -> np.array:
+    """
+    Interpolate down the rows and then across the columns using the (indices, weights)
+    taps for each axis. Taps with a zero weight are skipped so that a new cell sitting
+    exactly on an old cell centre takes its value even if a neighbouring cell is NaN.
+    """
+    rows_idx, rows_weights = rows_taps
+    cols_idx, cols_weights = cols_taps
+
+    row_pass = np.zeros((rows_idx.shape[0], old_values.shape[1]))
+    for tap in range(rows_idx.shape[1]):
+        term = rows_weights[:, tap, None] * old_values[rows_idx[:, tap], :]
+        term[rows_weights[:, tap] == 0, :] = 0.0
+        row_pass += term
+
+    new_values = np.zeros((rows_idx.shape[0], cols_idx.shape[0]))
+    for tap in range(cols_idx.shape[1]):
+        term = cols_weights[None, :, tap] * row_pass[:, cols_idx[:, tap]]
+        term[:, cols_weights[:, tap] == 0] = 0.0
+        new_values += term
+
+    return new_values
+
+
+def block_resample(old_grid: np.array, old_cell_size: float, new_cell_size: float, method: str, min_valid_fraction: float = 0.5) -> np.array:
+    """
+    Resample by an integer factor without any triangulation.
+
+    Downsampling splits the grid into factor x factor blocks (padding the bottom and right
+    edges with NaN) and reduces each block with its NaN-aware mean, minimum or maximum.
+    A block is NaN unless at least min_valid_fraction of its cells are valid.
+    'block_linear' uses the mean when downsampling.
+
+    Upsampling replicates each old cell into a factor x factor block, except for 'block_linear'
+    which linearly interpolates between the old cell centres across each block.
+    :param old_grid: 2D (masked) array of values
+    :param old_cell_size: cell size of the old grid
+    :param new_cell_size: cell size of the new grid. Must be an integer multiple or divisor of the old cell size
+    :param method: one of BLOCK_METHODS
+    :param min_valid_fraction: fraction of valid cells required in a block when downsampling
+    :return: the resampled array with NaN for nodata
+    """
+    if method not in BLOCK_METHODS:
+        raise ValueError(f"Resample Method: '{method}' not recognized")
+
+    old_values = np.ma.filled(old_grid.astype(float), np.nan)
+    old_rows, old_cols = old_values.shape
+    ratio = new_cell_size / old_cell_size if new_cell_size >= old_cell_size else old_cell_size / new_cell_size
+    factor = int(round(ratio))
+    if abs(ratio - factor) > 1e-6:
+        raise ValueError(f'Block resampling from {old_cell_size}m to {new_cell_size}m requires an integer factor (got {ratio})')
+
+    if new_cell_size >= old_cell_size:
+        new_rows = -(-old_rows // factor)
+        new_cols = -(-old_cols // factor)
+        padded = np.full((new_rows * factor, new_cols * factor), np.nan)
+        padded[:old_rows, :old_cols] = old_values
+        blocks = padded.reshape(new_rows, factor, new_cols, factor)
+
+        valid_count = np.count_nonzero(~np.isnan(blocks), axis=(1, 3))
+        if method == 'block_min':
+            new_values = np.fmin.reduce(np.fmin.reduce(blocks, axis=3), axis=1)
+        elif method == 'block_max':
+            new_values = np.fmax.reduce(np.fmax.reduce(blocks, axis=3), axis=1)
+        else:
+            block_sum = np.nansum(blocks, axis=(1, 3))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                new_values = block_sum / valid_count
+
+        new_values[(valid_count == 0) | (valid_count < min_valid_fraction * factor * factor)] = np.nan
+        return new_values
+
+    if method == 'block_linear':
+        # Centres of the new cells relative to the old cell centres, held at the outer edges
+        rows_pos = np.clip((np.arange(old_rows * factor) + 0.5) / factor - 0.5, 0, old_rows - 1)
+        cols_pos = np.clip((np.arange(old_cols * factor) + 0.5) / factor - 0.5, 0, old_cols - 1)
+        return separable_resample(old_values, linear_weights(rows_pos, old_rows), linear_weights(cols_pos, old_cols))
+
+    return np.repeat(np.repeat(old_values, factor, axis=0), factor, axis=1)
+
+
+def linear_weights(positions: np.array, old_count: int) -> Tuple[np.array, np.array]:
+    """
+    Indices and weights of the two old cells that linearly interpolate each position
+    """
+    idx0 = np.clip(np.floor(positions).astype(int), 0, max(old_count - 2, 0))
+    frac = positions - idx0
+    indices = np.clip(np.stack([idx0, idx0 + 1], axis=1), 0, old_count - 1)
+    weights = np.stack([1.0 - frac, frac], axis=1)
+    return (indices, weights)
+
+
+def cubic_weights(positions: np.array, old_count: int, a: float = -0.5) -> Tuple[np.array, np.array]:
+    """
+    Indices and weights of the four old cells that interpolate each position
+    using the Keys cubic convolution kernel. Edge cells are repeated beyond the grid.
+    """
+    idx1 = np.floor(positions).astype(int)
+    frac = positions - idx1
+    indices = np.clip(np.stack([idx1 - 1, idx1, idx1 + 1, idx1 + 2], axis=1), 0, old_count - 1)
+
+    dist = np.abs(np.stack([frac + 1.0, frac, 1.0 - frac, 2.0 - frac], axis=1))
+    weights = np.where(dist <= 1.0,
+                       ((a + 2.0) * dist - (a + 3.0)) * dist**2 + 1.0,
+                       ((a * dist - 5.0 * a) * dist + 8.0 * a) * dist - 4.0 * a)
+    return (indices, weights)
+
+
+def to_nan_array(arr: np.array, copy: bool = False) -> np.array:
+    """
+    Plain float array with NaN for nodata. Masked cells of masked arrays become NaN.
+    Float arrays without a mask are used as they are unless a copy is asked for.
+    """
+    if isinstance(arr, np.ma.MaskedArray):
+        mask = np.ma.getmask(arr)
+        data = np.ma.getdata(arr)
+        if data.dtype.kind != 'f':
+            data = data.astype(np.float64)
+        elif copy or mask is not np.ma.nomask:
+            data = data.copy()
+        if mask is not np.ma.nomask:
+            data[mask] = np.nan
+        return data
+
+    arr = np.asarray(arr)
+    if arr.dtype.kind != 'f':
+        return arr.astype(np.float64)
+    return arr.copy() if copy else arr
+
+
+def valid_mask(arr: np.array) -> np.array:
+    """
+    Boolean array of the cells that are neither masked nor NaN
+    """
+    valid = ~np.isnan(np.ma.getdata(arr))
+    mask = np.ma.getmask(arr)
+    if mask is not np.ma.nomask:
+        valid &= ~mask
+    return valid
+
+
+def unpack_valid_mask(packed: np.array, shape: Tuple[int, int]) -> np.array:
+    """
+    Boolean valid mask from Raster.packed_valid_mask()
+    """
+    return np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape).astype(bool)
+
+
+def nan_min_max(values: np.array) -> Tuple[float, float]:
+    """
+    The minimum and maximum of an array with NaN for nodata. Both are NaN if there are no values.
+    """
+    with warnings.catch_warnings():
+        # All NaN arrays are fine. They just have no min or max
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return (np.nanmin(values), np.nanmax(values))
+
+
+def valid_values(arr: np.array) -> np.array:
+    """
+    Flat array of the values that are neither masked nor NaN
+    """
+    values = arr.compressed() if isinstance(arr, np.ma.MaskedArray) else np.ravel(arr)
+    return values[~np.isnan(values)]
+
+
+def values_statistics(values: np.array) -> Tuple[float, float, int, float]:
+    """
+    (min, max, valid count, sum) of a flat array of valid values. The sum is
+    accumulated in float64. Min and max are NaN if there are no values.
+    """
+    if values.size < 1:
+        return (np.nan, np.nan, 0, 0.0)
+
+    return (float(values.min()), float(values.max()), int(values.size), float(np.sum(values, dtype=np.float64)))
+
+
+def band_statistics(band) -> Tuple[float, float]:
+    """
+    The minimum and maximum of a band from the statistics GDAL already has for it,
+    either in the file's own metadata or in an .aux.xml sidecar. Nothing is computed
+    so this never reads pixels. Returns (None, None) if there are no statistics.
+    Approximate statistics (e.g. from gdalinfo -approx_stats) are ignored.
+    :param band: GDAL raster band
+    """
+    if band.GetMetadataItem('STATISTICS_APPROXIMATE') == 'YES':
+        return (None, None)
+
+    if band.GetMetadataItem('STATISTICS_VALID_COUNT') == '0':
+        return (np.nan, np.nan)
+
+    the_min = band.GetMetadataItem('STATISTICS_MINIMUM')
+    the_max = band.GetMetadataItem('STATISTICS_MAXIMUM')
+    if the_min is None or the_max is None:
+        return (None, None)
+
+    return (float(the_min), float(the_max))
+
+
+def set_band_statistics(band, the_min: float, the_max: float, count: int, the_sum: float) -> None:
+    """
+    Store exact statistics on a band using GDAL's standard STATISTICS_* metadata items
+    plus the valid cell count and sum. GeoTIFFs keep these in the file's own metadata.
+    :param band: GDAL raster band opened for writing
+    """
+    band.SetMetadataItem('STATISTICS_VALID_COUNT', str(count))
+    band.SetMetadataItem('STATISTICS_SUM', repr(the_sum))
+    if count > 0:
+        band.SetMetadataItem('STATISTICS_MINIMUM', repr(the_min))
+        band.SetMetadataItem('STATISTICS_MAXIMUM', repr(the_max))
+        band.SetMetadataItem('STATISTICS_MEAN', repr(the_sum / count))
+
+
+def set_band_histogram(band, counts: np.array, the_min: float, the_max: float) -> None:
+    """
+    Store an elevation histogram as the band's default histogram
+    :param counts: Number of cells in each of the equal width bins between the_min and the_max
+    """
+    band.SetDefaultHistogram(the_min, the_max, [int(count) for count in counts])
+
+
+def write_statistics(raster_path: str, histogram_bins: int = 0) -> None:
+    """
+    Stream over an existing raster and store its statistics with it. Use this for
+    rasters that were not written by Raster.write(), like the output of gdalwarp.
+    :param raster_path: Path to the raster
+    :param histogram_bins: Also store an elevation histogram with this many bins (0 for none)
+    """
+    raster = Raster(filepath=raster_path, read_array=False)
+
+    the_min = np.nan
+    the_max = np.nan
+    count = 0
+    the_sum = 0.0
+    for __window, block in raster.iter_blocks():
+        block_min, block_max, block_count, block_sum = values_statistics(valid_values(block))
+        the_min = np.fmin(the_min, block_min)
+        the_max = np.fmax(the_max, block_max)
+        count += block_count
+        the_sum += block_sum
+
+    counts = None
+    if histogram_bins > 0 and count > 0:
+        # Second pass now that the range of the histogram is known
+        counts = np.zeros(histogram_bins, dtype=np.int64)
+        for __window, block in raster.iter_blocks():
+            counts += np.histogram(valid_values(block), bins=histogram_bins, range=(the_min, the_max))[0]
+
+    # Updating a cloud optimized GeoTIFF in place would break its layout so its statistics go in an .aux.xml sidecar
+    src_ds = gdal.Open(raster_path)
+    if src_ds.GetMetadataItem('LAYOUT', 'IMAGE_STRUCTURE') != 'COG':
+        src_ds = gdal.Open(raster_path, gdal.GA_Update)
+    band = src_ds.GetRasterBand(1)
+    set_band_statistics(band, float(the_min), float(the_max), count, the_sum)
+    if counts is not None:
+        set_band_histogram(band, counts, float(the_min), float(the_max))
+    band.FlushCache()
+    band = None
+    src_ds = None
+
+
+def geotiff_profile(name: str, overrides: str = None) -> Tuple[str, List[str]]:
+    """
+    Look up a GeoTIFF writer profile by name and apply any overriding creation options
+    :param name: One of the GEOTIFF_PROFILES (legacy, deflate, zstd or cog)
+    :param overrides: Space separated KEY=VALUE creation options, e.g. "ZLEVEL=9 NUM_THREADS=4"
+    :return: (driver name, creation options)
+    """
+    if name not in GEOTIFF_PROFILES:
+        raise ValueError(f'Unknown GeoTIFF profile "{name}". Expected one of {", ".join(GEOTIFF_PROFILES)}')
+
+    driver_name, options = GEOTIFF_PROFILES[name]
+    options = {option.split('=')[0]: option for option in options}
+    if overrides:
+        for option in overrides.split():
+            assert '=' in option, f'GeoTIFF creation options must be KEY=VALUE. Got "{option}"'
+            options[option.split('=')[0].upper()] = option
+
+    return (driver_name, list(options.values()))
+
+
 def array2raster_template(array: np.array, output_raster: str, template_raster: str) -> None:
     """
     This is similar to the function above only it gets its initial values from an
@@ -430,6 +1067,7 @@ def array2raster_template(array: np.array, output_raster: str, template_raster:
     :param templateRaster:
     :return:
     """
-    raster = Raster(filepath=template_raster)
+    # Only the template's metadata is needed. Its pixels are never read
+    raster = Raster(filepath=template_raster, read_array=False)
     raster.set_array(array)
     raster.write(output_raster)
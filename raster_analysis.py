@@ -4,9 +4,10 @@ null then the calculation is up to the upper elevation. If the upper elevation i
 then the analysis is above the lower elevation. If both are valid then the analysis is
 greater than or equal to the lower elevation and less than the upper elevation. i.e.
 """
-from typing import Dict
+from typing import Dict, List, Tuple
 import copy
 import numpy as np
+from raster import Raster, WINDOW_CELLS, to_nan_array, valid_mask
 
 
 def get_vol_and_area(ar_survey: np.array, ar_minimum: np.array, lower_elev: float, upper_elev: float, cell_size: float) -> tuple:
@@ -20,27 +21,19 @@ def get_vol_and_area(ar_survey: np.array, ar_minimum: np.array, lower_elev: floa
     Upper is null then analysis >= lower
     Both valid then analysis >= lower and < upper
     """
-    if lower_elev is None:
-        assert upper_elev is not None, 'An upper elevation must be provided if the lower elevation is not provided.'
-    else:
-        assert lower_elev >= 0, 'The lower elevation ({lower_elev}) must be greater than or equal to zero.'
-        if upper_elev is not None:
-            assert lower_elev < upper_elev, 'The lower elevation ({lower_elev}) must be less than the upper elevation ({upper_elev}).'
+    check_elevations(lower_elev, upper_elev)
 
-    if upper_elev is not None:
-        assert upper_elev >= 0, 'The upper elevation ({upper_elev}) must be greater than or equal to zero.'
+    # Plain float arrays with NaN for nodata. Masked arrays have their masked cells turned into NaN
+    ar_survey = to_nan_array(ar_survey)
 
     # Only proceed and calculate the area and volume if the survey is not entirely masked.
     # This shouldn't be needed, but the Workbench might have sections for surveys where no data were collected.
-    if np.ma.MaskedArray.count(ar_survey) == 0:
+    survey_nodata = np.isnan(ar_survey)
+    if survey_nodata.all():
         return (0.0, 0.0, 0.0, 0.0, 0.0, 0.0)
 
-    # We will create a new, custom minimum surface:
-    ar_new_min_srf = np.empty_like(ar_minimum)
-
-    # Quick Deep copy of arMinimum:
-    ar_new_min_srf[:] = ar_minimum
-    ar_new_min_srf = np.ma.masked_where(ar_survey.mask, ar_new_min_srf, True)
+    # The minimum surface only counts where there is survey data
+    ar_new_min_srf = np.where(survey_nodata, np.nan, to_nan_array(ar_minimum))
 
     template = {'area': 0.0, 'volume': 0.0}
     survey_above_upper = copy.copy(template)
@@ -48,7 +41,7 @@ def get_vol_and_area(ar_survey: np.array, ar_minimum: np.array, lower_elev: floa
 
     new_lower_elev = lower_elev
     if lower_elev is None:
-        new_lower_elev = np.min(ar_survey)
+        new_lower_elev = np.nanmin(ar_survey)
 
     survey_above_lower = get_above_elev(ar_survey, new_lower_elev, cell_size)
     min_surf_above_lower = get_above_elev(ar_new_min_srf, new_lower_elev, cell_size)
@@ -66,17 +59,36 @@ def get_vol_and_area(ar_survey: np.array, ar_minimum: np.array, lower_elev: floa
     return (area, net_volume, survey_above_lower['volume'], min_surf_above_lower['area'], min_surf_above_lower['volume'], min_surf_net_vol)
 
 
+def check_elevations(lower_elev: float, upper_elev: float) -> None:
+    """
+    Validate a pair of lower and upper analysis elevations. Either can be None, but not both.
+    """
+
+    if lower_elev is None:
+        assert upper_elev is not None, 'An upper elevation must be provided if the lower elevation is not provided.'
+    else:
+        assert lower_elev >= 0, 'The lower elevation ({lower_elev}) must be greater than or equal to zero.'
+        if upper_elev is not None:
+            assert lower_elev < upper_elev, 'The lower elevation ({lower_elev}) must be less than the upper elevation ({upper_elev}).'
+
+    if upper_elev is not None:
+        assert upper_elev >= 0, 'The upper elevation ({upper_elev}) must be greater than or equal to zero.'
+
+
 def get_above_elev(ar_values: np.array, elevation: float, cell_size: float) -> Dict[float, float]:
     """
-    Get the area and volume above the elevation
+    Get the area and volume above the elevation. NaN (and masked) cells are never above it.
     """
 
-    area_above_elev = np.ma.MaskedArray.count(ar_values[ar_values > elevation]) * cell_size**2
+    ar_values = to_nan_array(ar_values)
+    values_above_elev = ar_values[ar_values > elevation]
+    area_above_elev = values_above_elev.size * cell_size**2
 
     vol_above_elev = 0.0
     if area_above_elev > 0:
-        vol_above_elev = np.nansum(
-            ar_values[ar_values > elevation]) * cell_size**2 - (area_above_elev * elevation)
+        # Accumulate in float64 so that float32 rasters keep their volume precision. The elevation
+        # can be a float32 raster value (the survey minimum) so it is widened for the volume too
+        vol_above_elev = np.sum(values_above_elev, dtype=np.float64) * cell_size**2 - (area_above_elev * np.float64(elevation))
 
     return {'area': area_above_elev, 'volume': vol_above_elev}
 
@@ -92,19 +104,13 @@ def get_bin_area(ar_survey: np.array, lower_elev: float, upper_elev: float, cell
     Both valid then analysis >= lower and < upper
     """
 
-    if lower_elev is None:
-        assert upper_elev is not None, 'An upper elevation must be provided if the lower elevation is not provided.'
-    else:
-        assert lower_elev >= 0, 'The lower elevation ({lower_elev}) must be greater than or equal to zero.'
-        if upper_elev is not None:
-            assert lower_elev < upper_elev, 'The lower elevation ({lower_elev}) must be less than the upper elevation ({upper_elev}).'
+    check_elevations(lower_elev, upper_elev)
 
-    if upper_elev is not None:
-        assert upper_elev >= 0, 'The upper elevation ({upper_elev}) must be greater than or equal to zero.'
+    ar_survey = to_nan_array(ar_survey)
 
     # Only proceed and calculate the area and volume if the survey is not entirely masked.
     # This shouldn't be needed, but the Workbench might have sections for surveys where no data were collected.
-    if np.ma.MaskedArray.count(ar_survey) == 0:
+    if np.isnan(ar_survey).all():
         return 0.0
 
     template = {'area': 0.0}
@@ -112,7 +118,7 @@ def get_bin_area(ar_survey: np.array, lower_elev: float, upper_elev: float, cell
 
     new_lower_elev = lower_elev
     if lower_elev is None:
-        new_lower_elev = np.min(ar_survey)
+        new_lower_elev = np.nanmin(ar_survey)
 
     survey_above_lower = get_above_elev(ar_survey, new_lower_elev, cell_size)
 
@@ -122,3 +128,192 @@ def get_bin_area(ar_survey: np.array, lower_elev: float, upper_elev: float, cell
     area = survey_above_lower['area'] - survey_above_upper['area']
 
     return area
+
+
+def get_hypsometry(ar_survey: np.array, ar_minimum: np.array, elevations: List[float], cell_size: float) -> Tuple[np.array, np.array]:
+    """
+    Calculates the area and net volume above every elevation in a single pass.
+
+    This produces the same values as calling get_vol_and_area(ar_survey, ar_minimum, elevation, None, cell_size)
+    once for each elevation, but the valid cells of the survey and the minimum surface are only extracted
+    and sorted once. The area and volume above each elevation are then derived from cumulative sums.
+
+    Returns a tuple of (areas, volumes) arrays with one value per elevation.
+    """
+
+    return get_hypsometry_from_values(*get_valid_values(ar_survey, ar_minimum), elevations, cell_size)
+
+
+def get_hypsometry_from_values(survey_values: np.array, min_values: np.array, elevations: List[float], cell_size: float) -> Tuple[np.array, np.array]:
+    """
+    get_hypsometry() for flat arrays of valid survey and minimum surface values
+    (see get_valid_values() and get_valid_values_by_window()).
+    """
+
+    elevations = np.asarray(elevations, dtype=np.float64)
+
+    # Only proceed and calculate the area and volume if the survey is not entirely masked.
+    if survey_values.size == 0:
+        return (np.zeros(elevations.shape), np.zeros(elevations.shape))
+
+    survey_area, survey_vol = get_above_elevs(*get_cumulative_values(survey_values), elevations, cell_size)
+    __min_area, min_vol = get_above_elevs(*get_cumulative_values(min_values), elevations, cell_size)
+
+    return (survey_area, survey_vol - min_vol)
+
+
+def get_valid_values(ar_survey: np.array, ar_minimum: np.array) -> Tuple[np.array, np.array]:
+    """
+    Returns flat arrays of the valid survey values and the valid minimum surface values.
+    The minimum surface is masked wherever the survey is masked, just like get_vol_and_area().
+    """
+
+    survey_valid = valid_mask(ar_survey)
+
+    survey_values = np.ma.getdata(ar_survey)[survey_valid]
+    min_values = np.ma.getdata(ar_minimum)[survey_valid & valid_mask(ar_minimum)]
+
+    return (survey_values, min_values)
+
+
+def get_valid_values_by_window(survey_raster: Raster, ar_minimum: np.array, max_cells: int = WINDOW_CELLS) -> Tuple[np.array, np.array]:
+    """
+    The same as get_valid_values() but streams over the survey raster one block aligned
+    window at a time, so the full survey array and its mask are never held in memory.
+    The minimum surface must be on the same grid as the survey raster.
+    :param max_cells: Upper bound on the number of cells read in each window
+    """
+
+    assert (survey_raster.rows, survey_raster.cols) == ar_minimum.shape, 'The two arrays are not the same size!'
+
+    survey_parts = []
+    min_parts = []
+    for (xoff, yoff, xsize, ysize), block in survey_raster.iter_blocks(max_cells):
+        survey_values, min_values = get_valid_values(block, ar_minimum[yoff:yoff + ysize, xoff:xoff + xsize])
+        survey_parts.append(survey_values)
+        min_parts.append(min_values)
+
+    if len(survey_parts) < 1:
+        return (np.empty(0), np.empty(0))
+
+    return (np.concatenate(survey_parts), np.concatenate(min_parts))
+
+
+def get_cumulative_values(values: np.array) -> Tuple[np.array, np.array]:
+    """
+    Sort the values and build the cumulative sum used to look up the area and volume
+    above any elevation. The cumulative sum has a leading zero and is accumulated in
+    double precision so that volumes keep their precision.
+    """
+
+    sorted_values = np.sort(values)
+    cumulative = np.concatenate(([0.0], np.cumsum(sorted_values, dtype=np.float64)))
+
+    return (sorted_values, cumulative)
+
+
+def get_above_elevs(sorted_values: np.array, cumulative: np.array, elevations: np.array, cell_size: float) -> Tuple[np.array, np.array]:
+    """
+    Get the area and volume above each of the elevations from sorted values
+    and their cumulative sum (see get_cumulative_values()).
+    """
+
+    # Index of the first value strictly greater than each elevation. The comparison is done at the
+    # dtype of the values, like get_above_elev(), so that values equal to an elevation once it is
+    # rounded to float32 are not counted as above it. The volume still uses the float64 elevations.
+    idx = np.searchsorted(sorted_values, np.asarray(elevations).astype(sorted_values.dtype), side='right')
+    count_above = sorted_values.size - idx
+
+    area_above_elev = count_above * cell_size**2
+    vol_above_elev = (cumulative[-1] - cumulative[idx]) * cell_size**2 - (area_above_elev * elevations)
+    vol_above_elev[count_above == 0] = 0.0
+
+    return (area_above_elev, vol_above_elev)
+
+
+def get_vol_and_area_bins(ar_survey: np.array, ar_minimum: np.array, elev_pairs: List[Tuple[float, float]], cell_size: float) -> tuple:
+    """
+    Batched form of get_vol_and_area(). Takes a list of (lower, upper) elevation pairs,
+    either of which can be None, and calculates every pair from a single pass over the data.
+
+    Returns a tuple of arrays (area, volume, surveyvol, minsurfarea, minsurfvol, netminsurfvol)
+    with one value per elevation pair, in the same order as the tuple returned by get_vol_and_area().
+    """
+
+    return get_vol_and_area_bins_from_values(*get_valid_values(ar_survey, ar_minimum), elev_pairs, cell_size)
+
+
+def get_vol_and_area_bins_from_values(survey_values: np.array, min_values: np.array, elev_pairs: List[Tuple[float, float]], cell_size: float) -> tuple:
+    """
+    get_vol_and_area_bins() for flat arrays of valid survey and minimum surface values
+    (see get_valid_values() and get_valid_values_by_window()).
+    """
+
+    lower_elevs, upper_elevs = split_elev_pairs(elev_pairs)
+
+    # Only proceed and calculate the area and volume if the survey is not entirely masked.
+    if survey_values.size == 0:
+        return tuple(np.zeros(lower_elevs.shape) for __i in range(6))
+
+    survey_cumulative = get_cumulative_values(survey_values)
+    min_cumulative = get_cumulative_values(min_values)
+
+    # Missing lower elevations fall back to the lowest survey value
+    lower_elevs = np.where(np.isnan(lower_elevs), survey_cumulative[0][0], lower_elevs)
+
+    survey_lower_area, survey_lower_vol = get_above_elevs(*survey_cumulative, lower_elevs, cell_size)
+    min_lower_area, min_lower_vol = get_above_elevs(*min_cumulative, lower_elevs, cell_size)
+
+    # Missing (or zero) upper elevations mean there is nothing to subtract. That is the same
+    # as an upper elevation at the highest value in either surface, which nothing lies above.
+    top_elev = max(survey_cumulative[0][-1], min_cumulative[0][-1]) if min_values.size > 0 else survey_cumulative[0][-1]
+    no_upper = np.isnan(upper_elevs) | (upper_elevs == 0)
+    upper_elevs = np.where(no_upper, top_elev, upper_elevs)
+
+    survey_upper_area, survey_upper_vol = get_above_elevs(*survey_cumulative, upper_elevs, cell_size)
+    __min_upper_area, min_upper_vol = get_above_elevs(*min_cumulative, upper_elevs, cell_size)
+
+    survey_net_vol = survey_lower_vol - survey_upper_vol
+    min_surf_net_vol = min_lower_vol - min_upper_vol
+    net_volume = survey_net_vol - min_surf_net_vol
+
+    area = survey_lower_area - survey_upper_area
+
+    return (area, net_volume, survey_lower_vol, min_lower_area, min_lower_vol, min_surf_net_vol)
+
+
+def get_bin_areas(ar_survey: np.array, elev_pairs: List[Tuple[float, float]], cell_size: float) -> np.array:
+    """
+    Batched form of get_bin_area(). Takes a list of (lower, upper) elevation pairs,
+    either of which can be None, and returns an array of the area between each pair.
+    """
+
+    lower_elevs, upper_elevs = split_elev_pairs(elev_pairs)
+    survey_values, __min_values = get_valid_values(ar_survey, ar_survey)
+
+    if survey_values.size == 0:
+        return np.zeros(lower_elevs.shape)
+
+    survey_cumulative = get_cumulative_values(survey_values)
+
+    lower_elevs = np.where(np.isnan(lower_elevs), survey_cumulative[0][0], lower_elevs)
+    upper_elevs = np.where(np.isnan(upper_elevs) | (upper_elevs == 0), survey_cumulative[0][-1], upper_elevs)
+
+    lower_area, __lower_vol = get_above_elevs(*survey_cumulative, lower_elevs, cell_size)
+    upper_area, __upper_vol = get_above_elevs(*survey_cumulative, upper_elevs, cell_size)
+
+    return lower_area - upper_area
+
+
+def split_elev_pairs(elev_pairs: List[Tuple[float, float]]) -> Tuple[np.array, np.array]:
+    """
+    Validate a list of (lower, upper) elevation pairs and return them as two
+    float arrays with NaN in place of any missing (None) elevations.
+    """
+
+    for lower_elev, upper_elev in elev_pairs:
+        check_elevations(lower_elev, upper_elev)
+
+    ar_pairs = np.array(elev_pairs, dtype=np.float64).reshape(-1, 2)
+
+    return (ar_pairs[:, 0], ar_pairs[:, 1])
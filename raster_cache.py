@@ -0,0 +1,120 @@
+"""
+Process wide cache of decoded rasters
+
+The clipped section rasters get opened by more than one analysis stage
+(incremental and binned). The cache hands back the same decoded Raster
+to every stage instead of reading and decoding the GeoTIFF again.
+Rasters are keyed on their path and modification time and the least
+recently used ones are evicted to keep within a memory budget.
+
+Rasters handed out by the cache are shared so treat them as read only.
+"""
+import os
+from collections import OrderedDict
+from osgeo import gdal
+from raster import Raster
+from logger import Logger
+
+# Default memory budget for decoded rasters (MB)
+DEFAULT_BUDGET_MB = 1024.0
+
+
+class RasterCache:
+    """
+    LRU cache of decoded rasters with a memory budget
+    """
+
+    def __init__(self, budget_mb: float = DEFAULT_BUDGET_MB):
+        self.log = Logger('Raster Cache')
+        self.budget = int(budget_mb * 1024 * 1024)
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Absolute path: (modification time, raster, bytes). Oldest first
+        self.rasters = OrderedDict()
+
+    def set_budget(self, budget_mb: float) -> None:
+        """
+        Change the memory budget, evicting rasters if the cache is now over it
+        :param budget_mb: Memory budget (MB). Zero turns the cache off
+        """
+        self.budget = int(budget_mb * 1024 * 1024)
+        self._evict()
+
+    def get(self, raster_path: str) -> Raster:
+        """
+        The decoded raster at this path. It comes from the cache if the file hasn't changed
+        since it was last read. Rasters too big for the budget are not decoded at all and
+        come back metadata only, so that they get streamed instead.
+        :param raster_path: Path to the raster
+        """
+        key = os.path.abspath(raster_path)
+        mtime = os.path.getmtime(key)
+
+        cached = self.rasters.get(key)
+        if cached is not None and cached[0] == mtime:
+            self.hits += 1
+            self.rasters.move_to_end(key)
+            return cached[1]
+
+        self.misses += 1
+        if cached is not None:
+            # The file has been rewritten since it was cached
+            self._remove(key)
+
+        raster = Raster(filepath=raster_path, read_array=False)
+
+        # Decoded values with NaN for nodata. Integer rasters are decoded as float64
+        float_type = raster.data_type in (gdal.GDT_Float32, gdal.GDT_Float64)
+        size = raster.rows * raster.cols * (gdal.GetDataTypeSize(raster.data_type) // 8 if float_type else 8)
+        if size > self.budget:
+            self.log.debug(f'Raster too large to cache ({size / 1024 / 1024:.1f}MB): {raster_path}')
+            return raster
+
+        # Decode it now while it's going into the cache
+        size = raster.values.nbytes
+        self.rasters[key] = (mtime, raster, size)
+        self.used += size
+        self._evict()
+        return raster
+
+    def _remove(self, key: str) -> None:
+        __mtime, __raster, size = self.rasters.pop(key)
+        self.used -= size
+
+    def _evict(self) -> None:
+        """
+        Drop the least recently used rasters until the cache is within budget
+        """
+        while self.used > self.budget and len(self.rasters) > 0:
+            self._remove(next(iter(self.rasters)))
+            self.evictions += 1
+
+    def clear(self) -> None:
+        """
+        Empty the cache and reset the counts
+        """
+        self.rasters.clear()
+        self.used = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def report(self) -> None:
+        """
+        Log the hit and miss counts
+        """
+        self.log.info(f'{self.hits} hits, {self.misses} misses, {self.evictions} evictions. {len(self.rasters)} rasters ({self.used / 1024 / 1024:.1f}MB) cached')
+
+
+# The one cache shared by the whole process
+raster_cache = RasterCache()
+
+
+def get_raster(raster_path: str) -> Raster:
+    """
+    Shortcut for getting a raster from the process wide cache
+    """
+    return raster_cache.get(raster_path)
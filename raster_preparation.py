@@ -1,26 +1,23 @@
 """
 Build rasters from the CSV files
 """
-from typing import Dict
+from typing import Dict, List, NamedTuple, Tuple
 import os.path
+import traceback
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 from logger import Logger
+from raster import Raster
+from csv_lib import DEFAULT_POINTS_BUDGET_MB
 from sandbar_site import SandbarSite
 from computation_extents import ComputationExtents
+from clip_raster import ClipEngine, clear_clip_cache, DEFAULT_WARP_THREADS
 
 
-def raster_preparation(
-        sites: Dict[int, SandbarSite],
-        analysis_folder: str,
-        csv_cell_size: float,
-        raster_cell_size: float,
-        resample_method: str,
-        epsg: int,
-        reuse_rasters: bool,
-        gdal_warp: str,
-        comp_extent: ComputationExtents) -> None:
+class RasterPrepSettings(NamedTuple):
     """
-    Build rasters from the CSV files
-    :param sites: Dictionary of all SandbarSite objects to be processed.
+    Settings for building and clipping the rasters of every site. They are sent to
+    the worker processes that prepare sites in parallel so they must stay picklable.
     :param analysis_folder: The path to the output folder
     :param csv_cell_size: The cell size of the CSV files (m)
     :param raster_cell_size: The cell size of the output rasters (m)
@@ -28,32 +25,135 @@ def raster_preparation(
     :param epsg: The spatial reference code of the output rasters
     :param reuse_rasters: If True, existing rasters will be used if they exist
     :param gdal_warp: The path to the GDAL Warp executable
-    :param section_types: The list of section types to process
-    :param comp_extent_shp: The path to the computation extent shapefile
+    :param comp_extent: The computation extent polygons of every site
+    :param resample_engine: The Raster.ResampleEngine used for the linear, cubic and nearest resample methods
+    :param block_valid_fraction: Fraction of valid cells required in each block by the block resample methods
+    :param geotiff_profile: (driver, creation options) from raster.geotiff_profile() used to write every raster
+    :param points_budget_mb: Memory budget for the parsed survey points shared between validation, extents and gridding (MB)
+    :param parse_workers: Number of survey points files of a site parsed in parallel
+    :param points_cache_dir: Folder where parsed survey points are cached as binary arrays. None to always parse the text
+    :param plausible_margin: Survey points further than this outside the site's computation extent polygons make the survey invalid (m). None to skip this check
+    :param point_aggregation: Raster.PointAggregation used for cells with more than one survey point
+    :param site_workers: Number of sites prepared in parallel, each in its own process
+    :param survey_workers: Number of surveys of a site gridded in parallel threads
+    :param survey_stack: Stack each site's survey DEMs and reduce the stack to the minimum and maximum surfaces
+    :param clip_engine: ClipEngine used to clip the DEMs to the computation extent polygons
+    :param warp_threads: Number of threads each gdal.Warp uses with the API clip engine. None for all the
+        cores when sites are prepared one at a time and 1 when they are prepared in parallel processes
+    """
+    analysis_folder: str
+    csv_cell_size: float
+    raster_cell_size: float
+    resample_method: str
+    epsg: int
+    reuse_rasters: bool
+    gdal_warp: str
+    comp_extent: ComputationExtents
+    resample_engine: str = Raster.ResampleEngine.GRIDDATA
+    block_valid_fraction: float = 0.5
+    geotiff_profile: Tuple[str, List[str]] = None
+    points_budget_mb: float = DEFAULT_POINTS_BUDGET_MB
+    parse_workers: int = 1
+    points_cache_dir: str = None
+    plausible_margin: float = None
+    point_aggregation: str = Raster.PointAggregation.LAST
+    site_workers: int = 1
+    survey_workers: int = 1
+    survey_stack: bool = False
+    clip_engine: str = ClipEngine.MASK
+    warp_threads: int = None
+
+
+def raster_preparation(sites: Dict[int, SandbarSite], settings: RasterPrepSettings) -> None:
+    """
+    Build rasters from the CSV files
+    :param sites: Dictionary of all SandbarSite objects to be processed.
+    :param settings: RasterPrepSettings shared by every site
     :return: None"""
 
     log = Logger('Raster Prep')
+    parallel_sites = settings.site_workers > 1 and len(sites) > 1
+    if settings.warp_threads is None:
+        # Don't let every site process warp with every core
+        settings = settings._replace(warp_threads=1 if parallel_sites else DEFAULT_WARP_THREADS)
+
+    if parallel_sites:
+        workers = min(settings.site_workers, len(sites))
+        log.info(f'Preparing {len(sites)} sites across {workers} processes...')
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Results come back in site order so each site's messages are logged together
+            for site, (outputs, records, error) in zip(sites.values(), executor.map(_prepare_site_in_worker, sites.values(), repeat(settings))):
+                log.replay(records)
+                if error is not None:
+                    raise error
+                site.apply_raster_outputs(outputs)
+    else:
+        for site in sites.values():
+            prepare_site(site, settings)
+
+    log.info(f'Raster preparation is complete for all {len(sites)} sites.')
+
+
+def prepare_site(site: SandbarSite, settings: RasterPrepSettings) -> None:
+    """
+    Build the DEM rasters for one site and clip them to its sections
+    :param site: The site to prepare
+    :param settings: RasterPrepSettings with the warp threads already resolved (see raster_preparation)
+    """
+
+    log = Logger('Raster Prep')
+    log.info(f'Site {site.site_code5}: Starting raster preparation...')
 
-    for site in sites.values():
+    # Verify that ALL text files for all surveys at this site are correctly formatted.
+    # Each file is parsed once here and the points are reused to build the rasters.
+    site.points.set_budget(settings.points_budget_mb)
+    site.points.workers = settings.parse_workers
+    site.points.cache_dir = settings.points_cache_dir
+    plausible_extent = None
+    if settings.plausible_margin is not None:
+        plausible_extent = settings.comp_extent.get_site_extent(site.site_code5, settings.plausible_margin)
+    site.verify_txt_file_format(plausible_extent)
 
-        log.info(f'Site {site.site_code5}: Starting raster preparation...')
+    # Skip the site if it failed to find computational extent
+    if site.ignore:
+        site.points.clear()
+        return
 
-        # Verify that ALL text files for all surveys at this site are correctly formatted
-        site.verify_txt_file_format()
+    # Make a subfolder in the output workspace for this survey
+    survey_folder = os.path.join(settings.analysis_folder, site.site_code5)
+    if not os.path.exists(survey_folder):
+        os.makedirs(survey_folder)
 
-        # Skip the site if it failed to find computational extent
-        if site.ignore:
-            continue
+    assert os.path.exists(survey_folder), f'Failed to generate output folder for site {site.site_code5} at {survey_folder}'
 
-        # Make a subfolder in the output workspace for this survey
-        survey_folder = os.path.join(analysis_folder, site.site_code5)
-        if not os.path.exists(survey_folder):
-            os.makedirs(survey_folder)
+    # Convert the TXT files to GeoTIFFs
+    site.generate_dem_rasters(survey_folder, settings.csv_cell_size, settings.raster_cell_size, settings.resample_method, settings.epsg,
+                              settings.reuse_rasters, settings.resample_engine, settings.block_valid_fraction, settings.geotiff_profile,
+                              settings.point_aggregation, settings.survey_workers, settings.survey_stack)
+    site.clip_dem_rasters_to_sections(settings.gdal_warp, survey_folder, settings.comp_extent, settings.reuse_rasters, settings.geotiff_profile,
+                                      settings.clip_engine, settings.warp_threads)
 
-        assert os.path.exists(survey_folder), f'Failed to generate output folder for site {site.site_code5} at {survey_folder}'
+    # Free the points, survey stack and clipping masks before moving on to the next site
+    site.points.clear()
+    clear_clip_cache()
+    if site.survey_stack is not None:
+        site.survey_stack.close()
+        site.survey_stack = None
 
-        # Convert the TXT files to GeoTIFFs
-        site.generate_dem_rasters(survey_folder, csv_cell_size, raster_cell_size, resample_method, epsg, reuse_rasters)
-        site.clip_dem_rasters_to_sections(gdal_warp, survey_folder, comp_extent, reuse_rasters)
 
-    log.info(f'Raster preparation is complete for all {len(sites)} sites.')
+def _prepare_site_in_worker(site: SandbarSite, settings: RasterPrepSettings) -> tuple:
+    """
+    Prepare one site in a worker process. The site is a copy so the paths of the rasters it
+    produces are handed back, along with the log messages, for the main process to apply.
+    The traceback of an exception doesn't survive being sent back so it goes in the log messages.
+    :return: (raster outputs, log messages, exception or None)
+    """
+
+    log = Logger('Raster Prep')
+    log.start_buffer()
+    try:
+        prepare_site(site, settings)
+        return site.raster_outputs(), log.take_buffer(), None
+    except Exception as ex:
+        log.error(f'Site {site.site_code5}: Raster preparation failed in worker process {os.getpid()}\n{traceback.format_exc()}')
+        return None, log.take_buffer(), ex
@@ -3,15 +3,20 @@ Class defining a sandbar site
 """
 import re
 import os
-from typing import Dict
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Tuple
 from math import ceil, isnan
 from datetime import datetime
 from osgeo import ogr
 import numpy as np
-from raster import Raster
-from csv_lib import union_csv_extents
+from raster import Raster, DEM_DTYPE
+from survey_stack import SurveyStack
+from build_cache import BuildManifest, build_key
+from csv_lib import union_csv_extents, validate_points, load_points, PointCloudLoader, PointsFormatError
 from logger import Logger
-from clip_raster import clip_raster
+from clip_raster import clip_raster, mask_raster, ClipEngine, DEFAULT_WARP_THREADS
 from sandbar_survey import SandbarSurvey, get_file_insensitive
 from sandbar_survey_section import SandbarSurveySection
 from computation_extents import ComputationExtents, SITE_CODE_FIELD
@@ -43,6 +48,12 @@ class SandbarSite:
         self.max_surface_path = ''  # populated by GenerateDEMRasters()
         self.max_surface = None
 
+        # Optional stack of every survey DEM on the union grid. populated by GenerateDEMRasters()
+        self.survey_stack = None
+
+        # Parses each survey points file once for validation, extents and gridding
+        self.points = PointCloudLoader()
+
         # This is set to true if issues occur with the site and it can't be processed.
         self.ignore = False
 
@@ -82,7 +93,10 @@ class SandbarSite:
         the_match = re.search('[0]*([0-9]+)', self.site_code)
         return the_match.group(1) if the_match else None
 
-    def generate_dem_rasters(self, survey_folder: str, csv_cell_size: float, cell_size: float, resample_method: str, epsg, reuse_rasters: bool) -> None:
+    def generate_dem_rasters(self, survey_folder: str, csv_cell_size: float, cell_size: float, resample_method: str, epsg, reuse_rasters: bool,
+                             resample_engine: str = Raster.ResampleEngine.GRIDDATA, block_valid_fraction: float = 0.5,
+                             geotiff_profile: Tuple[str, List[str]] = None, point_aggregation: str = Raster.PointAggregation.LAST,
+                             survey_workers: int = 1, survey_stack: bool = False) -> None:
         """
         :param dirSurveyFolder:
         :param fCSVCellSize:
@@ -90,7 +104,13 @@ class SandbarSite:
         :param resampleMethod:
         :param theExtent:
         :param nEPSG:
-        :param bReUseRasters:
+        :param bReUseRasters: Reuse DEMs whose points file and settings haven't changed since they were built (see build_cache)
+        :param resample_engine:
+        :param block_valid_fraction:
+        :param geotiff_profile: (driver, creation options) used to write the rasters
+        :param point_aggregation: Raster.PointAggregation used for cells with more than one survey point
+        :param survey_workers: Number of surveys gridded, resampled and written at the same time
+        :param survey_stack: Keep every survey DEM in a SurveyStack and reduce the stack to the minimum and maximum surfaces
         :return:
         """
         dem_folder = os.path.join(survey_folder, 'DEMs_Unclipped')
@@ -103,7 +123,7 @@ class SandbarSite:
 
         # Retrieve the union of all TXT files for this site
         csv_files = [site_survey.points_path for site_survey in self.surveys.values()]
-        the_extent = union_csv_extents(csv_files, cell_size=csv_cell_size, padding=10.0)
+        the_extent = union_csv_extents(csv_files, cell_size=csv_cell_size, padding=10.0, loader=self.points)
         self.log.info(f'Site {self.site_code5}: Unioned extent for {len(self.surveys)} surveys is {the_extent}')
 
         # Create a temporary template raster object we can resample
@@ -113,73 +133,163 @@ class SandbarSite:
         # Initialize the Minimum Surface Raster and give it an array of appropriate size
         self.min_surface_path = os.path.join(survey_folder, f'{self.site_code5}_min_surface.tif')
         self.min_surface = Raster(proj=epsg, extent=the_extent, cellWidth=cell_size)
-        self.min_surface.set_array(np.nan * np.empty((self.min_surface.rows, self.min_surface.cols)))
+        self.min_surface.set_array(np.full((self.min_surface.rows, self.min_surface.cols), np.nan, dtype=DEM_DTYPE))
 
         # Initialize the Maximum Surface Raster and give it an array of appropriate size
         self.max_surface_path = os.path.join(survey_folder, f'{self.site_code5}_max_surface.tif')
         self.max_surface = Raster(proj=epsg, extent=the_extent, cellWidth=cell_size)
-        self.max_surface.set_array(np.nan * np.empty((self.max_surface.rows, self.max_surface.cols)))
+        self.max_surface.set_array(np.full((self.max_surface.rows, self.max_surface.cols), np.nan, dtype=DEM_DTYPE))
+
+        # Everything other than the points file that goes into a DEM
+        manifest = BuildManifest(survey_folder)
+        dem_settings = (csv_cell_size, cell_size, resample_method, resample_engine, block_valid_fraction, point_aggregation, the_extent, epsg, geotiff_profile)
+        dem_keys = {survey_key: build_key(manifest.file_digest(survey.points_path), dem_settings) for survey_key, survey in self.surveys.items()}
+
+        # The surveys that make up the surfaces and the grid they're on. Keys are strings to match the saved state
+        contributors = {str(survey_key): dem_keys[survey_key] for survey_key, survey in self.surveys.items() if survey.is_min_surface}
+        grid = json.loads(json.dumps({'extent': the_extent, 'cell_size': cell_size, 'epsg': epsg, 'geotiff_profile': geotiff_profile}, default=str))
+        fold_keys = self._load_surfaces(manifest.state('surfaces'), grid, contributors) if reuse_rasters else None
+        if fold_keys is None:
+            fold_keys = [survey_key for survey_key, survey in self.surveys.items() if survey.is_min_surface]
 
-        for survey in self.surveys.values():
+        if survey_stack:
+            self.survey_stack = SurveyStack(list(self.surveys), self.min_surface.rows, self.min_surface.cols, folder=survey_folder)
+
+        # The point loader isn't thread safe so the survey threads take turns with it.
+        # Only the lookup is locked. Points that have been evicted are parsed again outside the lock
+        points_lock = threading.Lock()
+
+        def build_dem(survey_key, survey: SandbarSurvey) -> Raster:
+            """
+            Grid, resample and write the DEM for one survey
+            :return: The DEM
+            """
 
             survey.dem_path = os.path.join(dem_folder, f'{self.site_code5}_{survey.survey_date:%Y%m%d}_dem.tif')
+            dem_key = dem_keys[survey_key]
 
-            # option to skip that speeds up debugging
-            if os.path.isfile(survey.dem_path) and reuse_rasters:
+            # Only reuse a DEM built from the same points and settings. Its values are only
+            # read if it's folded into the surfaces or goes into the survey stack
+            if reuse_rasters and manifest.is_current(survey.dem_path, dem_key):
                 self.log.info(f'Reusing existing raster at {survey.dem_path}')
-                continue
+                return Raster(filepath=survey.dem_path, read_array=False)
+
+            # Gridding is the last use of the points so the loader stops holding them
+            with points_lock:
+                points = self.points.take(survey.points_path)
+            if points is None:
+                points = load_points(survey.points_path, self.points.delimiter, self.points.cache_dir)
 
             # Create a raster object that will represent the raw CSV
             dem_raster = Raster(proj=epsg, extent=the_extent, cellWidth=csv_cell_size)
             # This function will add the array in-place to the raster object
-            dem_raster.load_dem_from_csv(survey.points_path, the_extent)
+            dem_raster.load_dem_from_csv(survey.points_path, the_extent, points=points, aggregation=point_aggregation)
+            del points
 
             if csv_cell_size != cell_size:
                 # This method resamples the array and returns a new raster object
-                new_dem = dem_raster.resample_dem(cell_size, resample_method)
-
-                # Only incorporate the DEM into the analysis if required
-                if survey.is_min_surface:
-                    self.min_surface.merge_min_surface(new_dem)
-                    self.max_surface.merge_max_surface(new_dem)
+                dem_raster = dem_raster.resample_dem(cell_size, resample_method, resample_engine, block_valid_fraction)
 
-                new_dem.write(survey.dem_path)
-            else:
-                # No resample necessary.
-
-                # Only incorporate the DEM into the analysis if required
-                if survey.is_min_surface:
-                    self.min_surface.merge_min_surface(dem_raster)
-                    self.max_surface.merge_max_surface(dem_raster)
+            dem_raster.write(survey.dem_path, profile=geotiff_profile)
+            assert os.path.isfile(survey.dem_path), f'Failed to generate raster for site {self.site_code5} at {survey.dem_path}'
+            manifest.record(survey.dem_path, dem_key)
+            return dem_raster
+
+        def merge(survey_key, dem_raster: Raster) -> None:
+            if self.survey_stack is not None:
+                self.survey_stack.set(survey_key, dem_raster.values)
+            elif survey_key in fold_keys:
+                # Only incorporate the DEM into the analysis if required.
+                # fmin and fmax don't depend on the order the surveys are merged in
+                self.min_surface.merge_min_surface(dem_raster)
+                self.max_surface.merge_max_surface(dem_raster)
+
+        if survey_workers > 1 and len(self.surveys) > 1:
+            with ThreadPoolExecutor(max_workers=survey_workers) as executor:
+                futures = {executor.submit(build_dem, survey_key, survey): survey_key for survey_key, survey in self.surveys.items()}
+                for future in as_completed(futures):
+                    merge(futures[future], future.result())
+        else:
+            for survey_key, survey in self.surveys.items():
+                merge(survey_key, build_dem(survey_key, survey))
 
-                # Write the raw DEM object
-                dem_raster.write(survey.dem_path)
+        if self.survey_stack is not None:
+            if len(fold_keys) > 0:
+                # One reduction over the surveys that go into the surfaces
+                self.min_surface.set_array(np.fmin(self.min_surface.values, self.survey_stack.min_surface(fold_keys)))
+                self.max_surface.set_array(np.fmax(self.max_surface.values, self.survey_stack.max_surface(fold_keys)))
 
-            assert os.path.isfile(survey.dem_path), f'Failed to generate raster for site {self.site_code5} at {survey.dem_path}'
+            for survey_key, (the_min, the_max, count, __sum) in self.survey_stack.statistics().items():
+                self.log.debug(f'Site {self.site_code5}: Survey {self.surveys[survey_key].survey_date:%Y-%m-%d} has {count} cells from {the_min} to {the_max}')
 
         # write the minimum and maximum surfaces raster to file
         assert self.min_surface is not None, f'Error generating minimum surface raster for site {self.site_code5}'
-        self.min_surface.write(self.min_surface_path)
+        self.min_surface.write(self.min_surface_path, profile=geotiff_profile)
 
         assert self.max_surface is not None, f'Error generating maximum surface raster for site {self.site_code5}'
-        self.max_surface.write(self.max_surface_path)
+        self.max_surface.write(self.max_surface_path, profile=geotiff_profile)
 
         assert os.path.isfile(self.min_surface_path), f'Minimum surface raster is missing for site {self.site_code5} at {self.min_surface_path}'
         assert os.path.isfile(self.max_surface_path), f'Maximum surface raster is missing for site {self.site_code5} at {self.max_surface_path}'
 
-    def clip_dem_rasters_to_sections(self, gdal_warp: str, survey_folder: str, comp_extent: ComputationExtents, reuse_rasters: bool) -> None:
+        # Remember what went into the surfaces so the next run only has to fold in new surveys
+        manifest.set_state('surfaces', {'grid': grid, 'surveys': contributors})
+        manifest.save()
+
+    def _load_surfaces(self, previous: dict, grid: dict, contributors: Dict[str, str]) -> list:
+        """
+        Start from the minimum and maximum surfaces written by an earlier run, if they can be.
+        That needs the same grid and every survey that went into them must still go in, unchanged.
+        :param previous: The grid and contributing surveys saved with the surfaces (see generate_dem_rasters)
+        :param grid: The grid definition of this run
+        :param contributors: Survey key (as a string): DEM build key of the surveys that go into the surfaces this run
+        :return: The keys of the surveys still to fold into the surfaces, or None if they have to be built from scratch
+        """
+        if previous is None or not (os.path.isfile(self.min_surface_path) and os.path.isfile(self.max_surface_path)):
+            return None
+
+        if previous['grid'] != grid:
+            self.log.info(f'Site {self.site_code5}: The extent or grid has changed since the surfaces were built. Rebuilding them from every survey.')
+            return None
+
+        if any(contributors.get(survey_key) != dem_key for survey_key, dem_key in previous['surveys'].items()):
+            self.log.info(f'Site {self.site_code5}: Surveys in the surfaces have changed or been removed. Rebuilding them from every survey.')
+            return None
+
+        previous_min = Raster(filepath=self.min_surface_path)
+        previous_max = Raster(filepath=self.max_surface_path)
+        if (previous_min.rows, previous_min.cols) != (self.min_surface.rows, self.min_surface.cols) or (previous_max.rows, previous_max.cols) != (self.max_surface.rows, self.max_surface.cols):
+            return None
+
+        self.min_surface.set_array(previous_min.values, True)
+        self.max_surface.set_array(previous_max.values, True)
+
+        fold_keys = [survey_key for survey_key, survey in self.surveys.items() if survey.is_min_surface and str(survey_key) not in previous['surveys']]
+        self.log.info(f'Site {self.site_code5}: Reusing the existing surfaces and folding in {len(fold_keys)} new surveys')
+        return fold_keys
+
+    def clip_dem_rasters_to_sections(self, gdal_warp: str, survey_folder: str, comp_extent: ComputationExtents, reuse_rasters: bool,
+                                     geotiff_profile: Tuple[str, List[str]] = None, clip_engine: str = ClipEngine.MASK,
+                                     warp_threads=DEFAULT_WARP_THREADS) -> None:
         """
         :param gdal_warp:
         :param dirSurveyFolder:
         :param dSections:
         :param theCompExtent:
-        :param bResUseRasters:
+        :param bResUseRasters: Reuse clipped rasters whose DEM, polygons and settings haven't changed since they were built (see build_cache)
+        :param geotiff_profile: (driver, creation options) used to write the clipped rasters
+        :param clip_engine: ClipEngine to clip with
+        :param warp_threads: Number of threads each gdal.Warp uses with the API engine, or 'ALL_CPUS'
         :return:
         """
         clipped_count = 0
         sections_count = 0
+        manifest = BuildManifest(survey_folder)
+
+        for survey_key, survey in self.surveys.items():
+            # The mask engine opens each DEM once for all its sections, and only if one needs clipping
+            dem = None
 
-        for survey in self.surveys.values():
             for section in survey.surveyed_sections.values():
 
                 # Only attempt to produce clipped raster if the computational extent exists
@@ -198,36 +308,98 @@ class SandbarSite:
 
                 clipped_path = os.path.join(dem_folder, f'{self.site_code5}_{survey.survey_date:%Y%m%d}_{section_folder}_dem.tif')
 
-                # option to skip that speeds up debugging
-                if not (os.path.isfile(clipped_path) and reuse_rasters):
+                # Only reuse a clipped raster built from the same DEM, polygons and settings
+                clipped_key = build_key(manifest.recorded_key(survey.dem_path), comp_extent.get_section_digest(self.site_code5, section.section_type), geotiff_profile,
+                                        clip_engine)
+                if not (reuse_rasters and manifest.is_current(clipped_path, clipped_key)):
 
                     # This clause ensures that only the desired features are
                     # used for the clipping
                     where_clause = comp_extent.get_filter_clause(self.site_code5, section.section_type)
-                    clip_raster(gdal_warp, survey.dem_path, clipped_path, comp_extent.full_path, where_clause)
+                    if clip_engine == ClipEngine.MASK:
+                        if dem is None:
+                            dem = Raster(filepath=survey.dem_path, read_array=False)
+                            if self.survey_stack is not None:
+                                # Already decoded in the stack
+                                dem.values = self.survey_stack.get(survey_key)
+                        mask_raster(dem, clipped_path, comp_extent.full_path, where_clause, geotiff_profile)
+                    else:
+                        clip_raster(gdal_warp, survey.dem_path, clipped_path, comp_extent.full_path, where_clause, geotiff_profile, clip_engine,
+                                    warp_threads)
+                    manifest.record(clipped_path, clipped_key)
 
                 # Store the clipped raster in a dictionary on the survey date
                 # objects
                 section.raster_path = clipped_path
                 clipped_count += 1
 
+        manifest.save()
+
         self.log.info(f'Site {self.site_code5}: Clipped {clipped_count} rasters across {len(self.surveys)} surveys and {sections_count} sections defined')
 
-    def verify_txt_file_format(self):
+    def raster_outputs(self) -> dict:
+        """
+        The paths of the rasters produced by raster preparation, and whether the site or any
+        of its sections were ignored. Used to hand the results of preparing a copy of this site
+        in another process back to the original (see apply_raster_outputs).
+        """
+        return {
+            'ignore': self.ignore,
+            'min_surface_path': self.min_surface_path,
+            'max_surface_path': self.max_surface_path,
+            'surveys': {survey_key: (survey.dem_path, {section_key: (section.raster_path, section.ignore) for section_key, section in survey.surveyed_sections.items()})
+                        for survey_key, survey in self.surveys.items()}
+        }
+
+    def apply_raster_outputs(self, outputs: dict) -> None:
+        """
+        Take on the raster paths from raster_outputs. The minimum and maximum surfaces are opened
+        from the rasters that were written, ready for the analyses.
+        """
+        self.ignore = outputs['ignore']
+        self.min_surface_path = outputs['min_surface_path']
+        self.max_surface_path = outputs['max_surface_path']
+
+        for survey_key, (dem_path, sections) in outputs['surveys'].items():
+            survey = self.surveys[survey_key]
+            survey.dem_path = dem_path
+            for section_key, (raster_path, ignore) in sections.items():
+                survey.surveyed_sections[section_key].raster_path = raster_path
+                survey.surveyed_sections[section_key].ignore = ignore
+
+        if not self.ignore:
+            self.min_surface = Raster(filepath=self.min_surface_path)
+            self.max_surface = Raster(filepath=self.max_surface_path)
+
+    def verify_txt_file_format(self, plausible_extent: tuple = None):
         """
         Verify that the text files for all surveys at this site are correctly formatted
+        :param plausible_extent: (x_min, x_max, y_min, y_max) that every survey point must fall inside. None to skip this check
         """
 
+        # Parse the files in parallel up front when the loader has more than one worker
+        self.points.preload([survey_date.points_path for survey_date in self.surveys.values()])
+
         for survey_date in self.surveys.values():
-            # Opeen the text file and verify that it has the correct number of space-separated floating point values
-            with open(survey_date.points_path, 'r', encoding='utf8') as f:
-                the_match = re.match("^([0-9.]+\s){3}([0-9.]+)\s*$", f.readline())
-                if not the_match:
-                    self.log.warning(f'Site {self.site_code5}: The {survey_date.survey_date.strftime("%Y-%m-%d")} survey has an invalid text file format. Skipping loading surveys. This site will not be processed. {survey_date.points_path}')
-
-                    # Any one survey fails then the minimum surface could be incorrect. Abort this site.
-                    self.ignore = True
-                    return False
+            # Parse the text file and verify that every row has four space-separated, finite floating point
+            # values inside the plausible extent. The parsed points are kept by the loader for the extent and
+            # gridding steps that follow.
+            try:
+                points = self.points.get(survey_date.points_path)
+                problems = validate_points(points, plausible_extent)
+            except PointsFormatError as ex:
+                problems = ex.problems
+            except ValueError as ex:
+                problems = [str(ex)]
+
+            if len(problems) > 0:
+                self.log.warning(f'Site {self.site_code5}: The {survey_date.survey_date.strftime("%Y-%m-%d")} survey has an invalid text file format. Skipping loading surveys. This site will not be processed. {survey_date.points_path}')
+                for problem in problems:
+                    self.log.warning(f'    {problem}')
+
+                # Any one survey fails then the minimum surface could be incorrect. Abort this site.
+                self.ignore = True
+                return False
 
         # If got to here then all surveys validated
         return True
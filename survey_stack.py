@@ -0,0 +1,108 @@
+"""
+Stack of all the survey DEMs at a site
+
+Every survey at a site is gridded onto the same union grid, so the DEMs
+can be held as one (surveys x rows x cols) float32 array. The minimum and
+maximum surfaces and the per survey statistics are then each a single
+reduction over the stack instead of one merge per survey, and any survey
+can be read back out of the stack without reopening its GeoTIFF.
+
+Stacks that are too big for memory are backed by a temporary file and
+memory mapped. The reductions and statistics work through the stack one
+survey at a time so that only one layer of a memory mapped stack is ever
+read into memory at once.
+"""
+import os
+import tempfile
+from typing import Dict, List, Tuple
+import numpy as np
+from raster import DEM_DTYPE, valid_values, values_statistics
+from logger import Logger
+
+# Stacks bigger than this are memory mapped from a temporary file (MB)
+DEFAULT_MEMMAP_MB = 1024.0
+
+
+class SurveyStack:
+    """
+    (surveys x rows x cols) array of survey DEM values with NaN for nodata
+    """
+
+    def __init__(self, survey_keys: List, rows: int, cols: int, folder: str = None, memmap_mb: float = DEFAULT_MEMMAP_MB):
+        """
+        :param survey_keys: Key of each survey, in the order they are stacked
+        :param rows: Rows in the site's union grid
+        :param cols: Columns in the site's union grid
+        :param folder: Where the temporary file for a memory mapped stack goes. None for the system temp folder
+        :param memmap_mb: Stacks bigger than this are memory mapped (MB)
+        """
+        self.log = Logger('Survey Stack')
+        self.index = {key: i for i, key in enumerate(survey_keys)}
+        self.path = None
+
+        shape = (len(survey_keys), rows, cols)
+        size = int(np.prod(shape)) * np.dtype(DEM_DTYPE).itemsize
+        if size > memmap_mb * 1024 * 1024:
+            handle, self.path = tempfile.mkstemp(dir=folder, suffix='.stack')
+            os.close(handle)
+            self.values = np.memmap(self.path, dtype=DEM_DTYPE, mode='w+', shape=shape)
+            self.values[:] = np.nan
+            self.log.debug(f'Memory mapped {shape} survey stack ({size / 1024 / 1024:.1f}MB) at {self.path}')
+        else:
+            self.values = np.full(shape, np.nan, dtype=DEM_DTYPE)
+
+    def set(self, survey_key, values: np.array) -> None:
+        """
+        Put a survey's DEM values into the stack
+        """
+        self.values[self.index[survey_key]] = values
+
+    def get(self, survey_key) -> np.array:
+        """
+        A survey's DEM values. This is a view into the stack so treat it as read only
+        """
+        return self.values[self.index[survey_key]]
+
+    def _reduce(self, ufunc, survey_keys: List = None) -> np.array:
+        """
+        Fold the surveys into one surface a layer at a time
+        :param ufunc: np.fmin or np.fmax
+        """
+        indices = range(self.values.shape[0]) if survey_keys is None else [self.index[key] for key in survey_keys]
+        surface = np.full(self.values.shape[1:], np.nan, dtype=DEM_DTYPE)
+        for i in indices:
+            ufunc(surface, self.values[i], out=surface)
+        return surface
+
+    def min_surface(self, survey_keys: List = None) -> np.array:
+        """
+        The lowest elevation of any survey in each cell. NaN where no survey has a value
+        :param survey_keys: The surveys to include. None for all of them
+        """
+        return self._reduce(np.fmin, survey_keys)
+
+    def max_surface(self, survey_keys: List = None) -> np.array:
+        """
+        The highest elevation of any survey in each cell. NaN where no survey has a value
+        :param survey_keys: The surveys to include. None for all of them
+        """
+        return self._reduce(np.fmax, survey_keys)
+
+    def statistics(self) -> Dict[object, Tuple[float, float, int, float]]:
+        """
+        (min, max, valid count, sum) of every survey, the same as raster.values_statistics.
+        Min and max are NaN for a survey with no values.
+        """
+        return {key: values_statistics(valid_values(self.values[i])) for key, i in self.index.items()}
+
+    def close(self) -> None:
+        """
+        Release the stack, deleting its temporary file if it was memory mapped
+        """
+        self.values = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError as ex:
+                self.log.warning(f'Failed to delete the survey stack file {self.path}: {ex}')
+            self.path = None
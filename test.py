@@ -15,14 +15,24 @@
 import unittest
 from os import path, makedirs
 import shutil
-from osgeo import gdal
+import pickle
+from datetime import datetime
+from osgeo import gdal, ogr, osr
 import numpy as np
 
 # Here's what we're testing
 import raster_analysis
 from logger import Logger
-from raster import Raster, delete_raster
-from csv_lib import union_csv_extents
+from raster import Raster, delete_raster, geotiff_profile, unpack_valid_mask, grid_points, duplicate_statistics
+from raster_cache import RasterCache
+from survey_stack import SurveyStack
+from build_cache import BuildManifest, build_key
+from csv_lib import union_csv_extents, read_points, read_points_extent, validate_points, PointCloudLoader, PointsFormatError
+from sandbar_site import SandbarSite
+from sandbar_survey import SandbarSurvey
+from sandbar_survey_section import SandbarSurveySection
+from raster_preparation import _prepare_site_in_worker, RasterPrepSettings
+from clip_raster import clip_raster, mask_raster, feature_mask, clear_clip_cache, ClipEngine
 
 
 class TempPathHelper():
@@ -46,6 +56,20 @@ class TempPathHelper():
             shutil.rmtree(self.path)
 
 
+def make_site(points_files, min_surface=None) -> SandbarSite:
+    """
+    A site with one survey for each of the test grids, keyed 1, 2, 3... and a day apart
+    :param points_files: Names of the points files in test/assets/grids
+    :param min_surface: Whether each survey goes into the minimum surface. All of them if None
+    """
+    grids = path.join(path.dirname(path.abspath(__file__)), 'test', 'assets', 'grids')
+    site = SandbarSite('0001', '00001', 1, grids)
+    for idx, points_file in enumerate(points_files):
+        is_min_surface = min_surface[idx] if min_surface is not None else True
+        site.surveys[idx + 1] = SandbarSurvey(idx + 1, datetime(2020, 1, idx + 1), 0, 0, 0, path.join(grids, points_file), True, is_min_surface)
+    return site
+
+
 class TestLoggerSingletonClass(unittest.TestCase):
     """_summary_
 
@@ -122,6 +146,23 @@ class TestLoggerSingletonClass(unittest.TestCase):
         log.destroy()
         self.assertTrue(True)
 
+    def test_Buffer(self):
+        """
+        Messages from worker processes are held and then replayed in the main process
+        """
+        log = Logger('TestBuffer')
+        log.start_buffer()
+        log.info("Buffered message")
+        log.warning("Buffered warning", Exception("buffered exception"))
+        records = log.take_buffer()
+        self.assertEqual(records, [("Buffered message", 'TestBuffer', 'info', None),
+                                   ("Buffered warning", 'TestBuffer', 'warning', 'buffered exception')])
+        self.assertEqual(log.take_buffer(), [])
+        log.replay(records)
+
+        # Loggers survive being sent to another process
+        self.assertEqual(pickle.loads(pickle.dumps(log)).method, 'TestBuffer')
+
 
 class TestRasterClass(unittest.TestCase):
     """
@@ -206,6 +247,116 @@ class TestRasterClass(unittest.TestCase):
         delete_raster(filename2)
         tmp.destroy()
 
+    def test_MetadataOnlyOpen(self):
+        tmp = TempPathHelper()
+        filename = path.join(tmp.path, 'raster-metadata-only.tif')
+        in_ras = np.ma.masked_invalid([
+            [0.5, 1, np.nan, 3],
+            [np.nan, 12.0, 2, 3]])
+        Raster(array=in_ras, extent=(0, 0.4, 0, 0.2), cellWidth=0.1).write(filename)
+
+        r_full = Raster(filepath=filename)
+        r_lazy = Raster(filepath=filename, read_array=False)
+
+        # Nothing has been read yet but the metadata is all there
+        self.assertIsNone(r_lazy._values)
+        self.assertEqual((r_lazy.rows, r_lazy.cols), (r_full.rows, r_full.cols))
+        self.assertEqual(r_lazy.gt, r_full.gt)
+        self.assertEqual(r_lazy.min, 0.5)
+        self.assertEqual(r_lazy.max, 12.0)
+        self.assertIsNone(r_lazy._values)
+
+        # The pixels get read the first time the array is used
+        self.assertTrue((r_lazy.array == r_full.array).all())
+        self.assertTrue((r_lazy.array.mask == r_full.array.mask).all())
+
+        delete_raster(filename)
+        tmp.destroy()
+
+    def test_WriteStatistics(self):
+        tmp = TempPathHelper()
+        filename = path.join(tmp.path, 'raster-statistics.tif')
+        in_ras = np.ma.masked_invalid([
+            [0.5, 1, np.nan, 3],
+            [np.nan, 12.0, 2, 3.5]])
+        Raster(array=in_ras, extent=(0, 0.4, 0, 0.2), cellWidth=0.1).write(filename, histogram_bins=4)
+
+        src_ds = gdal.Open(filename)
+        band = src_ds.GetRasterBand(1)
+        self.assertEqual(float(band.GetMetadataItem('STATISTICS_MINIMUM')), 0.5)
+        self.assertEqual(float(band.GetMetadataItem('STATISTICS_MAXIMUM')), 12.0)
+        self.assertEqual(int(band.GetMetadataItem('STATISTICS_VALID_COUNT')), 6)
+        self.assertEqual(float(band.GetMetadataItem('STATISTICS_SUM')), 22.0)
+        self.assertEqual(list(band.GetDefaultHistogram(force=False)[3]), [5, 0, 0, 1])
+        band = None
+        src_ds = None
+
+        # Readers take the stored statistics
+        r_out = Raster(filepath=filename)
+        self.assertEqual((r_out.min, r_out.max), (0.5, 12.0))
+
+        delete_raster(filename)
+        tmp.destroy()
+
+    def test_GridPoints(self):
+        # Three points in cell (0, 1) and one in cell (1, 0)
+        rows = np.array([0, 0, 1, 0])
+        cols = np.array([1, 1, 0, 1])
+        z = np.array([5.0, 2.0, 7.0, 3.0])
+        expected = {
+            Raster.PointAggregation.LAST: 3.0,
+            Raster.PointAggregation.MEAN: 10.0 / 3,
+            Raster.PointAggregation.MIN: 2.0,
+            Raster.PointAggregation.MAX: 5.0,
+            Raster.PointAggregation.COUNT: 3.0
+        }
+        for aggregation, value in expected.items():
+            grid, counts = grid_points((2, 2), rows, cols, z, aggregation)
+            self.assertAlmostEqual(grid[0, 1], value, places=5)
+            self.assertEqual(grid[1, 0], 1.0 if aggregation == Raster.PointAggregation.COUNT else 7.0)
+            self.assertTrue(np.isnan(grid[0, 0]) and np.isnan(grid[1, 1]))
+
+        stats = duplicate_statistics(counts)
+        self.assertEqual((stats['cells'], stats['duplicate_cells'], stats['duplicate_points'], stats['max_points_per_cell']), (2, 1, 3, 3))
+        self.assertRaises(ValueError, grid_points, (2, 2), rows, cols, z, 'median')
+
+    def test_NaNValues(self):
+        # Masked cells become NaN in the plain float values and the masked array view matches the input
+        maskedArray = np.ma.masked_array([
+            [1.0, 2, 3],
+            [4, np.nan, 6]],
+            mask=np.array([
+                [0, 1, 0],
+                [0, 0, 0]]))
+        rTest = Raster(array=maskedArray, extent=(0, 3, 0, 2), cellWidth=1)
+
+        self.assertNotIsInstance(rTest.values, np.ma.MaskedArray)
+        self.assertTrue(np.array_equal(rTest.values, [[1.0, np.nan, 3], [4, np.nan, 6]], equal_nan=True))
+        self.assertTrue((rTest.array.mask == [[0, 1, 0], [0, 1, 0]]).all())
+        self.assertTrue((rTest.array == maskedArray).all())
+        self.assertEqual((rTest.min, rTest.max), (1.0, 6.0))
+
+        # The input array is left alone
+        self.assertEqual(maskedArray.data[0, 1], 2.0)
+
+        packed = rTest.packed_valid_mask()
+        self.assertEqual(packed.nbytes, 1)
+        self.assertTrue((unpack_valid_mask(packed, (2, 3)) == ~np.isnan(rTest.values)).all())
+
+    def test_GeoTIFFProfile(self):
+        self.assertEqual(geotiff_profile('legacy'), ('GTiff', ['COMPRESS=LZW']))
+
+        driver_name, options = geotiff_profile('deflate', 'ZLEVEL=9 NUM_THREADS=2 BIGTIFF=YES')
+        self.assertEqual(driver_name, 'GTiff')
+        self.assertIn('ZLEVEL=9', options)
+        self.assertNotIn('ZLEVEL=6', options)
+        self.assertIn('NUM_THREADS=2', options)
+        self.assertIn('BIGTIFF=YES', options)
+        self.assertIn('PREDICTOR=3', options)
+
+        self.assertEqual(geotiff_profile('cog')[0], 'COG')
+        self.assertRaises(ValueError, geotiff_profile, 'jpeg')
+
     def test_SetArray(self):
         cellSize = 1
         theExtent = (0, 3, 10, 12)
@@ -419,6 +570,425 @@ class TestRasterClass(unittest.TestCase):
         # We have no test for this so it should always fail
         self.assertTrue(False)
 
+    def test_ResampleRegularEngine(self):
+        """
+        Validate the regular grid resample engine against the griddata engine
+        on a real survey grid. The two engines don't pick the same neighbour when
+        a new cell is equidistant from old cells and the triangulation used by
+        griddata is not quite bilinear, so compare within tolerances.
+        """
+        gridPath = path.join(path.dirname(path.abspath(
+            __file__)), 'test', 'assets', 'grids', 'realgrid.txt')
+        theExtent = union_csv_extents([gridPath], cell_size=1.0, padding=10.0)
+        rTest = Raster(extent=theExtent, cellWidth=1.0)
+        rTest.load_dem_from_csv(gridPath, theExtent)
+
+        for method in ['nearest', 'linear']:
+            rGriddata = rTest.resample_dem(0.5, method, Raster.ResampleEngine.GRIDDATA)
+            rRegular = rTest.resample_dem(0.5, method, Raster.ResampleEngine.REGULAR)
+            self.assertEqual(rGriddata.array.shape, rRegular.array.shape)
+
+            maskGriddata = np.ma.getmaskarray(rGriddata.array)
+            maskRegular = np.ma.getmaskarray(rRegular.array)
+            self.assertGreater((maskGriddata == maskRegular).mean(), 0.99)
+
+            both = ~maskGriddata & ~maskRegular
+            if method == 'nearest':
+                # Nearest neighbour must only ever return original values
+                self.assertTrue(np.isin(rRegular.array.compressed(), rTest.array.compressed()).all())
+            else:
+                diff = np.abs(rGriddata.array.data - rRegular.array.data)[both]
+                self.assertLess(np.percentile(diff, 99), 0.05)
+
+
+    def test_ResampleBlock(self):
+        """
+        Integer factor block resampling. The bottom and right edges are padded
+        with nodata so blocks there need at least half their cells valid.
+        """
+        theTestArray = np.ma.masked_invalid([
+            [1.0, 2, 3, 4, 5],
+            [5, 6, 7, np.nan, 9],
+            [9, 10, np.nan, np.nan, 13]])
+        rTest = Raster(array=theTestArray, extent=(0, 5, 0, 3), cellWidth=1)
+
+        expected = {
+            'block_mean': [[3.5, 14.0 / 3.0, 7.0], [9.5, np.nan, np.nan]],
+            'block_min': [[1.0, 3.0, 5.0], [9.0, np.nan, np.nan]],
+            'block_max': [[6.0, 7.0, 9.0], [10.0, np.nan, np.nan]]
+        }
+
+        for method, expectedArray in expected.items():
+            rBlock = rTest.resample_dem(2.0, method)
+            self.assertEqual(rBlock.cell_width, 2.0)
+            self.assertTrue(np.allclose(rBlock.array.filled(np.nan), expectedArray, equal_nan=True))
+
+        # Upsampling replicates each cell into a block
+        rUp = rTest.resample_dem(0.5, 'block_mean')
+        self.assertEqual(rUp.array.shape, (6, 10))
+        self.assertTrue(np.array_equal(rUp.array.filled(np.nan)[::2, ::2], theTestArray.filled(np.nan), equal_nan=True))
+
+        # Non integer factors are not allowed
+        with self.assertRaises(ValueError):
+            rTest.resample_dem(1.5, 'block_mean')
+
+    def test_ResampleFloat32(self):
+        # Resampled DEMs are held in float32, the same as the rasters on disk
+        rTest = Raster(array=np.ma.masked_invalid(np.arange(20.0).reshape(4, 5)), extent=(0, 5, 0, 4), cellWidth=1)
+        for method in ['bilinear', 'nearest', 'block_mean']:
+            self.assertEqual(rTest.resample_dem(0.5, method).array.dtype, np.float32)
+
+
+class TestRasterCache(unittest.TestCase):
+
+    def test_HitsMissesAndEviction(self):
+        tmp = TempPathHelper()
+        filename1 = path.join(tmp.path, 'cache1.tif')
+        filename2 = path.join(tmp.path, 'cache2.tif')
+        in_ras = np.ma.masked_invalid([
+            [0.5, 1, np.nan, 3],
+            [np.nan, 12.0, 2, 3.5]])
+        Raster(array=in_ras, extent=(0, 0.4, 0, 0.2), cellWidth=0.1).write(filename1)
+        Raster(array=in_ras, extent=(0, 0.4, 0, 0.2), cellWidth=0.1).write(filename2)
+
+        # Room for exactly one of the rasters: 8 cells of 4 byte values
+        cache = RasterCache(budget_mb=32.0 / 1024 / 1024)
+        first = cache.get(filename1)
+        self.assertIs(cache.get(filename1), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertTrue((first.array == in_ras).all())
+
+        # Least recently used raster gets evicted
+        cache.get(filename2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNot(cache.get(filename1), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+        # Too big for the budget so it comes back metadata only
+        cache.set_budget(0)
+        self.assertIsNone(cache.get(filename1)._values)
+
+        delete_raster(filename1)
+        delete_raster(filename2)
+        tmp.destroy()
+
+
+class TestPointCloudLoader(unittest.TestCase):
+
+    def setUp(self):
+        gridsFolder = path.join(path.dirname(path.abspath(__file__)), 'test', 'assets', 'grids')
+        self.gridPath1 = path.join(gridsFolder, 'grid1.txt')
+        self.gridPath2 = path.join(gridsFolder, 'grid2.txt')
+
+    def test_ParseOnce(self):
+        loader = PointCloudLoader()
+        theExtent = union_csv_extents([self.gridPath1, self.gridPath2], cell_size=1.0, padding=10.0, loader=loader)
+        self.assertEqual(theExtent, union_csv_extents([self.gridPath1, self.gridPath2], cell_size=1.0, padding=10.0))
+
+        # Gridding reuses the points parsed for the extent
+        points = loader.get(self.gridPath1)
+        self.assertEqual(loader.parse_count, 2)
+        self.assertEqual(points.shape[1], 4)
+
+        rShared = Raster(extent=theExtent, cellWidth=1.0)
+        rShared.load_dem_from_csv(self.gridPath1, theExtent, points=points)
+        rParsed = Raster(extent=theExtent, cellWidth=1.0)
+        rParsed.load_dem_from_csv(self.gridPath1, theExtent)
+        self.assertTrue(np.array_equal(rShared.values, rParsed.values, equal_nan=True))
+
+    def test_Budget(self):
+        # Nothing fits so every file is parsed and dropped but the extents are kept
+        loader = PointCloudLoader(budget_mb=0)
+        loader.get(self.gridPath1)
+        self.assertEqual((loader.used, len(loader.points)), (0, 0))
+        loader.extent(self.gridPath1)
+        self.assertEqual(loader.parse_count, 1)
+
+    def test_StreamedExtent(self):
+        # Files too big for the budget are streamed in blocks for their extent and never held
+        loader = PointCloudLoader(budget_mb=0, workers=2)
+        theExtent = loader.union_extent([self.gridPath1, self.gridPath2])
+        self.assertEqual((loader.parse_count, len(loader.points)), (0, 0))
+
+        points = np.concatenate([np.loadtxt(self.gridPath1, ndmin=2), np.loadtxt(self.gridPath2, ndmin=2)])
+        self.assertEqual(theExtent, (points[:, 1].min(), points[:, 1].max(), points[:, 2].min(), points[:, 2].max()))
+        self.assertEqual(read_points_extent(self.gridPath1, chunk_bytes=37), loader.extent(self.gridPath1))
+
+    def test_ReadPoints(self):
+        # Small blocks split lines across reads
+        for chunk_bytes in [37, 1024 * 1024]:
+            points = read_points(self.gridPath1, chunk_bytes=chunk_bytes)
+            self.assertTrue(np.array_equal(points, np.loadtxt(self.gridPath1, ndmin=2)))
+
+        # Lines that aren't fixed width fall back to the general parser
+        tmp = TempPathHelper()
+        filename = path.join(tmp.path, 'points.txt')
+        with open(filename, 'w') as f:
+            f.write('1 2.5 3 -4\n10 2 3.25 4\n11 1e3 3 4')
+        self.assertTrue(np.array_equal(read_points(filename, chunk_bytes=8), [[1, 2.5, 3, -4], [10, 2, 3.25, 4], [11, 1000, 3, 4]]))
+
+        with open(filename, 'w') as f:
+            f.write('1 2 3 4\n1 2 x 4\n')
+        self.assertRaises(ValueError, read_points, filename)
+        tmp.destroy()
+
+    def test_ValidatePoints(self):
+        # Problems are reported with the line they are on, even several blocks into the file
+        tmp = TempPathHelper()
+        filename = path.join(tmp.path, 'points.txt')
+        with open(filename, 'w') as f:
+            f.write('1 2.5 3.5 4.5\n' * 5 + '6 2.5 3.5\n7 2.5 3.5 4.5\n8 2.5 3.5 z\n')
+        with self.assertRaises(PointsFormatError) as context:
+            read_points(filename, chunk_bytes=30)
+        self.assertEqual(context.exception.problems, ['Line 6: expected 4 values but found 3', "Line 8: 'z' is not a number"])
+        tmp.destroy()
+
+        points = np.loadtxt(self.gridPath1, ndmin=2)
+        self.assertEqual(validate_points(points), [])
+        self.assertEqual(len(validate_points(points, plausible_extent=(0, 0, 0, 0))), 10)
+        self.assertEqual(validate_points(points[:, :3]), ['Expected 4 values per line but found 3'])
+
+        points[2, 3] = np.nan
+        self.assertEqual(validate_points(points), [f'Point 3: non-finite value {points[2].tolist()}'])
+
+    def test_PointsCache(self):
+        tmp = TempPathHelper()
+        cacheFolder = path.join(tmp.path, 'cache')
+        gridPath = path.join(tmp.path, 'grid1.txt')
+        shutil.copyfile(self.gridPath1, gridPath)
+
+        loader = PointCloudLoader(cache_dir=cacheFolder)
+        theExtent = union_csv_extents([gridPath], loader=loader)
+        self.assertEqual(loader.parse_count, 1)
+
+        # A later run reads the extent and the points from the cache without parsing the text
+        loader = PointCloudLoader(cache_dir=cacheFolder)
+        self.assertEqual(union_csv_extents([gridPath], loader=loader), theExtent)
+        points = loader.get(gridPath)
+        self.assertEqual(loader.parse_count, 0)
+        self.assertIsInstance(points, np.memmap)
+        self.assertTrue(np.array_equal(points, np.loadtxt(self.gridPath1, ndmin=2)))
+
+        rCached = Raster(extent=theExtent, cellWidth=1.0)
+        rCached.load_dem_from_csv(gridPath, theExtent, cache_dir=cacheFolder)
+        rParsed = Raster(extent=theExtent, cellWidth=1.0)
+        rParsed.load_dem_from_csv(gridPath, theExtent)
+        self.assertTrue(np.array_equal(rCached.values, rParsed.values, equal_nan=True))
+
+        # Changing the text file invalidates its cache
+        del points
+        with open(gridPath, 'a') as f:
+            f.write('\n99 1.0 1.0 1.0')
+        loader = PointCloudLoader(cache_dir=cacheFolder)
+        self.assertEqual(loader.get(gridPath).shape[0], np.loadtxt(gridPath, ndmin=2).shape[0])
+        self.assertEqual(loader.parse_count, 1)
+        loader.clear()
+        tmp.destroy()
+
+    def test_Preload(self):
+        loader = PointCloudLoader(workers=2)
+        loader.preload([self.gridPath1, self.gridPath2])
+        self.assertEqual(loader.parse_count, 2)
+        loader.get(self.gridPath2)
+        self.assertEqual(loader.parse_count, 2)
+
+
+class TestSurveyStack(unittest.TestCase):
+
+    def setUp(self):
+        self.surveys = {
+            'a': np.array([[1.0, np.nan], [3.0, np.nan]]),
+            'b': np.array([[2.0, 5.0], [np.nan, np.nan]]),
+            'c': np.array([[0.5, 9.0], [9.0, np.nan]])
+        }
+
+    def check_stack(self, stack):
+        for key, values in self.surveys.items():
+            stack.set(key, values)
+            self.assertTrue(np.array_equal(stack.get(key), values, equal_nan=True))
+
+        # The same as merging the surveys one at a time
+        self.assertTrue(np.array_equal(stack.min_surface(['a', 'b']), np.fmin(self.surveys['a'], self.surveys['b']), equal_nan=True))
+        self.assertTrue(np.array_equal(stack.max_surface(), np.fmax(np.fmax(self.surveys['a'], self.surveys['b']), self.surveys['c']), equal_nan=True))
+        self.assertEqual(stack.statistics()['b'], (2.0, 5.0, 2, 7.0))
+        self.assertTrue(np.isnan(stack.min_surface([])).all())
+
+        # A survey with no values has no min or max
+        stack.set('c', np.full((2, 2), np.nan))
+        the_min, the_max, count, the_sum = stack.statistics()['c']
+        self.assertTrue(np.isnan(the_min) and np.isnan(the_max))
+        self.assertEqual((count, the_sum), (0, 0.0))
+
+    def test_InMemory(self):
+        stack = SurveyStack(list(self.surveys), 2, 2)
+        self.assertIsNone(stack.path)
+        self.check_stack(stack)
+        stack.close()
+
+    def test_MemoryMapped(self):
+        tmp = TempPathHelper()
+        stack = SurveyStack(list(self.surveys), 2, 2, folder=tmp.path, memmap_mb=0)
+        self.assertIsInstance(stack.values, np.memmap)
+        self.check_stack(stack)
+        stack_path = stack.path
+        stack.close()
+        self.assertFalse(path.isfile(stack_path))
+        tmp.destroy()
+
+
+class TestBuildManifest(unittest.TestCase):
+
+    def test_Rebuild(self):
+        tmp = TempPathHelper()
+        pointsPath = path.join(tmp.path, 'points.txt')
+        rasterPath = path.join(tmp.path, 'DEMs', 'dem.tif')
+        makedirs(path.dirname(rasterPath))
+        with open(pointsPath, 'w') as f:
+            f.write('1 2.0 3.0 4.0\n')
+
+        manifest = BuildManifest(tmp.path)
+        key = build_key(manifest.file_digest(pointsPath), 1.0, 'bilinear')
+        self.assertFalse(manifest.is_current(rasterPath, key))
+
+        with open(rasterPath, 'w') as f:
+            f.write('raster')
+        manifest.record(rasterPath, key)
+        manifest.set_state('surfaces', {'grid': {'cell_size': 1.0}, 'surveys': {'1': key}})
+        manifest.save()
+
+        # A later run with the same inputs reuses the raster
+        manifest = BuildManifest(tmp.path)
+        self.assertEqual(manifest.recorded_key(rasterPath), key)
+        self.assertDictEqual(manifest.state('surfaces'), {'grid': {'cell_size': 1.0}, 'surveys': {'1': key}})
+        self.assertIsNone(manifest.state('missing'))
+        self.assertTrue(manifest.is_current(rasterPath, build_key(manifest.file_digest(pointsPath), 1.0, 'bilinear')))
+        self.assertFalse(manifest.is_current(rasterPath, build_key(manifest.file_digest(pointsPath), 0.5, 'bilinear')))
+
+        # Changing the points rebuilds it
+        with open(pointsPath, 'a') as f:
+            f.write('2 2.0 4.0 4.0\n')
+        self.assertFalse(manifest.is_current(rasterPath, build_key(manifest.file_digest(pointsPath), 1.0, 'bilinear')))
+        tmp.destroy()
+
+
+class TestClipRaster(unittest.TestCase):
+    """
+    A 4 x 4 DEM of 1m cells from (0, 0) to (4, 4) clipped to the Eddy polygon of site 00001.
+    The polygon covers the centres of the four cells in the bottom left corner. It covers part
+    of the cells to their right and above but not their centres, so those are nodata.
+    """
+
+    def setUp(self):
+        self.tmp = TempPathHelper()
+        spatial_ref = osr.SpatialReference()
+        spatial_ref.ImportFromEPSG(26912)
+
+        self.dem_path = path.join(self.tmp.path, 'dem.tif')
+        self.values = np.arange(16, dtype=np.float32).reshape(4, 4)
+        Raster(array=self.values, extent=(0, 4, 0, 4), cellWidth=1.0, proj=spatial_ref.ExportToWkt()).write(self.dem_path)
+
+        self.shape_file = path.join(self.tmp.path, 'extents.shp')
+        self.write_shape_file(self.shape_file, spatial_ref, 0.0)
+
+        self.where_clause = "(\"Site\" ='00001')  AND (\"Section\"='Eddy')"
+
+        # Rows run from the top so the bottom left cells are rows 2 and 3, columns 0 and 1
+        self.inside = np.zeros((4, 4), dtype=bool)
+        self.inside[2:, :2] = True
+
+    def tearDown(self):
+        clear_clip_cache()
+        self.tmp.destroy()
+
+    @staticmethod
+    def write_shape_file(shape_file, spatial_ref, x_offset):
+        """
+        Write the Eddy and Channel polygons, moved x_offset along the x axis
+        """
+        data_source = ogr.GetDriverByName('ESRI Shapefile').CreateDataSource(shape_file)
+        layer = data_source.CreateLayer('extents', spatial_ref, ogr.wkbPolygon)
+        layer.CreateField(ogr.FieldDefn('Site', ogr.OFTString))
+        layer.CreateField(ogr.FieldDefn('Section', ogr.OFTString))
+        for section, corners in [('Eddy', (0.2, 2.4)), ('Channel', (3.0, 4.0))]:
+            low_x, high_x = (corner + x_offset for corner in corners)
+            low_y, high_y = corners
+            feature = ogr.Feature(layer.GetLayerDefn())
+            feature.SetField('Site', '00001')
+            feature.SetField('Section', section)
+            feature.SetGeometry(ogr.CreateGeometryFromWkt(
+                f'POLYGON (({low_x} {low_y}, {high_x} {low_y}, {high_x} {high_y}, {low_x} {high_y}, {low_x} {low_y}))'))
+            layer.CreateFeature(feature)
+            feature = None
+        data_source = None
+
+    def check_clipped(self, clipped_path):
+        """
+        The clipped raster has the DEM values inside the Eddy polygon, nodata everywhere
+        else, and statistics stored with it that match those values
+        """
+        dataset = gdal.Open(clipped_path)
+        band = dataset.GetRasterBand(1)
+        self.assertEqual(band.DataType, gdal.GDT_Float32)
+        self.assertEqual(band.GetNoDataValue(), -9999.0)
+        self.assertAlmostEqual(float(band.GetMetadataItem('STATISTICS_MINIMUM')), float(self.values[self.inside].min()))
+        self.assertAlmostEqual(float(band.GetMetadataItem('STATISTICS_MAXIMUM')), float(self.values[self.inside].max()))
+        band = None
+        dataset = None
+
+        clipped = Raster(filepath=clipped_path)
+        self.assertTrue(np.array_equal(clipped.values, np.where(self.inside, self.values, np.nan), equal_nan=True))
+        return clipped.values
+
+    def test_ClipInProcess(self):
+        clipped_path = path.join(self.tmp.path, 'clipped.tif')
+        clip_raster(None, self.dem_path, clipped_path, self.shape_file, self.where_clause, engine=ClipEngine.API, warp_threads=1)
+        self.check_clipped(clipped_path)
+
+        # COG is warped into /vsimem/ and then copied
+        cog_path = path.join(self.tmp.path, 'clipped_cog.tif')
+        clip_raster(None, self.dem_path, cog_path, self.shape_file, self.where_clause, geotiff_profile('cog'), ClipEngine.API)
+        self.check_clipped(cog_path)
+
+    def test_MaskMatchesWarp(self):
+        warped_path = path.join(self.tmp.path, 'warped.tif')
+        clip_raster(None, self.dem_path, warped_path, self.shape_file, self.where_clause, engine=ClipEngine.API)
+
+        masked_path = path.join(self.tmp.path, 'masked.tif')
+        dem = Raster(filepath=self.dem_path)
+        mask_raster(dem, masked_path, self.shape_file, self.where_clause)
+
+        # Cell for cell the same as the warp, including nodata at the edge of the polygon
+        masked = self.check_clipped(masked_path)
+        self.assertTrue(np.array_equal(masked, Raster(filepath=warped_path).values, equal_nan=True))
+        self.assertTrue(np.array_equal(dem.values, self.values))
+
+    def test_MaskReprojectsFeatures(self):
+        # The same polygons in UTM 12N with a false easting 100m larger than the DEM's
+        spatial_ref = osr.SpatialReference()
+        spatial_ref.ImportFromProj4('+proj=utm +zone=12 +datum=NAD83 +x_0=500100 +units=m +no_defs')
+        shifted_shape_file = path.join(self.tmp.path, 'shifted_extents.shp')
+        self.write_shape_file(shifted_shape_file, spatial_ref, 100.0)
+
+        warped_path = path.join(self.tmp.path, 'warped.tif')
+        clip_raster(None, self.dem_path, warped_path, shifted_shape_file, self.where_clause, engine=ClipEngine.API)
+
+        # The features are reprojected onto the DEM grid, just like the warp's cutline
+        masked_path = path.join(self.tmp.path, 'masked.tif')
+        mask_raster(Raster(filepath=self.dem_path), masked_path, shifted_shape_file, self.where_clause)
+        masked = self.check_clipped(masked_path)
+        self.assertTrue(np.array_equal(masked, self.check_clipped(warped_path), equal_nan=True))
+
+    def test_FeatureMaskCached(self):
+        dem = Raster(filepath=self.dem_path)
+        mask = feature_mask(self.shape_file, self.where_clause, dem)
+        self.assertTrue(np.array_equal(mask, self.inside))
+
+        # Rasterized once for the grid and then reused
+        self.assertIs(feature_mask(self.shape_file, self.where_clause, Raster(filepath=self.dem_path, read_array=False)), mask)
+
+        clear_clip_cache()
+        self.assertIsNot(feature_mask(self.shape_file, self.where_clause, dem), mask)
+
 
 class TestSandbarSite(unittest.TestCase):
     """
@@ -440,12 +1010,175 @@ class TestSandbarSite(unittest.TestCase):
             [gridPath1, gridPath2, gridPath3], padding, float=10)
         self.assertTupleEqual(theExtent, (-10.5, 14.5, -0.5, 23.5))
 
+    def test_RasterOutputs(self):
+        tmp = TempPathHelper()
+        site = make_site(['grid1.txt', 'grid2.txt'])
+        site.min_surface_path = path.join(tmp.path, 'min.tif')
+        site.max_surface_path = path.join(tmp.path, 'max.tif')
+        Raster(array=np.array([[1.0, 2.0], [np.nan, 4.0]]), extent=(0, 2, 0, 2), cellWidth=1.0).write(site.min_surface_path)
+        Raster(array=np.array([[5.0, 6.0], [np.nan, 8.0]]), extent=(0, 2, 0, 2), cellWidth=1.0).write(site.max_surface_path)
+        for survey_key, survey in site.surveys.items():
+            survey.dem_path = path.join(tmp.path, f'dem{survey_key}.tif')
+            survey.surveyed_sections = {1: SandbarSurveySection(1, 1, 'Eddy'), 2: SandbarSurveySection(2, 2, 'Channel')}
+            for section_key, section in survey.surveyed_sections.items():
+                section.raster_path = path.join(tmp.path, f'dem{survey_key}_{section_key}.tif')
+        site.surveys[2].surveyed_sections[2].ignore = True
+
+        # The outputs go between processes so they must survive pickling
+        outputs = pickle.loads(pickle.dumps(site.raster_outputs()))
+
+        copy = make_site(['grid1.txt', 'grid2.txt'])
+        for survey in copy.surveys.values():
+            survey.surveyed_sections = {1: SandbarSurveySection(1, 1, 'Eddy'), 2: SandbarSurveySection(2, 2, 'Channel')}
+        copy.apply_raster_outputs(outputs)
+
+        self.assertFalse(copy.ignore)
+        self.assertEqual(copy.min_surface_path, site.min_surface_path)
+        self.assertEqual(copy.max_surface_path, site.max_surface_path)
+        for survey_key, survey in site.surveys.items():
+            self.assertEqual(copy.surveys[survey_key].dem_path, survey.dem_path)
+            for section_key, section in survey.surveyed_sections.items():
+                self.assertEqual(copy.surveys[survey_key].surveyed_sections[section_key].raster_path, section.raster_path)
+                self.assertEqual(copy.surveys[survey_key].surveyed_sections[section_key].ignore, section.ignore)
+        self.assertTrue(copy.surveys[2].surveyed_sections[2].ignore)
+        self.assertTrue(np.array_equal(copy.min_surface.values, [[1.0, 2.0], [np.nan, 4.0]], equal_nan=True))
+        self.assertTrue(np.array_equal(copy.max_surface.values, [[5.0, 6.0], [np.nan, 8.0]], equal_nan=True))
+
+        # The surfaces of an ignored site are never opened
+        site.ignore = True
+        ignored = make_site(['grid1.txt', 'grid2.txt'])
+        for survey in ignored.surveys.values():
+            survey.surveyed_sections = {1: SandbarSurveySection(1, 1, 'Eddy'), 2: SandbarSurveySection(2, 2, 'Channel')}
+        ignored.apply_raster_outputs(site.raster_outputs())
+        self.assertTrue(ignored.ignore)
+        self.assertIsNone(ignored.min_surface)
+        self.assertIsNone(ignored.max_surface)
+        tmp.destroy()
 
-class TestAreaVolume(unittest.TestCase):
-    """
-    Refer to this spreadsheet: https://docs.google.com/spreadsheets/d/1MmjVkg4lg50rC0n6xYBTeor0T3_QPLQRaEYFmBnB5OA/edit#gid=0
+    def test_SurveyWorkers(self):
+        # Gridding the surveys in parallel threads gives the same surfaces as one at a time
+        surfaces = []
+        for workers in [1, 3]:
+            tmp = TempPathHelper()
+            site = make_site(['grid1.txt', 'grid2.txt', 'grid3.txt'])
+            # No points budget so every survey's points are parsed again by the thread that grids them
+            site.points.set_budget(0)
+            site.generate_dem_rasters(tmp.path, 1.0, 0.5, 'linear', '', False, survey_workers=workers)
+            surfaces.append((site.min_surface.values.copy(), site.max_surface.values.copy()))
+            tmp.destroy()
+
+        self.assertGreater(np.count_nonzero(~np.isnan(surfaces[0][0])), 0)
+        self.assertTrue(np.array_equal(surfaces[0][0], surfaces[1][0], equal_nan=True))
+        self.assertTrue(np.array_equal(surfaces[0][1], surfaces[1][1], equal_nan=True))
+
+    def build_surfaces(self, folder, points_files, min_surface=None, reuse=True):
+        """
+        Build the DEMs and min/max surfaces of a site in a folder
+        """
+        site = make_site(points_files, min_surface)
+        site.generate_dem_rasters(folder, 1.0, 0.5, 'linear', '', reuse)
+        return site
 
-    NOTE: THE FOLLOWING ASSUMES THRESHOLDING ASSUMES BOTH ">" AND "<" (AS OPPOSED TO "<=" AND/OR ">=")
+    def mark_min_surface(self, site):
+        """
+        Put a value below every survey into the saved minimum surface. It only
+        survives the next run if that run starts from the saved surfaces.
+        """
+        surface = Raster(filepath=site.min_surface_path)
+        values = surface.values.copy()
+        values[0, 0] = -1000.0
+        surface.set_array(values)
+        surface.write(site.min_surface_path)
+
+    def check_rebuilt(self, site, folder, points_files, min_surface=None):
+        """
+        The site's surfaces are the same as building them from scratch
+        """
+        rebuilt = self.build_surfaces(folder, points_files, min_surface, reuse=False)
+        self.assertTrue(np.array_equal(site.min_surface.values, rebuilt.min_surface.values, equal_nan=True))
+        self.assertTrue(np.array_equal(site.max_surface.values, rebuilt.max_surface.values, equal_nan=True))
+
+    def write_lowered(self, folder, points_file, name):
+        """
+        A copy of a test grid with every elevation 5m lower, so with the same extent
+        """
+        grids = path.join(path.dirname(path.abspath(__file__)), 'test', 'assets', 'grids')
+        points = read_points(path.join(grids, points_file))
+        lowered = path.join(folder, name)
+        with open(lowered, 'w') as f:
+            for point_id, x, y, z in points:
+                f.write(f'{int(point_id)} {x} {y} {z - 5.0}\n')
+        return lowered
+
+    def test_IncrementalSurfaces(self):
+        tmp = TempPathHelper()
+        folder = path.join(tmp.path, 'site')
+        lowered = self.write_lowered(tmp.path, 'grid1.txt', 'lowered.txt')
+
+        site = self.build_surfaces(folder, ['grid1.txt', 'grid2.txt'])
+        self.mark_min_surface(site)
+
+        # A new survey on the same extent is folded into the saved surfaces
+        site = self.build_surfaces(folder, ['grid1.txt', 'grid2.txt', lowered])
+        self.assertEqual(site.min_surface.values[0, 0], -1000.0)
+        values = site.min_surface.values.copy()
+        values[0, 0] = np.nan
+        rebuilt = self.build_surfaces(path.join(tmp.path, 'rebuilt'), ['grid1.txt', 'grid2.txt', lowered], reuse=False)
+        self.assertTrue(np.array_equal(np.fmin(values, rebuilt.min_surface.values), rebuilt.min_surface.values, equal_nan=True))
+        self.assertTrue(np.array_equal(site.max_surface.values, rebuilt.max_surface.values, equal_nan=True))
+
+        # The saved surfaces now include the new survey
+        state = BuildManifest(folder).state('surfaces')
+        self.assertSetEqual(set(state['surveys']), {'1', '2', '3'})
+        tmp.destroy()
+
+    def test_SurfacesRebuiltForLargerExtent(self):
+        tmp = TempPathHelper()
+        folder = path.join(tmp.path, 'site')
+        site = self.build_surfaces(folder, ['grid1.txt', 'grid2.txt'])
+        self.mark_min_surface(site)
+
+        # grid3 grows the union extent so the surfaces are rebuilt from every survey
+        site = self.build_surfaces(folder, ['grid1.txt', 'grid2.txt', 'grid3.txt'])
+        self.assertNotEqual(site.min_surface.values[0, 0], -1000.0)
+        self.check_rebuilt(site, path.join(tmp.path, 'rebuilt'), ['grid1.txt', 'grid2.txt', 'grid3.txt'])
+        tmp.destroy()
+
+    def test_SurfacesRebuiltForChangedSurvey(self):
+        tmp = TempPathHelper()
+        folder = path.join(tmp.path, 'site')
+        points = self.write_lowered(tmp.path, 'grid2.txt', 'points.txt')
+        site = self.build_surfaces(folder, ['grid1.txt', points])
+        self.mark_min_surface(site)
+
+        # Changing the points of a survey in the surfaces rebuilds them
+        self.write_lowered(tmp.path, 'grid1.txt', 'points.txt')
+        site = self.build_surfaces(folder, ['grid1.txt', points])
+        self.assertNotEqual(site.min_surface.values[0, 0], -1000.0)
+        self.check_rebuilt(site, path.join(tmp.path, 'rebuilt'), ['grid1.txt', points])
+
+        # So does taking a survey out of the surfaces
+        self.mark_min_surface(site)
+        site = self.build_surfaces(folder, ['grid1.txt', points], [True, False])
+        self.assertNotEqual(site.min_surface.values[0, 0], -1000.0)
+        self.check_rebuilt(site, path.join(tmp.path, 'rebuilt_unflagged'), ['grid1.txt', points], [True, False])
+        tmp.destroy()
+
+    def test_WorkerError(self):
+        # The settings go to the worker processes so they must survive pickling
+        settings = RasterPrepSettings(None, 1.0, 1.0, 'bilinear', 26912, False, None, None)
+        self.assertEqual(pickle.loads(pickle.dumps(settings)), settings)
+
+        # A worker hands back its exception with the traceback in its log messages. There is no analysis folder to write to
+        outputs, records, error = _prepare_site_in_worker(make_site(['grid1.txt']), settings)
+        self.assertIsNone(outputs)
+        self.assertIsInstance(error, TypeError)
+        self.assertTrue(any('Traceback' in message and severity == 'error' for message, __method, severity, __exception in records))
+
+
+class AreaVolumeTestCase(unittest.TestCase):
+    """
+    Surface and minimum surface shared by the area and volume tests
     """
 
     def setUp(self):
@@ -472,6 +1205,14 @@ class TestAreaVolume(unittest.TestCase):
                 [1, 0, 0, 0],
                 [0, 1, 0, 0]]))
 
+
+class TestAreaVolume(AreaVolumeTestCase):
+    """
+    Refer to this spreadsheet: https://docs.google.com/spreadsheets/d/1MmjVkg4lg50rC0n6xYBTeor0T3_QPLQRaEYFmBnB5OA/edit#gid=0
+
+    NOTE: THE FOLLOWING ASSUMES THRESHOLDING ASSUMES BOTH ">" AND "<" (AS OPPOSED TO "<=" AND/OR ">=")
+    """
+
     def test_LowZeroNoHigh(self):
         """
         Test when low threshold is 0 and there is no high threshold
@@ -549,5 +1290,111 @@ class TestAreaVolume(unittest.TestCase):
         self.assertAlmostEqual(test[1], 0.0, places=7)
 
 
+class TestHypsometry(AreaVolumeTestCase):
+    """
+    The single pass hypsometry must give the same answers as calling
+    get_vol_and_area() once for every elevation.
+    """
+
+    def test_MatchesVolAndArea(self):
+        elevations = [0.0, 0.5, 2.5, 10.0, 15.5, 20.0, 99.9, 101.0]
+        areas, volumes = raster_analysis.get_hypsometry(
+            self.arSurf, self.arMin, elevations, self.cellSize)
+
+        for idx, elevation in enumerate(elevations):
+            test = raster_analysis.get_vol_and_area(
+                self.arSurf, self.arMin, elevation, None, self.cellSize)
+            self.assertAlmostEqual(areas[idx], test[0], places=7)
+            self.assertAlmostEqual(volumes[idx], test[1], places=7)
+
+    def test_Float32(self):
+        # float32 rasters give the float64 answers to float32 precision because the sums are done in float64
+        elevations = [0.0, 2.5, 15.5]
+        areas, volumes = raster_analysis.get_hypsometry(self.arSurf, self.arMin, elevations, self.cellSize)
+        areas32, volumes32 = raster_analysis.get_hypsometry(
+            self.arSurf.astype(np.float32), self.arMin.astype(np.float32), elevations, self.cellSize)
+        self.assertTrue(np.array_equal(areas, areas32))
+        self.assertTrue(np.allclose(volumes, volumes32, rtol=1e-6))
+
+    def test_Float32Ties(self):
+        # Cells that hold exactly an elevation step once both are rounded to float32 must
+        # land on the same side of it as they do for get_vol_and_area()
+        arSurf = np.arange(800, 1300, dtype=np.float32).reshape(20, 25) / np.float32(100)
+        arMin = np.full(arSurf.shape, 8.0, dtype=np.float32)
+        elevations = [8.0 + 0.1 * step for step in range(45)]
+        areas, volumes = raster_analysis.get_hypsometry(arSurf, arMin, elevations, self.cellSize)
+
+        for idx, elevation in enumerate(elevations):
+            test = raster_analysis.get_vol_and_area(arSurf, arMin, elevation, None, self.cellSize)
+            self.assertEqual(areas[idx], test[0])
+            self.assertAlmostEqual(volumes[idx], test[1], places=7)
+
+    def test_EmptySurvey(self):
+        arEmpty = np.ma.masked_array(self.arSurf.data, mask=np.ones(self.arSurf.shape))
+        areas, volumes = raster_analysis.get_hypsometry(
+            arEmpty, self.arMin, [0.0, 10.0], self.cellSize)
+        self.assertTrue((areas == 0).all())
+        self.assertTrue((volumes == 0).all())
+
+    def test_WindowedValues(self):
+        # Reading the survey one window at a time must gather the same cells as the whole array
+        survey = Raster(array=self.arSurf, extent=(0, 0.4, 0, 0.3), cellWidth=self.cellSize)
+        survey.block_size = (1, 1)
+        self.assertEqual(len(list(survey.windows(max_cells=2))), 6)
+
+        elevations = [0.0, 10.0, 20.0]
+        windowed = raster_analysis.get_hypsometry_from_values(
+            *raster_analysis.get_valid_values_by_window(survey, self.arMin, max_cells=2), elevations, self.cellSize)
+        whole = raster_analysis.get_hypsometry(self.arSurf, self.arMin, elevations, self.cellSize)
+        self.assertTrue(np.allclose(windowed[0], whole[0]))
+        self.assertTrue(np.allclose(windowed[1], whole[1]))
+
+
+class TestBinnedAreaVolume(AreaVolumeTestCase):
+    """
+    The batched bin functions must give the same answers as calling
+    get_vol_and_area() and get_bin_area() once for every bin.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.elevPairs = [(0, None), (10, None), (None, 20), (10, 20), (101, None), (None, 200), (101, 200)]
+
+    def test_MatchesVolAndArea(self):
+        test = raster_analysis.get_vol_and_area_bins(
+            self.arSurf, self.arMin, self.elevPairs, self.cellSize)
+
+        for idx, (lower, upper) in enumerate(self.elevPairs):
+            expected = raster_analysis.get_vol_and_area(
+                self.arSurf, self.arMin, lower, upper, self.cellSize)
+            for col in range(6):
+                self.assertAlmostEqual(test[col][idx], expected[col], places=7)
+
+    def test_MatchesBinArea(self):
+        test = raster_analysis.get_bin_areas(self.arSurf, self.elevPairs, self.cellSize)
+
+        for idx, (lower, upper) in enumerate(self.elevPairs):
+            expected = raster_analysis.get_bin_area(self.arSurf, lower, upper, self.cellSize)
+            self.assertAlmostEqual(test[idx], expected, places=7)
+
+    def test_Float32Ties(self):
+        # Bin bounds that equal float32 cell values once rounded must split the cells
+        # the same way as get_vol_and_area() and get_bin_area()
+        arSurf = np.arange(800, 1300, dtype=np.float32).reshape(20, 25) / np.float32(100)
+        arMin = np.full(arSurf.shape, 8.0, dtype=np.float32)
+        elevPairs = [(8.1, None), (None, 12.3), (8.1, 12.3), (8.7, 9.9), (10.2, 11.1), (12.3, None)]
+
+        test = raster_analysis.get_vol_and_area_bins(arSurf, arMin, elevPairs, self.cellSize)
+        test_areas = raster_analysis.get_bin_areas(arSurf, elevPairs, self.cellSize)
+
+        for idx, (lower, upper) in enumerate(elevPairs):
+            expected = raster_analysis.get_vol_and_area(arSurf, arMin, lower, upper, self.cellSize)
+            self.assertEqual(test[0][idx], expected[0])
+            self.assertEqual(test[3][idx], expected[3])
+            for col in (1, 2, 4, 5):
+                self.assertAlmostEqual(test[col][idx], expected[col], places=7)
+            self.assertEqual(test_areas[idx], raster_analysis.get_bin_area(arSurf, lower, upper, self.cellSize))
+
+
 if __name__ == '__main__':
     unittest.main()